@@ -1,40 +1,246 @@
 import os
 import stat
 import platform
-from flask import Flask, request, render_template, send_file, jsonify
-from werkzeug.utils import secure_filename
-from PyPDF2 import PdfReader, PdfWriter
+from flask import Flask, Response, g, has_request_context, request, render_template, send_file, jsonify
+from flask.logging import default_handler
+from werkzeug.exceptions import RequestedRangeNotSatisfiable
+from werkzeug.utils import secure_filename, send_file as werkzeug_send_file
+from werkzeug.sansio.multipart import MultipartDecoder, Field, File, Data, Epilogue, NeedData
 import re
+import sys
 import uuid
+import hashlib
+import hmac
 import shutil
 import time
 import zipfile
+import zlib
 import io
 import json
-from urllib.parse import unquote
+from urllib.parse import quote, unquote
 import base64
 import datetime
 import traceback
+import threading
+import logging
+import logging.handlers
+import queue
+import random
+import atexit
+import cProfile
+import marshal
+import multiprocessing
+import pstats
+import sqlite3
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+
+# prometheus_client chooses multiprocess mode when it is imported: every
+# gunicorn worker and PDF pool process writes its values to files in this
+# folder and /metrics adds them up. The folder is emptied when the server starts.
+METRICS_FOLDER = os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR',
+                                       os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'metrics'))
+# "python -m app unlock ..." runs the bulk CLI instead of the server. It
+# leaves the server's folders alone, so running it in a checkout never
+# touches the server's state. Pool processes started with spawn or forkserver
+# import this file again and learn it from the environment
+CLI_MODE = os.environ.get('PDF_UNLOCKER_CLI') == '1' or (__name__ == '__main__' and sys.argv[1:2] == ['unlock'])
+if CLI_MODE and 'PDF_UNLOCKER_CLI' not in os.environ:
+    os.environ['PDF_UNLOCKER_CLI'] = '1'
+    # Keep the CLI's metrics out of the folder of a server on the same machine
+    import tempfile
+    METRICS_FOLDER = os.environ['PROMETHEUS_MULTIPROC_DIR'] = tempfile.mkdtemp(prefix='pdf-unlocker-cli-metrics-')
+    atexit.register(shutil.rmtree, METRICS_FOLDER, ignore_errors=True)
+elif __name__ == '__main__':
+    # The development server is the only process: start from zero
+    shutil.rmtree(METRICS_FOLDER, ignore_errors=True)
+os.makedirs(METRICS_FOLDER, exist_ok=True)
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess
 
 # Detect if we're on Render.com
 IS_RENDER = os.environ.get('RENDER') == 'true'
 # Print environment details for debugging
-print(f"Running on: {platform.system()} {platform.release()}")
-print(f"Python version: {platform.python_version()}")
-print(f"Is Render: {IS_RENDER}")
+if not CLI_MODE:
+    print(f"Running on: {platform.system()} {platform.release()}")
+    print(f"Python version: {platform.python_version()}")
+    print(f"Is Render: {IS_RENDER}")
 
 app = Flask(__name__)
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
 
+# Logging: records are handed to a background thread through a queue and only
+# formatted there, so a request never waits for the formatting or for stderr.
+# LOG_FORMAT is 'json' (one object per line) or 'text'
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'WARNING' if CLI_MODE else 'INFO').upper()
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'json')
+# Records waiting for the writer; when it cannot keep up, new records are
+# dropped and counted instead of blocking the request
+LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', 10000))
+# Seconds between the writer's passes over the queue. Waking it for every
+# record would take the GIL from the request that logged it
+LOG_FLUSH_INTERVAL = float(os.environ.get('LOG_FLUSH_INTERVAL', 0.2))
+# Share of the records of an event that is kept, e.g.
+# LOG_SAMPLE_RATES="result_cache_hit=0.1,password_variation=0.01".
+# Warnings and errors are always kept
+LOG_SAMPLE_RATES = {
+    event.strip(): float(rate)
+    for event, _, rate in (item.partition('=') for item in os.environ.get('LOG_SAMPLE_RATES', '').split(','))
+    if event.strip() and rate.strip()
+}
+
+# Fields and "name=value" pairs in messages whose values never reach the log
+SECRET_FIELDS = {'password', 'passwd', 'token', 'admin_token', 'authorization', 'cookie'}
+SECRET_PATTERN = re.compile(r'(?i)\b(password|passwd|pwd|token)(\s*[:=]\s*)(\S+)')
+REDACTED = '[redacted]'
+
+# Attributes every LogRecord has; everything else was passed with extra=
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+def redact(message):
+    """Replace the values of password and token assignments in a message."""
+    return SECRET_PATTERN.sub(lambda m: m.group(1) + m.group(2) + REDACTED, message)
+
+class JsonLogFormatter(logging.Formatter):
+    """One JSON object per record, with the extra= fields as keys."""
+
+    def format(self, record):
+        entry = {
+            'time': datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'pid': record.process,
+            'thread': record.threadName,
+            'message': redact(record.getMessage())
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES and not key.startswith('_'):
+                entry[key] = REDACTED if key.lower() in SECRET_FIELDS else value
+        if record.exc_info:
+            entry['exc'] = redact(self.formatException(record.exc_info))
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+class RedactingFormatter(logging.Formatter):
+    """The text format with the same redaction as the JSON one."""
+
+    def format(self, record):
+        return redact(super().format(record))
+
+class SamplingFilter(logging.Filter):
+    """Keep only LOG_SAMPLE_RATES of the records of high-volume events."""
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = LOG_SAMPLE_RATES.get(getattr(record, 'event', None))
+        return rate is None or random.random() < rate
+
+class RequestContextFilter(logging.Filter):
+    """Add the method and path of the request a record was logged in."""
+
+    def filter(self, record):
+        if has_request_context():
+            record.method = request.method
+            record.path = request.path
+        return True
+
+LOG_RECORDS_DROPPED = Counter('pdf_unlocker_log_records_dropped', 'Log records dropped because the log queue was full')
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """Queue records as they are, without formatting them in the caller."""
+
+    def prepare(self, record):
+        # The record goes to a thread of this process, so its arguments do
+        # not have to be made picklable; formatting waits for the writer
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_RECORDS_DROPPED.inc()
+
+class BatchLogWriter:
+    """Background thread that writes the queued records every LOG_FLUSH_INTERVAL."""
+
+    def __init__(self, log_queue, handler):
+        self.queue = log_queue
+        self.handler = handler
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='log-writer', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        """Write out what is still queued and end the thread."""
+        self._stopped.set()
+        if self._thread.is_alive():
+            self._thread.join()
+
+    def _run(self):
+        while not self._stopped.wait(LOG_FLUSH_INTERVAL):
+            self.flush()
+        self.flush()
+
+    def flush(self):
+        while True:
+            try:
+                record = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            self.handler.handle(record)
+        self.handler.flush()
+
+def _log_formatter():
+    if LOG_FORMAT == 'text':
+        return RedactingFormatter('[%(asctime)s] %(levelname)s in %(module)s: %(message)s')
+    return JsonLogFormatter()
+
+def _start_log_listener():
+    """Route app.logger through a fresh queue and writer thread."""
+    global log_listener
+    log_queue = queue.Queue(LOG_QUEUE_SIZE)
+    log_handler.queue = log_queue
+    stream_handler = logging.StreamHandler(sys.stderr)
+    stream_handler.setFormatter(_log_formatter())
+    log_listener = BatchLogWriter(log_queue, stream_handler)
+    log_listener.start()
+
+log_handler = DroppingQueueHandler(None)
+log_handler.addFilter(SamplingFilter())
+log_handler.addFilter(RequestContextFilter())
+app.logger.removeHandler(default_handler)
+app.logger.addHandler(log_handler)
+app.logger.setLevel(LOG_LEVEL)
+log_listener = None
+_start_log_listener()
+# Write out what is still queued when the process exits
+atexit.register(lambda: log_listener.stop())
+if hasattr(os, 'register_at_fork'):
+    # The writer thread does not survive a fork: the child, a PDF pool
+    # process, gets its own
+    os.register_at_fork(after_in_child=_start_log_listener)
+
 # Create uploads and processed folders in the current directory
 UPLOAD_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'uploads')
 PROCESSED_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'processed')
 DATA_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
 
+def make_server_folder(path):
+    """Create a folder the server keeps its state in, unless running the CLI."""
+    if not CLI_MODE:
+        os.makedirs(path, exist_ok=True)
+
 # Ensure all directories exist
-os.makedirs(UPLOAD_FOLDER, exist_ok=True)
-os.makedirs(PROCESSED_FOLDER, exist_ok=True)
-os.makedirs(DATA_FOLDER, exist_ok=True)
+make_server_folder(UPLOAD_FOLDER)
+make_server_folder(PROCESSED_FOLDER)
+make_server_folder(DATA_FOLDER)
 
 # Fix permissions for folders
 def ensure_folder_permissions():
@@ -48,7 +254,7 @@ def ensure_folder_permissions():
             if not (current_mode & stat.S_IWUSR) or not (current_mode & stat.S_IWGRP):
                 new_mode = current_mode | stat.S_IWUSR | stat.S_IWGRP
                 os.chmod(folder, new_mode)
-                app.logger.info(f"Fixed permissions for {folder}")
+                app.logger.info("Fixed permissions for %s", folder)
                 
         # Test write permission by creating and removing a test file
         for folder in [UPLOAD_FOLDER, PROCESSED_FOLDER, DATA_FOLDER]:
@@ -56,66 +262,471 @@ def ensure_folder_permissions():
             with open(test_file, 'w') as f:
                 f.write('test')
             os.remove(test_file)
-            app.logger.info(f"Write test successful for {folder}")
+            app.logger.info("Write test successful for %s", folder)
             
     except Exception as e:
-        app.logger.error(f"Failed to fix permissions: {str(e)}")
+        app.logger.error("Failed to fix permissions: %s", e)
 
 # Run permission check at startup
-ensure_folder_permissions()
+if not CLI_MODE:
+    ensure_folder_permissions()
 
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['PROCESSED_FOLDER'] = PROCESSED_FOLDER
 app.config['DATA_FOLDER'] = DATA_FOLDER
 
+# Metrics served by /metrics
+# Buckets reach 2 minutes, the gunicorn timeout, for the slowest documents
+STAGE_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+# Time per processing stage: upload_save, encryption_probe, decrypt,
+# page_copy, write, verify and clean_filename
+STAGE_SECONDS = Histogram('pdf_unlocker_stage_seconds', 'Time spent in each processing stage',
+                          ['stage'], buckets=STAGE_BUCKETS)
+ZIP_BUILD_SECONDS = Histogram('pdf_unlocker_zip_build_seconds', 'Time to stream a /download-all archive',
+                              buckets=STAGE_BUCKETS)
+BYTES_IN = Counter('pdf_unlocker_bytes_in', 'Bytes of uploaded files')
+BYTES_OUT = Counter('pdf_unlocker_bytes_out', 'Bytes of unlocked files and archives sent')
+FILES_PROCESSED = Counter('pdf_unlocker_files', 'Unlock results by status', ['status'])
+PASSWORD_ATTEMPTS = Counter('pdf_unlocker_password_attempts', 'Password variations tried')
+
+# Requests, unlock jobs and PDF pool tasks running right now; only processes
+# that are alive count
+IN_FLIGHT = Gauge('pdf_unlocker_in_flight', 'Work currently in progress', ['kind'],
+                  multiprocess_mode='livesum')
+
+def count_file_result(status, count=1):
+    """Count finished unlocks as success, needs_password or error."""
+    FILES_PROCESSED.labels(status).inc(count)
+
+def unlock_result_status(result):
+    """The status an unlock result is counted under."""
+    if result.get('status') == 'success':
+        return 'success'
+    return 'needs_password' if result.get('needs_password') else 'error'
+
 # Path to store processed files information
 PROCESSED_FILES_DB = os.path.join(DATA_FOLDER, 'processed_files.json')
 
-# Dictionary to track processed files
-processed_files = {}
+# Where file metadata is kept: 'sqlite' shares it between all worker processes,
+# 'json' keeps it in per-process dictionaries journaled to PROCESSED_FILES_JOURNAL
+METADATA_BACKEND = os.environ.get('METADATA_BACKEND', 'sqlite')
+METADATA_DB = os.path.join(DATA_FOLDER, 'metadata.db')
+
+# How long uploads and unlocked files are kept, in seconds
+FILE_TTL = int(os.environ.get('FILE_TTL', 3600))
+
+def _os_thread_local():
+    """
+    Return a threading.local whose values belong to the OS thread.
+    
+    gevent's monkey patching makes threading.local per greenlet, which would
+    give every request of the async server mode a connection of its own.
+    """
+    monkey = sys.modules.get('gevent.monkey')
+    if monkey is not None and monkey.is_module_patched('threading'):
+        return monkey.get_original('threading', 'local')()
+    return threading.local()
+
+# One SQLite connection per OS thread, reopened in forked processes. In the
+# async server mode the greenlets of the event loop share one: none of them
+# can switch in the middle of a statement
+_metadata_local = _os_thread_local()
+
+def get_metadata_db():
+    """Return this thread's connection to the metadata database."""
+    conn = getattr(_metadata_local, 'conn', None)
+    if conn is None or _metadata_local.pid != os.getpid():
+        conn = sqlite3.connect(METADATA_DB, timeout=10, isolation_level=None, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        _metadata_local.conn = conn
+        _metadata_local.pid = os.getpid()
+    return conn
+
+def init_metadata_db():
+    """Create the metadata tables if they do not exist yet."""
+    get_metadata_db().executescript('''
+        CREATE TABLE IF NOT EXISTS files (
+            kind TEXT NOT NULL,
+            key TEXT NOT NULL,
+            name TEXT NOT NULL,
+            size INTEGER,
+            sha256 TEXT,
+            created_at REAL NOT NULL,
+            accessed_at REAL NOT NULL,
+            expires_at REAL NOT NULL,
+            PRIMARY KEY (kind, key)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS files_expires_at ON files (expires_at);
+        CREATE INDEX IF NOT EXISTS files_accessed_at ON files (accessed_at);
+        CREATE TABLE IF NOT EXISTS memory_reservations (
+            id TEXT PRIMARY KEY,
+            pid INTEGER NOT NULL,
+            bytes INTEGER NOT NULL,
+            created_at REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS counters (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        );
+    ''')
+
+# Counters of the json backend, which has no shared database to keep them in
+local_counters = {}
+
+def bump_counter(name, amount=1):
+    """Add to a counter shared by all workers (per process with the json backend)."""
+    if METADATA_BACKEND == 'sqlite':
+        get_metadata_db().execute(
+            'INSERT INTO counters (name, value) VALUES (?, ?) '
+            'ON CONFLICT (name) DO UPDATE SET value = value + excluded.value', (name, amount))
+    else:
+        local_counters[name] = local_counters.get(name, 0) + amount
+
+def read_counters():
+    """Return all counters as a dict."""
+    if METADATA_BACKEND == 'sqlite':
+        return dict(get_metadata_db().execute('SELECT name, value FROM counters').fetchall())
+    return dict(local_counters)
+
+_MISSING = object()
+
+class MetadataTable(MutableMapping):
+    """
+    Dictionary view of one kind of file in the metadata database.
+    
+    processed_files maps unlocked filenames to display names and
+    protected_files maps upload file IDs to original filenames; every read
+    and write goes straight to SQLite, so all workers see the same data.
+    """
+    
+    def __init__(self, kind):
+        self.kind = kind
+    
+    def __getitem__(self, key):
+        row = get_metadata_db().execute(
+            'SELECT name FROM files WHERE kind = ? AND key = ?', (self.kind, key)).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return row[0]
+    
+    def __setitem__(self, key, name):
+        self.put(key, name)
+    
+    def __delitem__(self, key):
+        cursor = get_metadata_db().execute(
+            'DELETE FROM files WHERE kind = ? AND key = ?', (self.kind, key))
+        if cursor.rowcount == 0:
+            raise KeyError(key)
+    
+    def __contains__(self, key):
+        return get_metadata_db().execute(
+            'SELECT 1 FROM files WHERE kind = ? AND key = ?', (self.kind, key)).fetchone() is not None
+    
+    def __iter__(self):
+        return iter(self.keys())
+    
+    def __len__(self):
+        return get_metadata_db().execute(
+            'SELECT COUNT(*) FROM files WHERE kind = ?', (self.kind,)).fetchone()[0]
+    
+    def keys(self):
+        return [row[0] for row in get_metadata_db().execute(
+            'SELECT key FROM files WHERE kind = ?', (self.kind,))]
+    
+    def items(self):
+        return get_metadata_db().execute(
+            'SELECT key, name FROM files WHERE kind = ?', (self.kind,)).fetchall()
+    
+    def pop(self, key, default=_MISSING):
+        # SELECT then DELETE rather than DELETE ... RETURNING, which needs SQLite 3.35
+        conn = get_metadata_db()
+        row = conn.execute(
+            'SELECT name FROM files WHERE kind = ? AND key = ?', (self.kind, key)).fetchone()
+        if row is not None:
+            conn.execute('DELETE FROM files WHERE kind = ? AND key = ?', (self.kind, key))
+        if row is None:
+            if default is _MISSING:
+                raise KeyError(key)
+            return default
+        return row[0]
+    
+    def clear(self):
+        get_metadata_db().execute('DELETE FROM files WHERE kind = ?', (self.kind,))
+    
+    def put(self, key, name, size=None, sha256=None, ttl=None):
+        """Insert or replace an entry along with its size, hash and expiry."""
+        now = time.time()
+        get_metadata_db().execute('''
+            INSERT INTO files (kind, key, name, size, sha256, created_at, accessed_at, expires_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (kind, key) DO UPDATE SET
+                name = excluded.name,
+                size = COALESCE(excluded.size, files.size),
+                sha256 = COALESCE(excluded.sha256, files.sha256),
+                accessed_at = excluded.accessed_at,
+                expires_at = excluded.expires_at
+        ''', (self.kind, key, name, size, sha256, now, now, now + (ttl or FILE_TTL)))
+    
+    def touch(self, key):
+        """Mark an entry as just used, for least-recently-used eviction."""
+        get_metadata_db().execute(
+            'UPDATE files SET accessed_at = ? WHERE kind = ? AND key = ?', (time.time(), self.kind, key))
+    
+    def record(self, key):
+        """Return all stored columns of an entry as a dict, or None."""
+        cursor = get_metadata_db().execute(
+            'SELECT * FROM files WHERE kind = ? AND key = ?', (self.kind, key))
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        return dict(zip([column[0] for column in cursor.description], row))
+
+# Append-only log of changes to processed_files for the 'json' backend,
+# replayed on top of the PROCESSED_FILES_DB snapshot at startup
+PROCESSED_FILES_JOURNAL = os.path.join(DATA_FOLDER, 'processed_files.journal')
+
+# Seconds between batched fsyncs of the journal
+JOURNAL_SYNC_INTERVAL = float(os.environ.get('JOURNAL_SYNC_INTERVAL', 1))
+
+# Seconds between compactions, and journal records that trigger one early
+JOURNAL_COMPACT_INTERVAL = int(os.environ.get('JOURNAL_COMPACT_INTERVAL', 300))
+JOURNAL_COMPACT_RECORDS = int(os.environ.get('JOURNAL_COMPACT_RECORDS', 10000))
+
+class MetadataJournal:
+    """
+    Append-only journal of set/del/clear records over a JSON snapshot.
+    
+    Appends are one small write each; a background thread fsyncs them in
+    batches and periodically compacts snapshot + journal into a new snapshot.
+    All workers append to the same journal, and compaction replays it from
+    disk under an exclusive lock, so no worker's changes are dropped.
+    """
+    
+    def __init__(self, snapshot_path, journal_path):
+        self.snapshot_path = snapshot_path
+        self.journal_path = journal_path
+        self.lock = threading.Lock()
+        self.fd = None
+        self.pid = None
+        self.dirty = False
+        self.records = 0
+        self.last_compact = time.time()
+    
+    def _open(self):
+        if self.fd is None or self.pid != os.getpid():
+            self.fd = os.open(self.journal_path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+            self.pid = os.getpid()
+            
+            # Terminate a record left half-written by a crash so the next one
+            # starts on a line of its own
+            with open(self.journal_path, 'rb') as f:
+                f.seek(0, os.SEEK_END)
+                if f.tell() > 0:
+                    f.seek(-1, os.SEEK_END)
+                    if f.read(1) != b'\n':
+                        os.write(self.fd, b'\n')
+            threading.Thread(target=self._maintain, daemon=True).start()
+        return self.fd
+    
+    def _flock(self, fd, operation):
+        if fcntl is not None:
+            # Waits while another process compacts the journal
+            run_cpu_bound(fcntl.flock, fd, getattr(fcntl, operation))
+    
+    def append(self, op, key=None, name=None):
+        """Append one record; it reaches the disk with the next batched fsync."""
+        record = {'op': op}
+        if key is not None:
+            record['key'] = key
+        if name is not None:
+            record['name'] = name
+        line = (json.dumps(record) + '\n').encode('utf-8')
+        
+        with self.lock:
+            fd = self._open()
+            self._flock(fd, 'LOCK_SH')
+            try:
+                os.write(fd, line)
+            finally:
+                self._flock(fd, 'LOCK_UN')
+            self.dirty = True
+            self.records += 1
+    
+    def sync(self):
+        """fsync the journal if anything was appended since the last sync."""
+        with self.lock:
+            if self.dirty and self.fd is not None and self.pid == os.getpid():
+                os.fsync(self.fd)
+                self.dirty = False
+    
+    def replay(self):
+        """Return the state recorded by the snapshot and the journal."""
+        state = {}
+        if os.path.exists(self.snapshot_path):
+            try:
+                with open(self.snapshot_path, 'r') as f:
+                    state = json.load(f)
+            except Exception as e:
+                app.logger.error("Error loading processed files snapshot: %s", e)
+        
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path, 'rb') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # A record cut short by a crash
+                        continue
+                    if record['op'] == 'set':
+                        state[record['key']] = record['name']
+                    elif record['op'] == 'del':
+                        state.pop(record['key'], None)
+                    elif record['op'] == 'clear':
+                        state.clear()
+        return state
+    
+    def compact(self):
+        """Fold the journal into a new snapshot and truncate it."""
+        with self.lock:
+            fd = self._open()
+            self._flock(fd, 'LOCK_EX')
+            try:
+                state = self.replay()
+                temp_file = os.path.join(os.path.dirname(self.snapshot_path), f'temp_{uuid.uuid4()}.json')
+                with open(temp_file, 'w') as f:
+                    json.dump(state, f)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(temp_file, self.snapshot_path)
+                os.ftruncate(fd, 0)
+                self.dirty = False
+                self.records = 0
+                self.last_compact = time.time()
+            finally:
+                self._flock(fd, 'LOCK_UN')
+        app.logger.info("Compacted processed files journal: %s entries", len(state))
+    
+    def _maintain(self):
+        pid = os.getpid()
+        while self.pid == pid:
+            time.sleep(JOURNAL_SYNC_INTERVAL)
+            try:
+                self.sync()
+                if (self.records >= JOURNAL_COMPACT_RECORDS or
+                        (self.records and time.time() - self.last_compact >= JOURNAL_COMPACT_INTERVAL)):
+                    self.compact()
+            except Exception as e:
+                app.logger.error("Processed files journal maintenance error: %s", e)
+
+class MemoryTable(dict):
+    """
+    Per-process dictionary with the same interface as MetadataTable.
+    
+    Changes are appended to the journal, if one is given.
+    """
+    
+    def __init__(self, journal=None):
+        super().__init__()
+        self.journal = journal
+    
+    def __setitem__(self, key, name):
+        super().__setitem__(key, name)
+        if self.journal:
+            self.journal.append('set', key, name)
+    
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        if self.journal:
+            self.journal.append('del', key)
+    
+    def pop(self, key, *default):
+        had_key = key in self
+        value = super().pop(key, *default)
+        if had_key and self.journal:
+            self.journal.append('del', key)
+        return value
+    
+    def clear(self):
+        super().clear()
+        if self.journal:
+            self.journal.append('clear')
+    
+    def update(self, *args, **kwargs):
+        for key, name in dict(*args, **kwargs).items():
+            self[key] = name
+    
+    def load(self, state):
+        """Replace the contents without journaling them."""
+        super().clear()
+        super().update(state)
+    
+    def put(self, key, name, size=None, sha256=None, ttl=None):
+        self[key] = name
+    
+    def touch(self, key):
+        pass
+    
+    def record(self, key):
+        return None
+
+processed_files_journal = MetadataJournal(PROCESSED_FILES_DB, PROCESSED_FILES_JOURNAL)
 
-# Dictionary to track password-protected files
-protected_files = {}
+if CLI_MODE:
+    # The CLI tracks no uploads or downloads
+    processed_files = MemoryTable()
+    protected_files = MemoryTable()
+elif METADATA_BACKEND == 'sqlite':
+    init_metadata_db()
+    
+    # Dictionary to track processed files
+    processed_files = MetadataTable('processed')
+    
+    # Dictionary to track password-protected files
+    protected_files = MetadataTable('protected')
+else:
+    # Dictionary to track processed files
+    processed_files = MemoryTable(journal=processed_files_journal)
+    
+    # Dictionary to track password-protected files
+    protected_files = MemoryTable()
 
 # Load processed files data from file if it exists
 def load_processed_files():
-    global processed_files
-    if os.path.exists(PROCESSED_FILES_DB):
-        try:
-            with open(PROCESSED_FILES_DB, 'r') as f:
-                processed_files = json.load(f)
-        except Exception as e:
-            app.logger.error(f"Error loading processed files data: {str(e)}")
-            processed_files = {}
+    if not os.path.exists(PROCESSED_FILES_DB) and not os.path.exists(PROCESSED_FILES_JOURNAL):
+        return
+    
+    try:
+        saved = processed_files_journal.replay()
+    except Exception as e:
+        app.logger.error("Error loading processed files data: %s", e)
+        saved = {}
+    
+    if METADATA_BACKEND == 'sqlite':
+        # One-time import of the JSON files written by older versions
+        for filename, display_name in saved.items():
+            if filename not in processed_files:
+                processed_files[filename] = display_name
+        for path in [PROCESSED_FILES_DB, PROCESSED_FILES_JOURNAL]:
+            try:
+                os.replace(path, path + '.migrated')
+            except OSError:
+                pass
+        app.logger.info("Imported %s processed files into %s", len(saved), METADATA_DB)
+    else:
+        processed_files.load(saved)
 
 # Save processed files data to file
 def save_processed_files():
-    try:
-        # First write to a temporary file
-        temp_file = os.path.join(app.config['DATA_FOLDER'], f'temp_{uuid.uuid4()}.json')
-        
-        with open(temp_file, 'w') as f:
-            json.dump(processed_files, f)
-            
-        # Make sure the file was written successfully
-        if os.path.exists(temp_file) and os.path.getsize(temp_file) > 0:
-            # Then rename it to the actual file (atomic operation)
-            shutil.move(temp_file, PROCESSED_FILES_DB)
-        else:
-            raise Exception("Failed to write data to temporary file")
-            
-    except Exception as e:
-        # If anything fails, try a direct write as fallback
-        try:
-            app.logger.error(f"Error in primary save method: {str(e)}, trying direct write")
-            with open(PROCESSED_FILES_DB, 'w') as f:
-                json.dump(processed_files, f)
-        except Exception as e2:
-            app.logger.error(f"Error saving processed files data: {str(e2)}")
-            raise
+    # Changes are persisted as they are made: committed to the database, or
+    # appended to the journal and fsynced in the background in batches of
+    # JOURNAL_SYNC_INTERVAL, so this costs nothing per call
+    pass
 
 # Load processed files on startup
-load_processed_files()
+if not CLI_MODE:
+    load_processed_files()
 
 # Define allowed file types
 ALLOWED_EXTENSIONS = {'pdf'}
@@ -124,6 +735,7 @@ def allowed_file(filename):
     """Check if the uploaded file has an allowed extension."""
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+@STAGE_SECONDS.labels('clean_filename').time()
 def clean_filename(filename, file_id=None):
     """
     Clean up the filename by removing security indicators and ensuring proper format.
@@ -135,11 +747,11 @@ def clean_filename(filename, file_id=None):
     Returns:
         str: Cleaned filename without security indicators
     """
-    app.logger.info(f"Cleaning filename: {filename}")
+    app.logger.debug("Cleaning filename: %s", filename, extra={'event': 'clean_filename'})
     
     # Ensure we're working with a string
     if not filename or not isinstance(filename, str):
-        app.logger.info("Invalid filename, using default")
+        app.logger.debug("Invalid filename, using default", extra={'event': 'clean_filename'})
         if file_id:
             # Use file_id to create a unique filename
             timestamp = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
@@ -180,578 +792,2752 @@ def clean_filename(filename, file_id=None):
         if original_without_ext and original_without_ext.lower() != "document":
             # Use the original name but clean it
             cleaned_name = f"{original_without_ext}_{timestamp}.pdf"
-            app.logger.info(f"Using original name with timestamp: {cleaned_name}")
+            app.logger.debug("Using original name with timestamp: %s", cleaned_name, extra={'event': 'clean_filename'})
         else:
             # No usable original name, use timestamp with file_id if available
             if file_id:
                 cleaned_name = f"document_{file_id[:8]}_{timestamp}.pdf"
             else:
                 cleaned_name = f"document_{timestamp}.pdf"
-            app.logger.info(f"Generated unique filename: {cleaned_name}")
+            app.logger.debug("Generated unique filename: %s", cleaned_name, extra={'event': 'clean_filename'})
     
-    app.logger.info(f"Filename after cleaning: {cleaned_name}")
+    app.logger.debug("Filename after cleaning: %s", cleaned_name, extra={'event': 'clean_filename'})
     return cleaned_name
 
-# Helper function to try password variations
-def try_password_variations(pdf_path, password):
-    """Try multiple variations of a password on a PDF file."""
-    app.logger.info(f"Trying password variations for: {password}")
-    variations = [
-        password,  # original
-        password.strip(),  # without leading/trailing spaces
-        f" {password}",  # leading space
-        f"{password} ",  # trailing space
-        f" {password} ",  # both spaces
-    ]
+# Parsed PDF readers shared by /check-password and the unlock paths.
+# /check-password parses every upload to probe its encryption; keeping that
+# reader around means the unlock that follows doesn't have to parse it again.
+# Readers are not thread-safe, so a reader is taken out of the cache while it
+# is used and only put back if the file still has to be unlocked.
+# A cached reader keeps the memory reservation it was parsed under, so the
+# memory it holds and the unlock that follows stay in MEMORY_BUDGET_BYTES;
+# the reservation is released when the reader is evicted, or by whoever
+# takes the reader once the unlock is done.
+READER_CACHE_MAX_ENTRIES = int(os.environ.get('READER_CACHE_MAX_ENTRIES', 32))
+READER_CACHE_MAX_BYTES = int(os.environ.get('READER_CACHE_MAX_BYTES', 128 * 1024 * 1024))
+
+# Seconds a reader is kept. The unlock usually follows within seconds, but it
+# may go to another worker, and the upload may be removed by another worker's
+# cleanup; such readers would otherwise stay until newer ones push them out.
+# Keep it below RESERVATION_MAX_AGE, after which reservations are taken for
+# those of a dead worker
+READER_CACHE_MAX_AGE = int(os.environ.get('READER_CACHE_MAX_AGE', 300))
+
+# file_id -> (reader, file size, time cached, memory reservation ID),
+# least recently used first
+reader_cache = OrderedDict()
+reader_cache_bytes = 0
+reader_cache_lock = threading.Lock()
+
+def _expire_cached_readers(now):
+    """
+    Drop readers older than READER_CACHE_MAX_AGE or whose upload is gone.
     
-    # If numeric, add numeric versions
-    if password.isdigit():
-        try:
-            variations.append(int(password))  # as integer
-        except:
-            pass
-            
-    # Add bytes versions
-    for var in list(variations):  # Create a copy of the list to avoid modifying during iteration
-        if isinstance(var, str):
-            try:
-                variations.append(var.encode('utf-8'))  # as bytes
-            except:
-                pass
+    Needs reader_cache_lock; returns the reservation IDs of the dropped
+    readers, to be released once the lock is given up.
+    """
+    global reader_cache_bytes
     
-    # Try each variation
-    for var in variations:
-        try:
-            app.logger.info(f"Trying variation: {var} (type: {type(var).__name__})")
-            reader = PdfReader(pdf_path)
-            if reader.is_encrypted:
-                result = reader.decrypt(var)
-                app.logger.info(f"Decrypt result: {result}")
-                if result > 0 or not reader.is_encrypted:
-                    app.logger.info(f"Success with variation: {var}")
-                    return reader
-        except Exception as e:
-            app.logger.warning(f"Failed with variation {var}: {str(e)}")
-            
-    return None
+    expired = []
+    for file_id, (_, size, cached_at, reservation_id) in list(reader_cache.items()):
+        if (cached_at < now - READER_CACHE_MAX_AGE
+                or not os.path.exists(os.path.join(app.config['UPLOAD_FOLDER'], file_id))):
+            del reader_cache[file_id]
+            reader_cache_bytes -= size
+            expired.append(reservation_id)
+            app.logger.debug("Expired cached reader for file_id %s", file_id)
+    return expired
 
-def unlock_pdf(input_path, output_path, password, file_id=None):
+def cache_reader(file_id, reader, size, reservation_id=None):
     """
-    Unlock a PDF file and save the unlocked version to the specified output path.
+    Keep a parsed reader for file_id, evicting the least recently used readers
+    once the cache holds more than READER_CACHE_MAX_ENTRIES readers or
+    READER_CACHE_MAX_BYTES bytes of PDF files.
     
-    Args:
-        input_path (str): Path to the input PDF file
-        output_path (str): Path where the unlocked PDF should be saved
-        password (str): Password to unlock the PDF
-        file_id (str, optional): The ID of the file being processed
+    The cache takes over reservation_id, the memory reservation the reader
+    was parsed under, and releases it right away if the reader isn't kept.
+    """
+    global reader_cache_bytes
+    
+    if READER_CACHE_MAX_ENTRIES <= 0 or size > READER_CACHE_MAX_BYTES:
+        release_memory(reservation_id)
+        return
+    
+    now = time.time()
+    with reader_cache_lock:
+        released = []
+        if file_id in reader_cache:
+            _, old_size, _, old_reservation_id = reader_cache.pop(file_id)
+            reader_cache_bytes -= old_size
+            released.append(old_reservation_id)
+        released.extend(_expire_cached_readers(now))
         
+        reader_cache[file_id] = (reader, size, now, reservation_id)
+        reader_cache_bytes += size
+        
+        while len(reader_cache) > READER_CACHE_MAX_ENTRIES or reader_cache_bytes > READER_CACHE_MAX_BYTES:
+            evicted_id, (_, evicted_size, _, evicted_reservation_id) = reader_cache.popitem(last=False)
+            reader_cache_bytes -= evicted_size
+            released.append(evicted_reservation_id)
+            app.logger.debug("Evicted cached reader for file_id %s", evicted_id)
+    
+    for released_id in released:
+        release_memory(released_id)
+
+def take_cached_reader(file_id):
+    """
+    Remove and return the cached reader for file_id.
+    
     Returns:
-        dict: A dictionary with status and other information
+        tuple: (reader, file size, reservation ID), or (None, 0, None) if no
+               reader is cached; the caller releases the reservation, or
+               hands it back to cache_reader() with the reader
+    """
+    global reader_cache_bytes
+    
+    with reader_cache_lock:
+        # Also drops this file's reader if its upload has been removed
+        released = _expire_cached_readers(time.time())
+        entry = reader_cache.pop(file_id, None)
+        if entry is not None:
+            reader_cache_bytes -= entry[1]
+    
+    for released_id in released:
+        release_memory(released_id)
+    if entry is None:
+        return None, 0, None
+    return entry[0], entry[1], entry[3]
+
+def evict_cached_reader(file_id):
+    """Forget the cached reader for file_id, if any."""
+    release_memory(take_cached_reader(file_id)[2])
+
+def shed_cached_reader():
+    """
+    Forget the least recently used cached reader to give its memory back.
+    
+    Returns:
+        bool: Whether there was a reader to forget
+    """
+    global reader_cache_bytes
+    
+    with reader_cache_lock:
+        if not reader_cache:
+            return False
+        file_id, (_, size, _, reservation_id) = reader_cache.popitem(last=False)
+        reader_cache_bytes -= size
+    
+    app.logger.debug("Shed cached reader for file_id %s", file_id)
+    release_memory(reservation_id)
+    return True
+
+def clear_reader_cache():
+    """Forget all cached readers."""
+    global reader_cache_bytes
+    
+    with reader_cache_lock:
+        released = [entry[3] for entry in reader_cache.values()]
+        reader_cache.clear()
+        reader_cache_bytes = 0
+    
+    for released_id in released:
+        release_memory(released_id)
+
+# Content-addressed cache of unlocked outputs.
+# Uploads are hashed (SHA-256) while they are saved. An unlocked output is
+# stored once under a key made of the content hash and a salted hash of the
+# password, so uploading the same PDF again (a retry, a re-drop after the tab
+# was closed, a shared handout) is answered without any PDF work.
+# Processed files are hard links to the cached file: the link count is the
+# reference count, which works across gunicorn workers and drops by itself
+# when a processed file is deleted.
+RESULT_CACHE_FOLDER = os.path.join(PROCESSED_FOLDER, 'cache')
+RESULT_CACHE_MAX_BYTES = int(os.environ.get('RESULT_CACHE_MAX_BYTES', 256 * 1024 * 1024))
+RESULT_CACHE_SALT_FILE = os.path.join(DATA_FOLDER, 'result_cache_salt')
+make_server_folder(RESULT_CACHE_FOLDER)
+# Eviction has to stat every entry, so a store only triggers it when the
+# cache may have outgrown its budget: when this process's estimate says so,
+# or when other workers had this long to add entries since the last scan
+RESULT_CACHE_SCAN_INTERVAL = 30
+result_cache_estimate = {'bytes': 0, 'scanned_at': 0.0}
+
+# Size of the chunks uploads are read, saved and hashed in
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+# The PDF header must appear within the first bytes of the file and the
+# startxref/%%EOF trailer within the last bytes of it
+PDF_HEADER_WINDOW = 1024
+PDF_TRAILER_WINDOW = 2048
+
+class UploadFacts:
+    """
+    What this process learned about uploads while saving them, by file_id.
+    
+    An entry is only popped by the worker that unlocks or removes the upload,
+    which often isn't the one that saved it, so entries are also forgotten
+    after max_age seconds and, oldest first, beyond max_entries. A forgotten
+    fact is worked out again from the file when it is needed.
+    """
+    
+    def __init__(self, max_entries, max_age):
+        self.max_entries = max_entries
+        self.max_age = max_age
+        # file_id -> (value, time stored), oldest first
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def _expire(self, now):
+        while self._entries:
+            file_id, (_, stored_at) = next(iter(self._entries.items()))
+            if len(self._entries) <= self.max_entries and stored_at >= now - self.max_age:
+                break
+            del self._entries[file_id]
+    
+    def __setitem__(self, file_id, value):
+        now = time.time()
+        with self._lock:
+            self._entries.pop(file_id, None)
+            self._entries[file_id] = (value, now)
+            self._expire(now)
+    
+    def get(self, file_id, default=None):
+        with self._lock:
+            self._expire(time.time())
+            entry = self._entries.get(file_id)
+        return default if entry is None else entry[0]
+    
+    def pop(self, file_id, default=None):
+        with self._lock:
+            entry = self._entries.pop(file_id, None)
+        return default if entry is None else entry[0]
+    
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+    
+    def __len__(self):
+        return len(self._entries)
+
+# Uploads whose facts each process keeps; a trailer is the largest at
+# PDF_TRAILER_WINDOW bytes. Uploads expire after FILE_TTL, and so do their facts
+UPLOAD_FACTS_MAX_ENTRIES = int(os.environ.get('UPLOAD_FACTS_MAX_ENTRIES', 4096))
+
+# SHA-256 of the uploads saved by this process
+upload_hashes = UploadFacts(UPLOAD_FACTS_MAX_ENTRIES, FILE_TTL)
+
+# Last PDF_TRAILER_WINDOW bytes of the uploads saved by this process
+upload_trailers = UploadFacts(UPLOAD_FACTS_MAX_ENTRIES, FILE_TTL)
+
+# Page objects counted in the uploads saved by this process
+upload_pages = UploadFacts(UPLOAD_FACTS_MAX_ENTRIES, FILE_TTL)
+
+# A page object's /Type entry; pages inside compressed object streams are not
+# visible to it, which only makes such files look smaller than they are
+PAGE_MARKER_RE = re.compile(rb'/Type\s{0,8}/Page(?![A-Za-z])')
+
+# Bytes kept between chunks so a page marker split across them is still found
+PAGE_MARKER_OVERLAP = 32
+
+def _count_page_markers(scan, data, final=False):
+    """
+    Count page markers in the next chunk of a file.
+    
+    scan holds the running count and the unscanned tail of the previous
+    chunk; markers starting in the last PAGE_MARKER_OVERLAP bytes are left
+    for the next call, so none is counted twice or cut in half.
     """
+    buf = scan['carry'] + data
+    boundary = len(buf) if final else max(len(buf) - PAGE_MARKER_OVERLAP, 0)
+    for match in PAGE_MARKER_RE.finditer(buf):
+        if match.start() >= boundary:
+            break
+        scan['pages'] += 1
+    scan['carry'] = buf[boundary:]
+
+def prescan_pdf(input_path):
+    """Return (size, page count) of a PDF without parsing it."""
+    scan = {'pages': 0, 'carry': b''}
+    with open(input_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(UPLOAD_CHUNK_SIZE), b''):
+            _count_page_markers(scan, chunk)
+    _count_page_markers(scan, b'', final=True)
+    return os.path.getsize(input_path), scan['pages']
+
+def upload_lane(file_id, input_path):
+    """Return the lane for an upload, pre-scanning it if another worker saved it."""
+    pages = upload_pages.get(file_id)
+    if pages is None:
+        _, pages = prescan_pdf(input_path)
+        upload_pages[file_id] = pages
+    return choose_lane(os.path.getsize(input_path), pages)
+
+def _load_result_cache_salt():
+    """Return the salt for password hashes, creating it on first start."""
     try:
-        app.logger.info(f"Attempting to unlock PDF: {input_path}")
-        
-        # Try to determine if this is numeric password
-        numeric_mode = password.isdigit()
-        is_password_int = False
-        if numeric_mode:
-            try:
-                int(password)
-                is_password_int = True
-                app.logger.info(f"Numeric password detected: {password}")
-            except:
-                pass
-        
-        # If we're on Render and this is a numeric password, use specialized handling
-        if IS_RENDER and numeric_mode:
-            app.logger.info("Using specialized Render numeric password handling")
-            reader = try_password_variations(input_path, password)
-            
-            if reader and not reader.is_encrypted:
-                app.logger.info("Successfully opened PDF with variation helper!")
-                writer = PdfWriter()
-                for page in reader.pages:
-                    writer.add_page(page)
-                    
-                with open(output_path, 'wb') as out_file:
-                    writer.write(out_file)
-                    
-                # Check if successful
-                if os.path.exists(output_path) and os.path.getsize(output_path) > 0:
-                    try:
-                        verify = PdfReader(output_path)
-                        if not verify.is_encrypted:
-                            app.logger.info("Successfully verified unlocked PDF!")
-                            
-                            # Get original filename
-                            original_filename = "document.pdf"
-                            if file_id and file_id in protected_files:
-                                original_filename = protected_files.get(file_id, "document.pdf")
-                                app.logger.info(f"Retrieved original filename for file_id {file_id}: {original_filename}")
-                                
-                            # Process filenames
-                            cleaned_filename = clean_filename(original_filename, file_id)
-                            app.logger.info(f"After cleaning filename: {cleaned_filename}")
-                            
-                            # Make sure we're not getting an empty or default name
-                            if cleaned_filename in ["document.pdf", "", ".pdf"] or cleaned_filename.lower() == "document.pdf":
-                                if original_filename and original_filename.lower() != "document.pdf":
-                                    # Use the original name but without extension
-                                    base_name = os.path.splitext(original_filename)[0]
-                                    timestamp = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
-                                    cleaned_filename = f"{base_name}_{timestamp}.pdf"
-                                    app.logger.info(f"Using modified original filename: {cleaned_filename}")
-                                else:
-                                    # Generate a completely new name
-                                    timestamp = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
-                                    cleaned_filename = f"file_{timestamp}.pdf"
-                                    app.logger.info(f"Generated unique filename: {cleaned_filename}")
-                            
-                            # Create the display filename with the 'unlocked_' prefix
-                            prefixed_filename = f"unlocked_{cleaned_filename}"
-                            display_filename = secure_filename(prefixed_filename)
-                            app.logger.info(f"Final display filename: {display_filename}")
-                            
-                            # Store in processed files
-                            output_filename = os.path.basename(output_path)
-                            processed_files[output_filename] = display_filename
-                            save_processed_files()
-                            
-                            # Cleanup if file_id is provided
-                            if file_id:
-                                if file_id in protected_files:
-                                    del protected_files[file_id]
-                                    
-                                # Remove the input file 
-                                if os.path.exists(input_path):
-                                    os.remove(input_path)
-                            
-                            return {
-                                'status': 'success',
-                                'filename': display_filename,
-                                'download_url': f'/download/{output_filename}'
-                            }
-                    except Exception as verify_error:
-                        app.logger.error(f"Verification error: {str(verify_error)}")
+        with open(RESULT_CACHE_SALT_FILE, 'rb') as f:
+            salt = f.read()
+        if salt:
+            return salt
+    except FileNotFoundError:
+        pass
+    
+    salt = os.urandom(32)
+    try:
+        # O_EXCL so concurrently starting workers agree on a single salt
+        fd = os.open(RESULT_CACHE_SALT_FILE, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(salt)
+        return salt
+    except FileExistsError:
+        with open(RESULT_CACHE_SALT_FILE, 'rb') as f:
+            return f.read()
+
+# The CLI does not use the result cache
+RESULT_CACHE_SALT = os.urandom(32) if CLI_MODE else _load_result_cache_salt()
+
+def _start_upload(filename):
+    """Open the upload file for an incoming PDF part."""
+    file_id = str(uuid.uuid4())
+    input_path = os.path.join(app.config['UPLOAD_FOLDER'], file_id)
+    return {
+        'file_id': file_id,
+        'filename': filename,
+        'path': input_path,
+        'handle': open(input_path, 'wb'),
+        'digest': hashlib.sha256(),
+        'head': b'',
+        'tail': b'',
+        'scan': {'pages': 0, 'carry': b''},
+        'size': 0,
+        'error': None
+    }
+
+def _reject_upload(upload, message):
+    """Stop saving an upload and remove what was written of it."""
+    if upload['handle'] is not None:
+        upload['handle'].close()
+        upload['handle'] = None
+    if upload.get('path') and os.path.exists(upload['path']):
+        os.remove(upload['path'])
+    upload['file_id'] = None
+    upload['error'] = message
+    app.logger.warning("Rejected upload %s: %s", upload['filename'], message)
+
+def _feed_upload(upload, data):
+    """Write, hash and sniff the next chunk of an upload."""
+    if upload['error'] or not data:
+        return
+    
+    if len(upload['head']) < PDF_HEADER_WINDOW:
+        upload['head'] += data[:PDF_HEADER_WINDOW - len(upload['head'])]
+        if len(upload['head']) >= PDF_HEADER_WINDOW and b'%PDF-' not in upload['head']:
+            _reject_upload(upload, 'Not a PDF file')
+            return
+    
+    upload['handle'].write(data)
+    upload['digest'].update(data)
+    _count_page_markers(upload['scan'], data)
+    upload['size'] += len(data)
+    upload['tail'] = (upload['tail'] + data)[-PDF_TRAILER_WINDOW:]
+
+def _finish_upload(upload):
+    """Close an upload and check that it is a complete PDF."""
+    if upload['error']:
+        return
+    
+    if b'%PDF-' not in upload['head']:
+        _reject_upload(upload, 'Not a PDF file')
+        return
+    
+    if b'%%EOF' not in upload['tail'] or b'startxref' not in upload['tail']:
+        _reject_upload(upload, 'The PDF file is truncated or damaged')
+        return
+    
+    upload['handle'].close()
+    upload['handle'] = None
+    upload['sha256'] = upload['digest'].hexdigest()
+    _count_page_markers(upload['scan'], b'', final=True)
+    upload['pages'] = upload['scan']['pages']
+    upload['lane'] = choose_lane(upload['size'], upload['pages'])
+    upload_hashes[upload['file_id']] = upload['sha256']
+    upload_trailers[upload['file_id']] = upload['tail']
+    upload_pages[upload['file_id']] = upload['pages']
+
+@STAGE_SECONDS.labels('upload_save').time()
+def ingest_uploads(field_name='files[]', max_files=None):
+    """
+    Stream the multipart request body to the uploads folder.
+    
+    The body is read in UPLOAD_CHUNK_SIZE chunks. Each PDF part is written to
+    disk and hashed as it arrives; a part without a PDF header is dropped after
+    its first PDF_HEADER_WINDOW bytes, and one without a startxref/%%EOF trailer
+    is removed as soon as it ends. Reading stops once max_files parts have been
+    handled, so a rejected single upload is never read to the end.
+    
+    Args:
+        field_name (str): Form field holding the uploaded files
+        max_files (int, optional): Stop after this many file parts
         
-        # Try PyPDF2 standard method
-        try:
-            app.logger.info("Trying standard PyPDF2 approach")
-            reader = PdfReader(input_path)
+    Returns:
+        tuple: (list of upload dicts with file_id, filename, size, sha256 and
+                error, dict of form field values as lists) or (None, None)
+               if the request is not multipart
+    """
+    boundary = request.mimetype_params.get('boundary')
+    if request.mimetype != 'multipart/form-data' or not boundary:
+        return None, None
+    
+    decoder = MultipartDecoder(boundary.encode('latin-1'), app.config.get('MAX_FORM_MEMORY_SIZE'))
+    stream = request.stream
+    uploads = []
+    form = {}
+    current = None
+    field_name_current = None
+    field_data = []
+    
+    try:
+        while True:
+            event = decoder.next_event()
             
-            # Check if the PDF is password-protected
-            if reader.is_encrypted:
-                # Try to decrypt the PDF
-                decrypt_result = reader.decrypt(password)
-                app.logger.info(f"Decrypt result: {decrypt_result}")
-                
-                if decrypt_result <= 0:  # 0 = wrong password, -1 = no password needed
-                    app.logger.info("Failed to decrypt PDF with provided password")
-                    return {
+            if isinstance(event, NeedData):
+                decoder.receive_data(stream.read(UPLOAD_CHUNK_SIZE) or None)
+            elif isinstance(event, File):
+                if event.name == field_name and event.filename and allowed_file(event.filename):
+                    current = _start_upload(event.filename)
+                else:
+                    current = {
+                        'file_id': None,
+                        'filename': event.filename or 'Unknown file',
+                        'handle': None,
+                        'size': 0,
+                        'error': 'Invalid file type. Only PDF files are accepted.'
+                    }
+                uploads.append(current)
+            elif isinstance(event, Field):
+                field_name_current = event.name
+                field_data = []
+            elif isinstance(event, Data):
+                if current is not None:
+                    _feed_upload(current, event.data)
+                    if current['error'] and max_files is not None and len(uploads) >= max_files:
+                        # Rejected, and no later part is wanted: leave the rest unread
+                        current = None
+                        break
+                    if not event.more_data:
+                        _finish_upload(current)
+                        current = None
+                        if max_files is not None and len(uploads) >= max_files:
+                            break
+                elif field_name_current is not None:
+                    field_data.append(event.data)
+                    if not event.more_data:
+                        form.setdefault(field_name_current, []).append(
+                            b''.join(field_data).decode('utf-8', 'replace'))
+                        field_name_current = None
+            elif isinstance(event, Epilogue):
+                break
+    except ValueError as e:
+        # The body ended before the closing boundary
+        app.logger.warning("Malformed multipart upload: %s", e)
+    finally:
+        # A client that disconnects mid-upload leaves a partial file behind
+        if current is not None and current.get('handle') is not None:
+            _reject_upload(current, 'The upload was interrupted')
+    
+    BYTES_IN.inc(sum(upload['size'] for upload in uploads))
+    for upload in uploads:
+        upload.pop('handle', None)
+        upload.pop('digest', None)
+        upload.pop('head', None)
+        upload.pop('scan', None)
+    
+    return uploads, form
+
+def upload_hash(file_id, input_path):
+    """Return the SHA-256 of an upload, hashing the file if another worker saved it."""
+    content_hash = upload_hashes.get(file_id)
+    if content_hash is None:
+        digest = hashlib.sha256()
+        with open(input_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(UPLOAD_CHUNK_SIZE), b''):
+                digest.update(chunk)
+        content_hash = digest.hexdigest()
+        upload_hashes[file_id] = content_hash
+    return content_hash
+
+def result_cache_key(file_id, input_path, password):
+    """
+    Return the result cache key for unlocking an upload with a password.
+    
+    Returns None if the cache is disabled or the upload can't be hashed.
+    """
+    if RESULT_CACHE_MAX_BYTES <= 0:
+        return None
+    try:
+        content_hash = upload_hash(file_id, input_path)
+    except OSError as e:
+        app.logger.warning("Could not hash upload %s: %s", file_id, e)
+        return None
+    
+    password_hash = hmac.new(RESULT_CACHE_SALT, _password_bytes(password or ''), hashlib.sha256).hexdigest()
+    return hashlib.sha256(f"{content_hash}:{password_hash}".encode('ascii')).hexdigest()
+
+def _result_cache_path(cache_key):
+    return os.path.join(RESULT_CACHE_FOLDER, f"{cache_key}.pdf")
+
+def _link_or_copy(source, destination):
+    """Hard link source to destination, copying if the filesystem can't link."""
+    try:
+        os.link(source, destination)
+    except FileExistsError:
+        os.remove(destination)
+        os.link(source, destination)
+    except OSError:
+        shutil.copyfile(source, destination)
+
+def result_cache_checkout(cache_key, output_path):
+    """
+    Provide a cached unlocked output at output_path.
+    
+    Returns:
+        bool: True on a cache hit, False if the result is not cached
+    """
+    if cache_key is None:
+        return False
+    
+    cache_path = _result_cache_path(cache_key)
+    try:
+        _link_or_copy(cache_path, output_path)
+        # Bump the entry for LRU eviction. Only the access time: the entry
+        # shares its inode with the processed files linked to it, whose
+        # modification time is their Last-Modified and part of their ETag
+        os.utime(cache_path, ns=(time.time_ns(), os.stat(cache_path).st_mtime_ns))
+    except FileNotFoundError:
+        return False
+    except OSError as e:
+        app.logger.warning("Result cache checkout failed for %s: %s", cache_key, e)
+        return False
+    
+    app.logger.info("Result cache hit for %s", cache_key, extra={'event': 'result_cache_hit'})
+    return True
+
+def result_cache_store(cache_key, output_path):
+    """Add a freshly unlocked output to the result cache."""
+    if cache_key is None:
+        return
+    
+    cache_path = _result_cache_path(cache_key)
+    if os.path.exists(cache_path):
+        return
+    try:
+        # Link under a temporary name first so a half-copied file is never visible
+        temp_path = os.path.join(RESULT_CACHE_FOLDER, f"temp_{uuid.uuid4()}")
+        _link_or_copy(output_path, temp_path)
+        os.replace(temp_path, cache_path)
+    except OSError as e:
+        app.logger.warning("Could not add %s to the result cache: %s", output_path, e)
+        return
+    
+    try:
+        result_cache_estimate['bytes'] += os.path.getsize(cache_path)
+    except OSError:
+        pass
+    if (result_cache_estimate['bytes'] > RESULT_CACHE_MAX_BYTES
+            or time.time() - result_cache_estimate['scanned_at'] > RESULT_CACHE_SCAN_INTERVAL):
+        evict_result_cache()
+
+def evict_result_cache(max_age=None):
+    """
+    Evict least recently used cache entries until the cache fits in
+    RESULT_CACHE_MAX_BYTES, and entries unused for more than max_age seconds.
+    Recency is the access time result_cache_checkout() sets.
+    
+    Entries still referenced by a processed file (link count above 1) don't
+    free any space when removed, so they are kept and not counted.
+    
+    Returns:
+        int: Number of entries evicted
+    """
+    entries = []
+    total = 0
+    try:
+        with os.scandir(RESULT_CACHE_FOLDER) as it:
+            for entry in it:
+                if not entry.is_file() or entry.name.startswith('temp_'):
+                    continue
+                st = entry.stat()
+                if st.st_nlink > 1:
+                    continue
+                entries.append((max(st.st_atime, st.st_mtime), st.st_size, entry.path))
+                total += st.st_size
+    except OSError as e:
+        app.logger.error("Error scanning result cache: %s", e)
+        return 0
+    
+    evicted = 0
+    now = time.time()
+    for used_at, size, path in sorted(entries):
+        expired = max_age is not None and now - used_at > max_age
+        if not expired and total <= RESULT_CACHE_MAX_BYTES:
+            break
+        try:
+            os.remove(path)
+            total -= size
+            evicted += 1
+        except OSError as e:
+            app.logger.error("Error evicting %s from result cache: %s", path, e)
+    
+    result_cache_estimate['bytes'] = total
+    result_cache_estimate['scanned_at'] = now
+    if evicted:
+        app.logger.info("Evicted %s entries from the result cache", evicted)
+    return evicted
+
+# Helper functions to try password variations
+def _password_bytes(password):
+    """Return the bytes the security handler checks for a password (as PyPDF2 encodes it)."""
+    if isinstance(password, bytes):
+        return password
+    try:
+        return password.encode('latin-1')
+    except UnicodeEncodeError:
+        return password.encode('utf-8')
+
+def _password_candidates(password):
+    """
+    Build the list of variations of a password to try.
+    
+    Variations that end up as the same bytes for the security handler (e.g.
+    an ASCII password and its UTF-8 encoding) are only tried once.
+    """
+    variations = [
+        password,  # original
+        password.strip(),  # without leading/trailing spaces
+        f" {password}",  # leading space
+        f"{password} ",  # trailing space
+        f" {password} ",  # both spaces
+    ]
+    
+    # If numeric, add the number as an integer would print it (no leading zeros)
+    if password.isdigit():
+        variations.append(str(int(password)))
+            
+    # Add bytes versions
+    variations += [var.encode('utf-8') for var in variations]
+    
+    candidates = []
+    seen = set()
+    for var in variations:
+        key = _password_bytes(var)
+        if key not in seen:
+            seen.add(key)
+            candidates.append(var)
+    return candidates
+
+def try_password_variations(pdf_path, password, reader=None):
+    """
+    Try multiple variations of a password on a PDF file.
+    
+    The file is opened once: PdfReader reads the /Encrypt dictionary (/O, /U,
+    /P, /ID and revision) when it is created, and decrypt() only runs the
+    standard security handler's key derivation for a candidate. So each
+    variation costs a key check, not a new parse of the whole file.
+    
+    Args:
+        pdf_path (str): Path to the PDF file
+        password (str): The password entered by the user
+        reader (PdfReader, optional): Already parsed reader of pdf_path
+        
+    Returns:
+        PdfReader: The reader, decrypted with the first matching variation,
+            or None if no variation matches
+    """
+    from PyPDF2 import PdfReader
+    app.logger.debug("Trying password variations", extra={'event': 'password_variation'})
+    
+    try:
+        if reader is None:
+            reader = PdfReader(pdf_path)
+        if not reader.is_encrypted:
+            return reader
+    except Exception as e:
+        app.logger.warning("Failed to open PDF for password variations: %s", e)
+        return None
+    
+    # Try each variation against the security handler
+    with STAGE_SECONDS.labels('decrypt').time():
+        for attempt, var in enumerate(_password_candidates(password), 1):
+            PASSWORD_ATTEMPTS.inc()
+            try:
+                result = reader.decrypt(var)
+                if result > 0:
+                    app.logger.debug("Success with variation %s (type: %s)", attempt, type(var).__name__,
+                                     extra={'event': 'password_variation'})
+                    return reader
+            except Exception as e:
+                app.logger.warning("Failed with variation %s: %s", attempt, e, extra={'event': 'password_variation'})
+            
+    return None
+
+# Progress of the unlocks in flight, one small JSON file per upload, so that
+# the /progress stream of any worker can follow a file unlocked in a pool
+# process of another
+PROGRESS_FOLDER = os.path.join(DATA_FOLDER, 'progress')
+make_server_folder(PROGRESS_FOLDER)
+
+# Seconds between two progress writes while a file is copied or written;
+# stage changes are written right away
+PROGRESS_INTERVAL = float(os.environ.get('PROGRESS_INTERVAL', 0.25))
+
+class ProgressReporter:
+    """
+    Record the stage of one file's unlock and how far it has got.
+    
+    update() runs for every object or page the engines copy, so it only reads
+    the clock until PROGRESS_INTERVAL has passed since the last write.
+    """
+    
+    def __init__(self, file_id):
+        self.path = os.path.join(PROGRESS_FOLDER, f"{file_id}.json")
+        self.state = {'file_id': file_id, 'stage': 'parsing', 'done': 0, 'total': 0, 'unit': None, 'bytes': 0}
+        self.next_write = 0.0
+    
+    def stage(self, stage, total=0, unit=None, **fields):
+        self.state.update(fields, stage=stage, done=0, total=total, unit=unit)
+        self._write(time.monotonic())
+    
+    def update(self, done, bytes_written=0):
+        now = time.monotonic()
+        if now < self.next_write:
+            return
+        self.state['done'] = done
+        self.state['bytes'] = bytes_written
+        self._write(now)
+    
+    def _write(self, now):
+        self.next_write = now + PROGRESS_INTERVAL
+        self.state['updated_at'] = time.time()
+        temp_file = f"{self.path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(temp_file, 'w') as f:
+                json.dump(self.state, f)
+            os.replace(temp_file, self.path)
+        except OSError as e:
+            app.logger.debug("Could not record progress: %s", e, extra={'event': 'progress'})
+
+def start_progress(input_path):
+    """Return a ProgressReporter for an uploaded file, or None for any other path."""
+    folder, file_id = os.path.split(input_path)
+    if folder != app.config['UPLOAD_FOLDER']:
+        return None
+    progress = ProgressReporter(file_id)
+    progress.stage('parsing')
+    return progress
+
+def read_progress(file_id):
+    """Return the last recorded progress of a file, or None."""
+    try:
+        with open(os.path.join(PROGRESS_FOLDER, f"{file_id}.json")) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+class _ProgressStream:
+    """File object wrapper reporting the bytes PdfWriter.write has written."""
+    
+    def __init__(self, stream, progress):
+        self.stream = stream
+        self.progress = progress
+        self.writes = 0
+    
+    def write(self, data):
+        # PdfWriter writes every token separately; looking at the clock on
+        # every 256th write keeps the wrapper cheap
+        self.writes += 1
+        if not self.writes & 0xFF:
+            self.progress.update(0, self.stream.tell())
+        return self.stream.write(data)
+    
+    def tell(self):
+        return self.stream.tell()
+
+# Engine used to write unlocked PDFs:
+# 'clone' writes every object of the original document back decrypted, keeping
+# the object graph (outlines, named destinations, forms...) intact;
+# 'pages' rebuilds the document page by page with PdfWriter.add_page
+UNLOCK_ENGINE = os.environ.get('UNLOCK_ENGINE', 'clone')
+
+# Stream types that only describe how the original file was stored. Their
+# content is written out as regular objects and a plain xref table instead.
+_STORAGE_STREAM_TYPES = ('/ObjStm', '/XRef')
+
+# Trailer entries that belong to the original xref section or its encryption
+_SKIPPED_TRAILER_KEYS = ('/Encrypt', '/Prev', '/XRefStm', '/Size', '/Type', '/W',
+                         '/Index', '/Filter', '/DecodeParms', '/Length')
+
+def _write_decrypted_clone(reader, stream, progress=None):
+    """
+    Write a whole-document clone of a decrypted reader without encryption.
+    
+    Every indirect object is read (and decrypted) once and written back under
+    its original object number, so all references stay valid and nothing but
+    the /Encrypt entry is lost. Objects are dropped from the reader's cache as
+    soon as they are written to keep memory flat on large documents.
+    
+    Args:
+        reader (PdfReader): Reader that is not encrypted or already decrypted
+        stream: Binary file object to write the PDF to
+        progress (ProgressReporter, optional): Told about every object written
+        
+    Returns:
+        dict: Write summary for verify_unlocked_output
+    """
+    from PyPDF2.generic import DictionaryObject, IndirectObject, NameObject, NumberObject, StreamObject
+    trailer = reader.trailer
+    
+    encrypt_ref = trailer.raw_get('/Encrypt') if '/Encrypt' in trailer else None
+    skipped = set()
+    if isinstance(encrypt_ref, IndirectObject):
+        skipped.add(encrypt_ref.idnum)
+    
+    root_ref = trailer.raw_get('/Root') if '/Root' in trailer else None
+    root_idnum = root_ref.idnum if isinstance(root_ref, IndirectObject) else None
+    has_pages = False
+    
+    # Every object number the document defines, with its generation
+    object_ids = {}
+    for generation, entries in reader.xref.items():
+        for idnum in entries:
+            if reader.xref_free_entry.get(generation, {}).get(idnum, False):
+                continue
+            object_ids[idnum] = generation
+    for idnum in reader.xref_objStm:
+        object_ids[idnum] = 0
+    
+    stream.write(reader.pdf_header.encode('latin-1') + b"\n%\xE2\xE3\xCF\xD3\n")
+    
+    # Reading (and decrypting) objects counts as copying, serializing them
+    # as writing
+    copy_seconds = 0.0
+    started = time.perf_counter()
+    
+    if progress is not None:
+        progress.stage('writing', total=len(object_ids), unit='objects')
+    
+    positions = {}
+    for done, idnum in enumerate(sorted(object_ids)):
+        if idnum == 0 or idnum in skipped:
+            continue
+        if progress is not None:
+            progress.update(done, stream.tell())
+        
+        generation = object_ids[idnum]
+        copy_started = time.perf_counter()
+        obj = reader.get_object(IndirectObject(idnum, generation, reader))
+        reader.resolved_objects.pop((generation, idnum), None)
+        copy_seconds += time.perf_counter() - copy_started
+        
+        if obj is None:
+            continue
+        if isinstance(obj, StreamObject) and obj.get('/Type') in _STORAGE_STREAM_TYPES:
+            continue
+        
+        if idnum == root_idnum:
+            has_pages = isinstance(obj, DictionaryObject) and '/Pages' in obj
+        
+        positions[idnum] = (stream.tell(), generation)
+        stream.write(f"{idnum} {generation} obj\n".encode('latin-1'))
+        obj.write_to_stream(stream, None)
+        stream.write(b"\nendobj\n")
+    
+    # Classic xref table covering every object number up to the highest one
+    size = max(positions) + 1 if positions else 1
+    xref_location = stream.tell()
+    stream.write(f"xref\n0 {size}\n".encode('latin-1'))
+    stream.write(b"0000000000 65535 f \n")
+    for idnum in range(1, size):
+        if idnum in positions:
+            offset, generation = positions[idnum]
+            stream.write(f"{offset:010} {generation:05} n \n".encode('latin-1'))
+        else:
+            stream.write(b"0000000000 65535 f \n")
+    
+    new_trailer = DictionaryObject()
+    for key, value in trailer.items():
+        if key not in _SKIPPED_TRAILER_KEYS:
+            new_trailer[NameObject(key)] = trailer.raw_get(key)
+    new_trailer[NameObject('/Size')] = NumberObject(size)
+    
+    stream.write(b"trailer\n")
+    new_trailer.write_to_stream(stream, None)
+    stream.write(f"\nstartxref\n{xref_location}\n%%EOF\n".encode('latin-1'))
+    
+    STAGE_SECONDS.labels('page_copy').observe(copy_seconds)
+    STAGE_SECONDS.labels('write').observe(time.perf_counter() - started - copy_seconds)
+    
+    return {
+        'engine': 'clone',
+        'bytes': stream.tell(),
+        'objects': len(positions),
+        'encrypted': '/Encrypt' in new_trailer,
+        'has_catalog': root_idnum in positions and has_pages,
+    }
+
+def _write_page_copy(reader, stream, progress=None):
+    """
+    Write a reader's pages to a new document with PdfWriter.add_page.
+    
+    Returns:
+        dict: Write summary for verify_unlocked_output
+    """
+    from PyPDF2 import PdfWriter
+    writer = PdfWriter()
+    with STAGE_SECONDS.labels('page_copy').time():
+        if progress is not None:
+            progress.stage('copying', total=len(reader.pages), unit='pages')
+        for done, page in enumerate(reader.pages):
+            if progress is not None:
+                progress.update(done)
+            writer.add_page(page)
+    with STAGE_SECONDS.labels('write').time():
+        if progress is not None:
+            progress.stage('writing')
+            writer.write(_ProgressStream(stream, progress))
+        else:
+            writer.write(stream)
+    
+    return {
+        'engine': 'pages',
+        'bytes': stream.tell(),
+        'objects': len(writer._objects),
+        'encrypted': getattr(writer, '_encrypt', None) is not None,
+        'has_catalog': '/Pages' in writer._root_object and len(writer.pages) == len(reader.pages),
+    }
+
+def write_unlocked_pdf(reader, output_path, progress=None):
+    """
+    Write the decrypted content of reader to output_path without encryption.
+    
+    Uses the engine selected by UNLOCK_ENGINE; if the clone engine can't handle
+    a (broken) document, the page-by-page rebuild is used instead.
+    
+    Returns:
+        dict: Write summary (engine, bytes, objects, encrypted, has_catalog)
+    """
+    if UNLOCK_ENGINE == 'clone':
+        try:
+            with open(output_path, 'wb') as f:
+                return _write_decrypted_clone(reader, f, progress)
+        except Exception as e:
+            app.logger.warning("Clone engine failed, falling back to page copy: %s", e)
+    
+    with open(output_path, 'wb') as f:
+        return _write_page_copy(reader, f, progress)
+
+# How unlocked output is verified:
+# 'fast' checks the summary of what was just written (no /Encrypt in the
+# trailer, a catalog with pages, bytes on disk) without reading the file back;
+# 'deep' additionally re-parses the written file, which is useful for debugging
+PDF_VERIFY_MODE = os.environ.get('PDF_VERIFY_MODE', 'fast')
+
+@STAGE_SECONDS.labels('verify').time()
+def verify_unlocked_output(summary, output_path, progress=None):
+    """
+    Check that write_unlocked_pdf produced a usable, unencrypted PDF.
+    
+    Args:
+        summary (dict): The summary returned by write_unlocked_pdf
+        output_path (str): Path the PDF was written to
+        progress (ProgressReporter, optional): Told that verifying has started
+        
+    Returns:
+        str: An error message, or None if the output is fine
+    """
+    if progress is not None:
+        progress.stage('verifying', bytes=summary['bytes'] if summary else 0)
+    
+    if not summary or summary['bytes'] == 0:
+        return 'Failed to create unlocked PDF file'
+    
+    if summary['encrypted']:
+        return 'Failed to unlock PDF. Output is still encrypted.'
+    
+    if summary['objects'] == 0 or not summary['has_catalog']:
+        return 'Error verifying output PDF: the document catalog or its pages are missing'
+    
+    if PDF_VERIFY_MODE == 'deep':
+        try:
+            if os.path.getsize(output_path) != summary['bytes']:
+                return 'Error verifying output PDF: the file on disk is incomplete'
+            
+            from PyPDF2 import PdfReader
+            verify_reader = PdfReader(output_path)
+            if verify_reader.is_encrypted:
+                return 'Failed to unlock PDF. Output is still encrypted.'
+            if len(verify_reader.pages) == 0:
+                return 'Error verifying output PDF: the document has no pages'
+        except Exception as verify_error:
+            return f'Error verifying output PDF: {str(verify_error)}'
+    
+    return None
+
+def _unlock_pdf_file(input_path, output_path, password, reader=None):
+    """
+    Decrypt a PDF file and write the unlocked version to the output path.
+    
+    This is the PDF-only part of unlock_pdf. It runs in the PDF worker processes,
+    so it must not touch processed_files/protected_files: the caller records the
+    result in the bookkeeping dictionaries of the web worker. The progress of
+    uploaded files is recorded for /progress as it goes.
+    
+    Args:
+        input_path (str): Path to the input PDF file
+        output_path (str): Path where the unlocked PDF should be saved
+        password (str): Password to unlock the PDF
+        reader (PdfReader, optional): Already parsed reader of input_path, e.g.
+            from the reader cache; the file is parsed again when omitted
+        
+    Returns:
+        dict: {'status': 'success'} or {'status': 'error', 'error': ..., 'needs_password': bool}
+    """
+    progress = start_progress(input_path)
+    result = _decrypt_and_write(input_path, output_path, password, reader, progress)
+    if progress is not None:
+        progress.stage('finished', status=unlock_result_status(result), error=result.get('error'))
+    return result
+
+def _decrypt_and_write(input_path, output_path, password, reader, progress):
+    """The steps of _unlock_pdf_file, reporting to progress (which may be None)."""
+    from PyPDF2 import PdfReader
+    try:
+        app.logger.debug("Attempting to unlock PDF: %s", input_path, extra={'event': 'unlock_step'})
+        
+        # Try to determine if this is numeric password
+        numeric_mode = password.isdigit()
+        if numeric_mode:
+            app.logger.debug("Numeric password detected", extra={'event': 'unlock_step'})
+        
+        # If we're on Render and this is a numeric password, use specialized handling
+        if IS_RENDER and numeric_mode:
+            app.logger.debug("Using specialized Render numeric password handling", extra={'event': 'unlock_step'})
+            variation_reader = try_password_variations(input_path, password, reader=reader)
+            
+            if variation_reader is not None:
+                app.logger.debug("Successfully opened PDF with variation helper!", extra={'event': 'unlock_step'})
+                reader = variation_reader
+                summary = write_unlocked_pdf(reader, output_path, progress)
+                    
+                # Check if successful
+                verify_error = verify_unlocked_output(summary, output_path, progress)
+                if verify_error is None:
+                    app.logger.debug("Successfully verified unlocked PDF!", extra={'event': 'unlock_step'})
+                    return {'status': 'success'}
+                app.logger.error("Verification error: %s", verify_error)
+        
+        # Try PyPDF2 standard method
+        standard_error = None
+        try:
+            app.logger.debug("Trying standard PyPDF2 approach", extra={'event': 'unlock_step'})
+            with STAGE_SECONDS.labels('encryption_probe').time():
+                if reader is None:
+                    reader = PdfReader(input_path)
+                else:
+                    app.logger.debug("Using cached PDF reader", extra={'event': 'unlock_step'})
+                encrypted = reader.is_encrypted
+            
+            # Check if the PDF is password-protected
+            if encrypted:
+                if progress is not None:
+                    progress.stage('decrypting')
+                # Try to decrypt the PDF
+                with STAGE_SECONDS.labels('decrypt').time():
+                    decrypt_result = reader.decrypt(password)
+                app.logger.debug("Decrypt result: %s", decrypt_result, extra={'event': 'unlock_step'})
+                
+                if decrypt_result <= 0:  # 0 = wrong password, -1 = no password needed
+                    app.logger.info("Failed to decrypt PDF with provided password", extra={'event': 'wrong_password'})
+                    return {
                         'status': 'error',
-                        'error': 'Incorrect password. Please try again.'
+                        'error': 'Incorrect password. Please try again.',
+                        'needs_password': True
                     }
             else:
-                app.logger.info("PDF is not encrypted, creating a copy")
+                app.logger.debug("PDF is not encrypted, creating a copy", extra={'event': 'unlock_step'})
                 
             # Write the unlocked PDF to the output path
-            writer = PdfWriter()
-            for page in reader.pages:
-                writer.add_page(page)
-                
-            with open(output_path, 'wb') as f:
-                writer.write(f)
+            summary = write_unlocked_pdf(reader, output_path, progress)
                 
             # Verify the output file is valid and not encrypted
-            if not os.path.exists(output_path) or os.path.getsize(output_path) == 0:
-                app.logger.error("Output file was not created or is empty")
+            verify_error = verify_unlocked_output(summary, output_path, progress)
+            if verify_error is not None:
+                app.logger.error("Error verifying output PDF: %s", verify_error)
                 return {
                     'status': 'error',
-                    'error': 'Failed to create unlocked PDF file'
+                    'error': verify_error,
+                    'needs_password': False
                 }
-                
-            # Check if the output PDF is really unlocked
+            
+            return {'status': 'success'}
+        except Exception as e:
+            app.logger.error("Error in standard PyPDF2 approach: %s", e)
+            standard_error = e
+            # Fall through to next method for Render
+        
+        # If we're on Render, try one more approach for compatibility
+        if IS_RENDER:
+            app.logger.debug("Attempting Render fallback approach", extra={'event': 'unlock_step'})
             try:
-                verify_reader = PdfReader(output_path)
-                if verify_reader.is_encrypted:
-                    app.logger.error("Output PDF is still encrypted")
-                    return {
-                        'status': 'error',
-                        'error': 'Failed to unlock PDF. Output is still encrypted.'
-                    }
-            except Exception as verify_error:
-                app.logger.error(f"Error verifying output PDF: {str(verify_error)}")
-                return {
-                    'status': 'error',
-                    'error': f'Error verifying output PDF: {str(verify_error)}'
-                }
+                # Try with alternative approach using file-based password
+                password_file = os.path.join(app.config['DATA_FOLDER'], f"pwd_{uuid.uuid4()}.txt")
+                with open(password_file, 'w') as f:
+                    f.write(password)
                 
-            # Get original filename if file_id is provided
-            original_filename = "document.pdf"
-            if file_id and file_id in protected_files:
-                original_filename = protected_files.get(file_id, "document.pdf")
-                app.logger.info(f"Retrieved original filename for file_id {file_id}: {original_filename}")
-            else:
-                # If we don't have an original filename, try to create a unique one
-                timestamp = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
-                original_filename = f"file_{timestamp}.pdf"
-                app.logger.info(f"No original filename found, generated: {original_filename}")
-            
-            # Process filenames for display
-            cleaned_filename = clean_filename(original_filename, file_id)
-            app.logger.info(f"After cleaning filename: {cleaned_filename}")
+                # Read the password from file
+                with open(password_file, 'r') as f:
+                    file_pwd = f.read().strip()
+                
+                app.logger.debug("Password read from file", extra={'event': 'unlock_step'})
+                reader = PdfReader(input_path, password=file_pwd)
+                
+                if reader.is_encrypted:
+                    # Try to decrypt
+                    decrypt_result = reader.decrypt(file_pwd)
+                    app.logger.debug("Decrypt result from file-read password: %s", decrypt_result, extra={'event': 'unlock_step'})
+                    
+                    if decrypt_result <= 0:
+                        app.logger.info("Failed to decrypt with file-read password")
+                        return {
+                            'status': 'error',
+                            'error': 'Incorrect password. Please try again.',
+                            'needs_password': True
+                        }
+                
+                # Clean up password file
+                if os.path.exists(password_file):
+                    os.remove(password_file)
+                
+                # Write the unlocked PDF
+                summary = write_unlocked_pdf(reader, output_path, progress)
+                
+                # Verify output
+                if verify_unlocked_output(summary, output_path, progress) is None:
+                    app.logger.info("Render fallback method succeeded")
+                    return {'status': 'success'}
+            except Exception as render_error:
+                app.logger.error("Render fallback error: %s", render_error)
+        
+        # If we get here, all approaches failed
+        return {
+            'status': 'error',
+            'error': 'Failed to unlock PDF. Please check your password and try again.',
+            'needs_password': "password" in str(standard_error).lower()
+        }
+    except Exception as e:
+        app.logger.error("Error in unlock_pdf: %s", e)
+        return {
+            'status': 'error',
+            'error': f'An error occurred: {str(e)}',
+            'needs_password': False
+        }
+
+def _finalize_unlocked_file(input_path, output_path, file_id=None):
+    """
+    Record a successfully unlocked file so it can be downloaded.
+    
+    Works out the display filename from the original upload name, stores it in
+    processed_files and removes the input file.
+    
+    Args:
+        input_path (str): Path to the input PDF file
+        output_path (str): Path where the unlocked PDF was saved
+        file_id (str, optional): The ID of the file being processed
+        
+    Returns:
+        dict: A dictionary with status, display filename and download URL
+    """
+    # Get original filename if file_id is provided
+    original_filename = "document.pdf"
+    if file_id and file_id in protected_files:
+        original_filename = protected_files.get(file_id, "document.pdf")
+        app.logger.debug("Retrieved original filename for file_id %s: %s", file_id, original_filename, extra={'event': 'display_name'})
+    else:
+        # If we don't have an original filename, try to create a unique one
+        timestamp = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
+        original_filename = f"file_{timestamp}.pdf"
+        app.logger.debug("No original filename found, generated: %s", original_filename, extra={'event': 'display_name'})
+    
+    # Process filenames for display
+    cleaned_filename = clean_filename(original_filename, file_id)
+    app.logger.debug("After cleaning filename: %s", cleaned_filename, extra={'event': 'display_name'})
+    
+    # Make sure we're not getting an empty or default name
+    if cleaned_filename in ["document.pdf", "", ".pdf"] or cleaned_filename.lower() == "document.pdf":
+        if original_filename and original_filename.lower() != "document.pdf":
+            # Use the original name but without extension
+            base_name = os.path.splitext(original_filename)[0]
+            timestamp = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
+            cleaned_filename = f"{base_name}_{timestamp}.pdf"
+            app.logger.debug("Using modified original filename: %s", cleaned_filename, extra={'event': 'display_name'})
+        else:
+            # Generate a completely new name
+            timestamp = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
+            cleaned_filename = f"file_{timestamp}.pdf"
+            app.logger.debug("Generated unique filename: %s", cleaned_filename, extra={'event': 'display_name'})
+    
+    # Create the display filename with the 'unlocked_' prefix
+    prefixed_filename = f"unlocked_{cleaned_filename}"
+    display_filename = secure_filename(prefixed_filename)
+    app.logger.debug("Final display filename: %s", display_filename, extra={'event': 'display_name'})
+    
+    # Store in processed files for later download
+    # along with its size and the hash of the upload it came from
+    output_filename = os.path.basename(output_path)
+    processed_files.put(output_filename, display_filename,
+                        size=os.path.getsize(output_path),
+                        sha256=upload_hashes.get(file_id) if file_id else None)
+    save_processed_files()
+    enforce_storage_budget()
+    
+    # Cleanup if file_id is provided
+    if file_id:
+        if file_id in protected_files:
+            del protected_files[file_id]
+        upload_hashes.pop(file_id, None)
+        upload_trailers.pop(file_id, None)
+        upload_pages.pop(file_id, None)
+        evict_cached_reader(file_id)
+            
+        # Remove the input file
+        if os.path.exists(input_path):
+            os.remove(input_path)
+    
+    app.logger.info("Successfully unlocked PDF: %s", original_filename)
+    return {
+        'status': 'success',
+        'filename': display_filename,
+        'download_url': f'/download/{output_filename}'
+    }
+
+def unlock_pdf(input_path, output_path, password, file_id=None, reader=None):
+    """
+    Unlock a PDF file and save the unlocked version to the specified output path.
+    
+    Args:
+        input_path (str): Path to the input PDF file
+        output_path (str): Path where the unlocked PDF should be saved
+        password (str): Password to unlock the PDF
+        file_id (str, optional): The ID of the file being processed
+        reader (PdfReader, optional): Already parsed reader of input_path
+        
+    Returns:
+        dict: A dictionary with status and other information
+    """
+    cache_key = result_cache_key(file_id, input_path, password) if file_id else None
+    
+    result = None
+    try:
+        # Same content unlocked with the same password before: no PDF work
+        if result_cache_checkout(cache_key, output_path):
+            result = _finalize_unlocked_file(input_path, output_path, file_id)
+    except Exception as e:
+        app.logger.error("Error using cached result: %s", e)
+    
+    if result is None:
+        result = _unlock_pdf_file(input_path, output_path, password, reader=reader)
+        if result['status'] == 'success':
+            try:
+                result_cache_store(cache_key, output_path)
+                result = _finalize_unlocked_file(input_path, output_path, file_id)
+            except Exception as e:
+                app.logger.error("Error in unlock_pdf: %s", e)
+                result = {
+                    'status': 'error',
+                    'error': f'An error occurred: {str(e)}'
+                }
+    
+    count_file_result(unlock_result_status(result))
+    return result
+
+# Gunicorn workers on this machine, exported by gunicorn_config.py; 1 for the
+# development server
+WEB_WORKERS = max(1, int(os.environ.get('WEB_CONCURRENCY', 1)))
+
+# Worker processes for the CPU-bound PDF work.
+# PyPDF2 is pure Python and holds the GIL for the whole unlock, so a batch is
+# spread over a pool of processes instead of threads. 0 runs everything inline.
+# Every gunicorn worker has its own pool, so by default each gets its share
+# of the CPUs rather than all of them
+PDF_POOL_WORKERS = int(os.environ.get('PDF_POOL_WORKERS', max(1, (os.cpu_count() or 1) // WEB_WORKERS)))
+
+# Processes per worker for slow-lane files, kept apart so that large
+# documents never queue in front of small ones
+SLOW_POOL_WORKERS = int(os.environ.get('SLOW_POOL_WORKERS', 1))
+
+# Seconds between a pool process's checks that its owner is still running
+POOL_OWNER_CHECK_INTERVAL = 1
+
+# Process pools by lane, each with the process ID that created it
+pdf_pools = {}
+pdf_pool_lock = threading.Lock()
+
+# Whether warm_up has run in this process or in the process it was forked from
+_warmed_up = False
+
+def warm_up():
+    """
+    Import PyPDF2 and pycryptodome and run a tiny encrypted document through them.
+    
+    The rest of the app imports PyPDF2 where it is used, so starting the
+    server or the CLI doesn't pay for it. The gunicorn master calls this
+    before forking the workers, pool processes when they start and /healthz
+    on every ping; only the first call in a process does any work.
+    
+    Returns:
+        float: Seconds spent, 0 if the process was already warm
+    """
+    global _warmed_up
+    if _warmed_up:
+        return 0.0
+    
+    start = time.perf_counter()
+    from PyPDF2 import PdfReader, PdfWriter
+    from Crypto.Cipher import AES
+    
+    # Writing encrypts with RC4 and MD5, reading parses the xref table,
+    # the /Encrypt dictionary and the page tree
+    writer = PdfWriter()
+    writer.add_blank_page(72, 72)
+    writer.encrypt('warm-up-user', 'warm-up-owner')
+    stream = io.BytesIO()
+    writer.write(stream)
+    stream.seek(0)
+    reader = PdfReader(stream)
+    reader.decrypt('warm-up-user')
+    len(reader.pages)
+    AES.new(bytes(16), AES.MODE_CBC, bytes(16)).decrypt(bytes(16))
+    
+    _warmed_up = True
+    return time.perf_counter() - start
+
+def _exit_with_owner(owner_pid):
+    """
+    End this pool process once the process that owns its pool is gone.
+    
+    A gunicorn worker killed with SIGKILL (timeout, out of memory) never runs
+    the atexit shutdown of its pools, and their processes would be adopted by
+    init and keep running. The owner is watched rather than the parent: in
+    the async mode the parent is the fork server, which only exits once all
+    the processes it started have.
+    """
+    def watch():
+        while True:
+            try:
+                os.kill(owner_pid, 0)
+            except ProcessLookupError:
+                os._exit(1)
+            except PermissionError:
+                pass
+            time.sleep(POOL_OWNER_CHECK_INTERVAL)
+    
+    threading.Thread(target=watch, name='owner-watch', daemon=True).start()
+
+def _init_pdf_worker(owner_pid=None):
+    """Import and prime the PDF and crypto modules once when a pool process starts."""
+    _exit_with_owner(owner_pid or os.getppid())
+    warm_up()
+
+def _pdf_worker_ping():
+    """No-op task used to start the pool processes ahead of the first batch."""
+    return os.getpid()
+
+def get_pdf_pool(lane='fast'):
+    """
+    Return this worker's PDF process pool for a lane, starting and prewarming it if needed.
+    
+    The pool is created lazily and per process ID, so gunicorn workers forked
+    from a master never share (or inherit a broken copy of) a pool. In the
+    async server mode its processes come from a fork server: forked from the
+    worker, they would inherit its gevent hub, and with it the greenlets
+    accepting connections, and serve requests themselves.
+    """
+    workers = SLOW_POOL_WORKERS if lane == 'slow' else PDF_POOL_WORKERS
+    if PDF_POOL_WORKERS <= 0 or workers <= 0:
+        return None
+    
+    with pdf_pool_lock:
+        pool, pid = pdf_pools.get(lane, (None, None))
+        if pool is None or pid != os.getpid():
+            context = multiprocessing.get_context('forkserver') if ASYNC_MODE else None
+            pool = ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=_init_pdf_worker,
+                                       initargs=(os.getpid(),))
+            pdf_pools[lane] = (pool, os.getpid())
+            
+            # Submit one ping per worker so every process is started and has
+            # PyPDF2/pycryptodome imported before real work arrives
+            pings = [pool.submit(_pdf_worker_ping) for _ in range(workers)]
+            for ping in pings:
+                ping.result()
+            app.logger.info("Started %s PDF worker pool with %s processes", lane, workers)
+    
+    return pool
+
+def _reset_pdf_pool(lane='fast'):
+    """Drop a broken pool so the next batch starts a fresh one."""
+    with pdf_pool_lock:
+        pool, _ = pdf_pools.pop(lane, (None, None))
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+def submit_pdf_work(fn, *args, lane='fast'):
+    """Run fn(*args) on the lane's PDF process pool, or inline when the pool is disabled."""
+    pool = get_pdf_pool(lane)
+    if pool is not None:
+        IN_FLIGHT.labels('pdf_work').inc()
+        future = pool.submit(fn, *args)
+        future.add_done_callback(lambda _: IN_FLIGHT.labels('pdf_work').dec())
+        return future
+    
+    future = Future()
+    try:
+        with IN_FLIGHT.labels('pdf_work').track_inprogress():
+            future.set_result(run_cpu_bound(fn, *args))
+    except Exception as e:
+        future.set_exception(e)
+    return future
+
+def _gevent_patched():
+    # gevent is only imported when gunicorn_config.py selected the async mode
+    monkey = sys.modules.get('gevent.monkey')
+    return monkey is not None and monkey.is_module_patched('threading')
+
+# In the async server mode (SERVER_MODE=async in gunicorn_config.py) gevent
+# serves all connections of a worker from one event loop, so slow uploads and
+# downloads only cost a greenlet each. PDF work holds the GIL for the whole
+# document and would stop the loop, so it runs on gevent's native threads
+ASYNC_MODE = _gevent_patched()
+
+def run_cpu_bound(fn, *args, **kwargs):
+    """
+    Run fn off the event loop in the async server mode, inline otherwise.
+    
+    Also used for calls that may block on a lock held by another process,
+    which would stop the loop just the same.
+    """
+    if not ASYNC_MODE:
+        return fn(*args, **kwargs)
+    import gevent
+    thread_id = threading.get_ident()
+    if sampler.is_sampling(thread_id):
+        # The request only waits from here on: sample the thread doing the work
+        prefix = _collapse_stack(sys._getframe(1)) + ';'
+        args = (thread_id, prefix, fn) + args
+        fn = sampler.sample_instead
+    return gevent.get_hub().threadpool.apply(fn, args, kwargs)
+
+# Files at least this large, or with at least this many pages, go to the
+# slow lane
+LANE_SLOW_BYTES = int(os.environ.get('LANE_SLOW_BYTES', 2 * 1024 * 1024))
+LANE_SLOW_PAGES = int(os.environ.get('LANE_SLOW_PAGES', 100))
+
+# How many files each lane may process at once, across all workers
+LANE_SLOTS = {
+    'fast': int(os.environ.get('FAST_LANE_SLOTS', 4)),
+    'slow': int(os.environ.get('SLOW_LANE_SLOTS', 1))
+}
+
+# One lock file per lane slot; holding an flock on it occupies the slot
+LANES_FOLDER = os.path.join(DATA_FOLDER, 'lanes')
+make_server_folder(LANES_FOLDER)
+
+# Slots of this process when flock is not available
+_local_lane_slots = {lane: threading.BoundedSemaphore(slots) for lane, slots in LANE_SLOTS.items()}
+
+def choose_lane(size, pages):
+    """Route a file to the 'fast' or 'slow' lane by its size and page count."""
+    if size >= LANE_SLOW_BYTES or pages >= LANE_SLOW_PAGES:
+        return 'slow'
+    return 'fast'
+
+def _try_lane_slot(lane):
+    if fcntl is None:
+        if _local_lane_slots[lane].acquire(blocking=False):
+            return ('local', lane)
+        return None
+    
+    for slot in range(LANE_SLOTS[lane]):
+        fd = os.open(os.path.join(LANES_FOLDER, f'{lane}.{slot}.lock'), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return fd
+        except OSError:
+            os.close(fd)
+    return None
+
+def acquire_lane_slot(lane, timeout=0):
+    """
+    Take one of the lane's processing slots.
+    
+    Args:
+        lane (str): 'fast' or 'slow'
+        timeout (float): Seconds to wait for a slot to free up
+        
+    Returns:
+        Slot to pass to release_lane_slot(), or None if all slots stayed busy
+    """
+    deadline = time.time() + timeout
+    while True:
+        slot = _try_lane_slot(lane)
+        if slot is not None or time.time() >= deadline:
+            return slot
+        time.sleep(ADMISSION_POLL_INTERVAL)
+
+def release_lane_slot(slot):
+    """Give back a slot taken by acquire_lane_slot()."""
+    if slot is None:
+        return
+    if isinstance(slot, tuple):
+        _local_lane_slots[slot[1]].release()
+    else:
+        # Unlock before closing: a pool process forked while the slot was
+        # held shares the lock and would otherwise keep it forever
+        fcntl.flock(slot, fcntl.LOCK_UN)
+        os.close(slot)
+
+# Memory that PDF processing may use at once, summed over all workers
+MEMORY_BUDGET_BYTES = int(os.environ.get('MEMORY_BUDGET_BYTES', 256 * 1024 * 1024))
+
+# Estimated memory use of unlocking a PDF: fixed overhead plus a cost per
+# byte of the file and per object in its xref table (measured on PyPDF2 3.0
+# at about 1.2 bytes per byte and 2.3 KB per object, with headroom for RSS)
+MEMORY_COST_BASE = 4 * 1024 * 1024
+MEMORY_COST_PER_BYTE = float(os.environ.get('MEMORY_COST_PER_BYTE', 2))
+MEMORY_COST_PER_OBJECT = int(os.environ.get('MEMORY_COST_PER_OBJECT', 3 * 1024))
+
+# How long a request waits for memory before getting a 503, and the
+# Retry-After it is told
+ADMISSION_WAIT = float(os.environ.get('ADMISSION_WAIT', 5))
+ADMISSION_RETRY_AFTER = int(os.environ.get('ADMISSION_RETRY_AFTER', 5))
+ADMISSION_POLL_INTERVAL = 0.2
+
+# Reservations older than this are assumed to belong to a worker that was killed
+RESERVATION_MAX_AGE = 600
+
+# Reservations of the json backend, which only limits this process
+_local_reservations = {}
+_local_reservations_lock = threading.Lock()
+
+def estimate_memory_cost(input_path, file_id=None):
+    """
+    Estimate how much memory parsing and unlocking a PDF will take.
+    
+    Uses the file size and the object count from the trailer's /Size, read
+    from the trailer bytes kept at upload or from the end of the file.
+    
+    Returns:
+        int: Estimated bytes, capped at MEMORY_BUDGET_BYTES so that any file
+             can run once it has the budget to itself
+    """
+    size = os.path.getsize(input_path)
+    tail = upload_trailers.get(file_id) if file_id else None
+    if tail is None:
+        with open(input_path, 'rb') as f:
+            f.seek(max(size - PDF_TRAILER_WINDOW, 0))
+            tail = f.read()
+    
+    sizes = re.findall(rb'/Size\s+(\d+)', tail)
+    # An xref stream's dictionary may sit before the tail; assume ~1 KB objects
+    objects = int(sizes[-1]) if sizes else size // 1024
+    
+    cost = MEMORY_COST_BASE + int(size * MEMORY_COST_PER_BYTE) + objects * MEMORY_COST_PER_OBJECT
+    return min(cost, MEMORY_BUDGET_BYTES)
+
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass
+    return True
+
+def reserve_memory(cost):
+    """
+    Reserve memory from the budget shared by all workers.
+    
+    Args:
+        cost (int): Bytes to reserve, from estimate_memory_cost()
+        
+    Returns:
+        str: Reservation ID to pass to release_memory(), or None if the
+             budget does not have room for it right now
+    """
+    while True:
+        reservation_id = _try_reserve_memory(cost)
+        # Readers this process cached are only worth their memory while
+        # nothing else needs it
+        if reservation_id is not None or not shed_cached_reader():
+            return reservation_id
+
+def _try_reserve_memory(cost):
+    reservation_id = str(uuid.uuid4())
+    now = time.time()
+    
+    if METADATA_BACKEND != 'sqlite':
+        with _local_reservations_lock:
+            if sum(_local_reservations.values()) + cost > MEMORY_BUDGET_BYTES:
+                return None
+            _local_reservations[reservation_id] = cost
+        return reservation_id
+    
+    # BEGIN IMMEDIATE waits up to the connection's timeout for other writers
+    return run_cpu_bound(_reserve_memory_row, reservation_id, cost, now)
+
+def _reserve_memory_row(reservation_id, cost, now):
+    """Insert a reservation into the shared budget if it fits, see reserve_memory()."""
+    conn = get_metadata_db()
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        # Drop reservations of workers that died without releasing them
+        for stale_id, pid, created_at in conn.execute(
+                'SELECT id, pid, created_at FROM memory_reservations').fetchall():
+            if created_at < now - RESERVATION_MAX_AGE or not _process_alive(pid):
+                conn.execute('DELETE FROM memory_reservations WHERE id = ?', (stale_id,))
+        
+        used = conn.execute('SELECT COALESCE(SUM(bytes), 0) FROM memory_reservations').fetchone()[0]
+        if used + cost > MEMORY_BUDGET_BYTES:
+            conn.execute('COMMIT')
+            return None
+        
+        conn.execute('INSERT INTO memory_reservations (id, pid, bytes, created_at) VALUES (?, ?, ?, ?)',
+                     (reservation_id, os.getpid(), cost, now))
+        conn.execute('COMMIT')
+        return reservation_id
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+
+def release_memory(reservation_id):
+    """Return a reservation made by reserve_memory() to the budget."""
+    if reservation_id is None:
+        return
+    if METADATA_BACKEND != 'sqlite':
+        with _local_reservations_lock:
+            _local_reservations.pop(reservation_id, None)
+        return
+    get_metadata_db().execute('DELETE FROM memory_reservations WHERE id = ?', (reservation_id,))
+
+def admit_memory(cost, timeout=ADMISSION_WAIT):
+    """Reserve memory, waiting up to timeout seconds for room; None if there is none."""
+    deadline = time.time() + timeout
+    while True:
+        reservation_id = reserve_memory(cost)
+        if reservation_id is not None or time.time() >= deadline:
+            return reservation_id
+        time.sleep(ADMISSION_POLL_INTERVAL)
+
+def server_busy_response():
+    """503 response telling the client to retry once memory has been freed."""
+    response = jsonify({
+        'status': 'error',
+        'busy': True,
+        'message': 'The server is busy with other files. Please try again in a few seconds.'
+    })
+    response.status_code = 503
+    response.headers['Retry-After'] = str(ADMISSION_RETRY_AFTER)
+    return response
+
+# Helper function to clean up temporary files
+def _cleanup_temp_files(file_paths):
+    for file_path in file_paths:
+        try:
+            if os.path.exists(file_path):
+                os.remove(file_path)
+                app.logger.debug("Removed temporary file: %s", file_path)
+        except Exception as e:
+            app.logger.error("Failed to remove temporary file %s: %s", file_path, e)
+
+# Profiling
+# A request with an X-Profile header and the admin token in X-Admin-Token
+# runs under cProfile, and so do the PDF tasks of a job it starts. The
+# profiles are listed and served by /admin/profiles; without ADMIN_TOKEN
+# on-demand profiling and the admin endpoints are off.
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN')
+PROFILES_FOLDER = os.path.join(DATA_FOLDER, 'profiles')
+make_server_folder(PROFILES_FOLDER)
+
+# How long on-demand profiles are kept, in seconds
+PROFILE_MAX_AGE = int(os.environ.get('PROFILE_MAX_AGE', 7 * 24 * 3600))
+
+# Continuous sampling: one thread per process samples the stacks of running
+# requests and job files every PROFILE_SAMPLE_INTERVAL seconds, and the
+# samples of the PROFILE_KEEP_SLOWEST slowest ones are kept. The cost is one
+# stack walk per running request per interval, whatever the request does.
+PROFILE_SAMPLING = os.environ.get('PROFILE_SAMPLING', '0') == '1'
+PROFILE_SAMPLE_INTERVAL = float(os.environ.get('PROFILE_SAMPLE_INTERVAL', 0.01))
+PROFILE_KEEP_SLOWEST = int(os.environ.get('PROFILE_KEEP_SLOWEST', 20))
+
+# Innermost frames kept per sampled stack
+PROFILE_MAX_DEPTH = 64
+
+# Functions listed in the text report of a cProfile profile
+PROFILE_REPORT_LINES = 60
+
+# cProfile runs one profiler at a time per process on newer Pythons
+profile_lock = threading.Lock()
+
+def _collapse_stack(frame):
+    """A stack as 'file:function;...' from the outermost frame, as flame graph tools read it."""
+    names = []
+    while frame is not None and len(names) < PROFILE_MAX_DEPTH:
+        code = frame.f_code
+        names.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+def _unpatched(module_name, name):
+    """module_name.name as it was before gevent's monkey patching, if any."""
+    monkey = sys.modules.get('gevent.monkey')
+    if monkey is not None:
+        return monkey.get_original(module_name, name)
+    return getattr(__import__(module_name), name)
+
+class StackSampler:
+    """
+    Samples the stacks of registered threads from one background thread.
+    
+    In the async server mode requests are greenlets sharing the event loop's
+    OS thread, which sys._current_frames() knows nothing about. The sampler
+    then runs on a real OS thread, so that it doesn't wait for requests to
+    yield, and reads a greenlet's stack from the loop's current frame while
+    the greenlet runs and from the frame it is suspended in otherwise.
+    While a request waits for run_cpu_bound(), the native thread doing the
+    work is sampled in its place.
+    """
+    
+    def __init__(self, interval):
+        self.interval = interval
+        self.reset()
+    
+    def reset(self):
+        # Also run in forked children, where the parent's thread is gone.
+        # gevent's locks can't be shared with a native thread
+        self.lock = _unpatched('_thread', 'allocate_lock')()
+        # Held while the sampler thread has nothing to sample; start()
+        # releases it to wake the thread up
+        self.wakeup = _unpatched('_thread', 'allocate_lock')()
+        self.wakeup.acquire()
+        self.awake = False
+        self.samples = {}
+        self.started = False
+    
+    def _frame(self, target, frames):
+        greenlet, native_id = target
+        if greenlet is not None and (greenlet.gr_frame is not None or greenlet.dead):
+            return greenlet.gr_frame
+        return frames.get(native_id)
+    
+    def _sample(self, sleep):
+        """Sample every registered thread once; False once none is left."""
+        sleep(self.interval)
+        frames = sys._current_frames()
+        with self.lock:
+            if not self.samples:
+                self.awake = False
+                return False
+            for sample in self.samples.values():
+                frame = self._frame(sample['target'], frames)
+                if frame is not None:
+                    stack = sample['prefix'] + _collapse_stack(frame)
+                    sample['stacks'][stack] = sample['stacks'].get(stack, 0) + 1
+            return True
+    
+    def _run(self):
+        sleep = _unpatched('time', 'sleep')
+        while True:
+            self.wakeup.acquire()
+            while self._sample(sleep):
+                pass
+    
+    def start(self, thread_id):
+        """Start sampling the calling thread, registered as thread_id."""
+        if ASYNC_MODE:
+            from greenlet import getcurrent
+            target = (getcurrent(), _unpatched('_thread', 'get_ident')())
+        else:
+            target = (None, thread_id)
+        
+        with self.lock:
+            if not self.started:
+                _unpatched('_thread', 'start_new_thread')(self._run, ())
+                self.started = True
+            self.samples[thread_id] = {'target': target, 'prefix': '', 'stacks': {}}
+            if not self.awake:
+                self.awake = True
+                self.wakeup.release()
+    
+    def is_sampling(self, thread_id):
+        return thread_id in self.samples
+    
+    def sample_instead(self, thread_id, prefix, fn, *args, **kwargs):
+        """
+        Run fn on the calling thread, sampled in place of thread_id.
+        
+        Its stacks are recorded under prefix, the collapsed stack of the
+        caller that is waiting for it.
+        """
+        native_id = _unpatched('_thread', 'get_ident')()
+        with self.lock:
+            sample = self.samples.get(thread_id)
+            if sample is not None:
+                waiting = sample['target'], sample['prefix']
+                sample['target'], sample['prefix'] = (None, native_id), prefix
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            if sample is not None:
+                with self.lock:
+                    sample['target'], sample['prefix'] = waiting
+    
+    def stop(self, thread_id):
+        """Stop sampling a thread and return its {stack: samples}."""
+        with self.lock:
+            sample = self.samples.pop(thread_id, None)
+        return sample['stacks'] if sample is not None else {}
+
+sampler = StackSampler(PROFILE_SAMPLE_INTERVAL)
+
+def _reset_profiling_after_fork():
+    global profile_lock
+    profile_lock = threading.Lock()
+    sampler.reset()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_profiling_after_fork)
+
+def _is_admin():
+    """Whether the request carries the admin token."""
+    token = request.headers.get('X-Admin-Token', '')
+    return bool(ADMIN_TOKEN) and hmac.compare_digest(token.encode('utf-8'), ADMIN_TOKEN.encode('utf-8'))
+
+def _is_valid_profile_id(profile_id):
+    return re.fullmatch(r'[A-Za-z0-9-]+', profile_id or '') is not None
+
+def _write_profile_meta(profile_id, meta):
+    path = os.path.join(PROFILES_FOLDER, f"{profile_id}.json")
+    with open(path + '.tmp', 'w') as f:
+        json.dump(meta, f)
+    os.replace(path + '.tmp', path)
+
+def profiled_call(profile_path, fn, *args):
+    """Run fn(*args) under cProfile and save the profile to profile_path."""
+    with profile_lock:
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            return fn(*args)
+        finally:
+            profiler.disable()
+            profiler.dump_stats(profile_path)
+
+def record_sampled_profile(label, duration, stacks):
+    """
+    Keep the stack samples of a request if it is one of the slowest.
+    
+    The duration is part of the file name, so finding the slowest ones only
+    lists the folder; at most PROFILE_KEEP_SLOWEST are kept.
+    
+    Args:
+        label (str): What was sampled, e.g. 'POST /unlock-with-password'
+        duration (float): How long it took, in seconds
+        stacks (dict): Samples per collapsed stack from StackSampler.stop
+    """
+    if not stacks:
+        return
+    
+    try:
+        duration_ms = int(duration * 1000)
+        kept = sorted((int(name.split('-')[1]), name) for name in os.listdir(PROFILES_FOLDER)
+                      if name.startswith('sampled-') and name.endswith('.json'))
+        if len(kept) >= PROFILE_KEEP_SLOWEST and duration_ms <= kept[-PROFILE_KEEP_SLOWEST][0]:
+            return
+        
+        profile_id = f"sampled-{duration_ms:09d}-{uuid.uuid4().hex[:12]}"
+        _write_profile_meta(profile_id, {
+            'profile_id': profile_id,
+            'kind': 'sampled',
+            'label': label,
+            'duration': duration,
+            'created_at': time.time(),
+            'interval': PROFILE_SAMPLE_INTERVAL,
+            'samples': sum(stacks.values()),
+            'stacks': stacks
+        })
+        
+        for _, name in kept[:max(0, len(kept) + 1 - PROFILE_KEEP_SLOWEST)]:
+            try:
+                os.remove(os.path.join(PROFILES_FOLDER, name))
+            except FileNotFoundError:
+                pass
+    except Exception as e:
+        app.logger.error("Error recording sampled profile: %s", e)
+
+def sampled_call(label, fn, *args):
+    """Run fn(*args) with its stack sampled and keep the samples if it is one of the slowest."""
+    thread_id = threading.get_ident()
+    started = time.perf_counter()
+    sampler.start(thread_id)
+    try:
+        return fn(*args)
+    finally:
+        record_sampled_profile(label, time.perf_counter() - started, sampler.stop(thread_id))
+
+def pdf_task(job, entry, fn, *args):
+    """The (fn, args...) to submit for a job file, profiled the way its job asks for."""
+    if job.get('profile_id'):
+        profile_path = os.path.join(PROFILES_FOLDER, f"{job['profile_id']}.{entry['file_id']}.prof")
+        return (profiled_call, profile_path, fn) + args
+    if PROFILE_SAMPLING:
+        return (sampled_call, f"job file {entry['filename']}", fn) + args
+    return (fn,) + args
+
+@app.before_request
+def _start_profiling():
+    g.request_started = time.perf_counter()
+    if request.headers.get('X-Profile') and _is_admin() and profile_lock.acquire(blocking=False):
+        g.profile_id = f"cprofile-{uuid.uuid4()}"
+        g.profiler = cProfile.Profile()
+        g.profiler.enable()
+    elif PROFILE_SAMPLING and not request.path.startswith(('/admin/', '/metrics', '/healthz')):
+        sampler.start(threading.get_ident())
+        g.sampled = True
+
+@app.after_request
+def _finish_profiling(response):
+    profiler = g.pop('profiler', None)
+    sampled = g.pop('sampled', False)
+    if profiler is None and not sampled:
+        return response
+    
+    duration = time.perf_counter() - g.request_started
+    label = f"{request.method} {request.path}"
+    if profiler is not None:
+        profiler.disable()
+        profile_lock.release()
+        try:
+            profiler.dump_stats(os.path.join(PROFILES_FOLDER, f"{g.profile_id}.prof"))
+            _write_profile_meta(g.profile_id, {
+                'profile_id': g.profile_id,
+                'kind': 'cprofile',
+                'label': label,
+                'duration': duration,
+                'created_at': time.time(),
+                'status_code': response.status_code
+            })
+            response.headers['X-Profile-Id'] = g.profile_id
+        except Exception as e:
+            app.logger.error("Error saving profile %s: %s", g.profile_id, e)
+    else:
+        record_sampled_profile(label, duration, sampler.stop(threading.get_ident()))
+    return response
+
+@app.teardown_request
+def _stop_profiling(exc):
+    # after_request is skipped when the view raised
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        profiler.disable()
+        profile_lock.release()
+    if g.pop('sampled', False):
+        sampler.stop(threading.get_ident())
+
+@app.before_request
+def _track_request():
+    IN_FLIGHT.labels('requests').inc()
+
+@app.teardown_request
+def _untrack_request(exc):
+    IN_FLIGHT.labels('requests').dec()
+
+@app.route('/')
+def index():
+    # Async workers hold the result and progress streams cheaply; with sync
+    # workers the page polls instead of keeping a worker busy
+    return render_template('index.html', streaming=ASYNC_MODE)
+
+def _job_entry_paths(file_id):
+    """Return the input and output paths used for a file ID."""
+    input_path = os.path.join(app.config['UPLOAD_FOLDER'], file_id)
+    output_path = os.path.join(app.config['PROCESSED_FOLDER'], f"unlocked_{file_id}")
+    return input_path, output_path
+
+def _job_entry_result(entry, unlock_result, cache_key=None):
+    """
+    Turn the result of _unlock_pdf_file for one job file into a result entry.
+    
+    Runs in the web worker, so this is where successful unlocks are marshalled
+    back into the processed_files bookkeeping.
+    
+    Args:
+        entry (dict): The job's entry for the file
+        unlock_result (dict): The result returned by _unlock_pdf_file
+        cache_key (str, optional): Result cache key to store a new output under
+        
+    Returns:
+        dict: A result entry in the format returned to the frontend
+    """
+    file_id = entry['file_id']
+    input_path, output_path = _job_entry_paths(file_id)
+    
+    if entry['source'] == 'upload':
+        # Uploaded in this request, report the name the client sent
+        filename = entry['filename']
+    else:
+        filename = protected_files.get(file_id, "document.pdf")
+    
+    if unlock_result['status'] == 'success':
+        try:
+            result_cache_store(cache_key, output_path)
+            finalized = _finalize_unlocked_file(input_path, output_path, file_id)
+            return {
+                'file_id': file_id,
+                'filename': finalized['filename'],
+                'status': 'success',
+                'download_url': finalized['download_url']
+            }
+        except Exception as e:
+            app.logger.error("General error processing PDF with ID %s: %s", file_id, e)
+            return {
+                'file_id': file_id,
+                'filename': filename,
+                'status': 'error',
+                'message': f'Error: {str(e)}'
+            }
+    
+    if unlock_result.get('needs_password'):
+        app.logger.info("PDF requires password: %s", filename)
+        return {
+            'file_id': file_id,
+            'filename': filename,
+            'status': 'needs_password',
+            'message': 'This PDF is password protected'
+        }
+    
+    app.logger.warning("Failed to unlock PDF with ID %s: %s", file_id, unlock_result['error'])
+    
+    if entry['source'] == 'upload':
+        # Not a password issue, might be a corrupt file: clean it up
+        if os.path.exists(input_path):
+            os.remove(input_path)
+        if file_id in protected_files:
+            del protected_files[file_id]
+        upload_hashes.pop(file_id, None)
+        upload_trailers.pop(file_id, None)
+        upload_pages.pop(file_id, None)
+        evict_cached_reader(file_id)
+    
+    return {
+        'file_id': file_id,
+        'filename': filename,
+        'status': 'error',
+        'message': unlock_result['error']
+    }
+
+# Background jobs for /unlock batches
+JOBS_FOLDER = os.path.join(DATA_FOLDER, 'jobs')
+make_server_folder(JOBS_FOLDER)
+
+# Number of background threads running unlock jobs in each worker process
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 2))
+SLOW_JOB_WORKERS = int(os.environ.get('SLOW_JOB_WORKERS', 1))
+
+# Jobs with any slow-lane file run on their own threads, so they never hold
+# up jobs made only of small files
+job_executors = {
+    'fast': ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix='unlock-job'),
+    'slow': ThreadPoolExecutor(max_workers=SLOW_JOB_WORKERS, thread_name_prefix='unlock-job-slow')
+}
+
+# Statuses after which a job will not change anymore
+JOB_FINISHED_STATUSES = ('completed', 'failed')
+
+# Jobs run on threads of the worker that accepted them and die with it (timeout,
+# out of memory, restart, deploy). While a job is unfinished its worker touches
+# the job's file every JOB_HEARTBEAT_INTERVAL seconds; a job whose file has not
+# been touched for JOB_STALE_AFTER seconds is marked failed by whoever loads it
+JOB_STALE_AFTER = int(os.environ.get('JOB_STALE_AFTER', 60))
+JOB_HEARTBEAT_INTERVAL = JOB_STALE_AFTER / 6
+
+# Unfinished jobs accepted by this process, and the process ID that started
+# the heartbeat thread touching them
+owned_jobs = set()
+job_heartbeat = {'pid': None}
+job_heartbeat_lock = threading.Lock()
+
+# Queues of the requests streaming a job's results, by job ID. The job's
+# thread puts every entry on it as it finishes, then None when the job is over
+job_listeners = {}
+# Seconds a stream waits for the next result before checking the job's state
+JOB_STREAM_POLL_INTERVAL = 5
+# Seconds a result stream may hold a sync worker. gunicorn kills a sync worker
+# that is busy with one request for longer than its timeout (120s), and the
+# worker's jobs with it, so the stream ends before then with a "poll" line and
+# the client follows the rest of the job through /jobs/<job_id>
+JOB_STREAM_MAX_SECONDS = int(os.environ.get('JOB_STREAM_MAX_SECONDS', 90))
+
+def _publish_job_entry(job_id, entry):
+    listener = job_listeners.get(job_id)
+    if listener is not None:
+        listener.put(entry)
+
+def _job_path(job_id):
+    """Return the path of the JSON file holding a job's state."""
+    return os.path.join(JOBS_FOLDER, f"{job_id}.json")
+
+def _is_valid_job_id(job_id):
+    """Job IDs are UUIDs; reject anything else so it can't escape JOBS_FOLDER."""
+    try:
+        return str(uuid.UUID(job_id)) == job_id
+    except (ValueError, TypeError):
+        return False
+
+def save_job(job):
+    """
+    Persist the state of a job.
+    
+    Jobs are stored as JSON files in the data folder (rather than in memory) so
+    that /jobs/<job_id> can be answered by any gunicorn worker, not only the
+    one running the job.
+    """
+    job['updated_at'] = time.time()
+    temp_file = os.path.join(JOBS_FOLDER, f"temp_{uuid.uuid4()}.json")
+    try:
+        with open(temp_file, 'w') as f:
+            json.dump(job, f)
+        # Atomic replace so readers never see a half-written job
+        os.replace(temp_file, _job_path(job['job_id']))
+    except Exception as e:
+        app.logger.error("Error saving job %s: %s", job['job_id'], e)
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+
+def load_job(job_id):
+    """
+    Load a job's state, or return None if the job does not exist.
+    
+    An unfinished job of another process whose heartbeat has stopped is
+    marked failed on the way.
+    """
+    if not _is_valid_job_id(job_id):
+        return None
+    try:
+        with open(_job_path(job_id), 'r') as f:
+            job = json.load(f)
+            touched_at = os.fstat(f.fileno()).st_mtime
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        app.logger.error("Error loading job %s: %s", job_id, e)
+        return None
+    
+    if (job['status'] not in JOB_FINISHED_STATUSES and job_id not in owned_jobs
+            and time.time() - touched_at > JOB_STALE_AFTER):
+        _fail_stale_job(job)
+    return job
+
+def _fail_stale_job(job):
+    """Mark a job failed whose worker stopped running it."""
+    app.logger.warning("Unlock job %s of process %s stopped %.0fs ago, marking it failed",
+                       job['job_id'], job.get('owner_pid'), time.time() - job.get('updated_at', 0))
+    job['status'] = 'failed'
+    job['error'] = 'The server stopped while unlocking these files'
+    for entry in job['files']:
+        if entry['status'] in ('queued', 'processing'):
+            entry['status'] = 'error'
+            entry['message'] = 'The server stopped while unlocking this file, please try again'
+    save_job(job)
+    for status, count in _job_counts(job).items():
+        count_file_result(status, count)
+
+def unfinished_jobs():
+    """Return the jobs still queued or running, after failing those whose worker died."""
+    try:
+        names = os.listdir(JOBS_FOLDER)
+    except FileNotFoundError:
+        return []
+    
+    jobs = []
+    for name in names:
+        if name.startswith('temp_') or not name.endswith('.json'):
+            continue
+        job = load_job(name[:-len('.json')])
+        if job is not None and job['status'] not in JOB_FINISHED_STATUSES:
+            jobs.append(job)
+    return jobs
+
+def _job_heartbeat():
+    """Touch the files of the jobs this process owns, for as long as it lives."""
+    while True:
+        time.sleep(JOB_HEARTBEAT_INTERVAL)
+        for job_id in list(owned_jobs):
+            try:
+                os.utime(_job_path(job_id))
+            except FileNotFoundError:
+                owned_jobs.discard(job_id)
+            except OSError as e:
+                app.logger.error("Error touching job %s: %s", job_id, e)
+
+def _own_job(job_id):
+    """Keep a job of this process from being taken for dead while it is unfinished."""
+    owned_jobs.add(job_id)
+    with job_heartbeat_lock:
+        # Threads don't survive a fork: every worker starts its own
+        if job_heartbeat['pid'] != os.getpid():
+            threading.Thread(target=_job_heartbeat, name='job-heartbeat', daemon=True).start()
+            job_heartbeat['pid'] = os.getpid()
+
+def _job_counts(job):
+    """Count the files of a job per status."""
+    counts = {}
+    for entry in job['files']:
+        counts[entry['status']] = counts.get(entry['status'], 0) + 1
+    return counts
+
+@IN_FLIGHT.labels('jobs').track_inprogress()
+def run_unlock_job(job_id, passwords=None):
+    """
+    Process every queued file of an unlock job and record per-file results.
+    
+    The files are unlocked in parallel on the process pool of their lane,
+    each once its lane has a free slot and its estimated memory fits in the
+    shared budget; each result is recorded as soon as it comes back.
+    
+    Args:
+        job_id (str): The job to run
+        passwords (dict, optional): Password to try per file ID; kept out of
+            the job's state so they never reach the disk
+    """
+    passwords = passwords or {}
+    job = load_job(job_id)
+    if job is None:
+        app.logger.error("Unlock job %s not found", job_id)
+        return
+    
+    futures = {}
+    try:
+        job['status'] = 'running'
+        
+        pending = []
+        cached_entries = []
+        for entry in job['files']:
+            if entry['status'] != 'queued':
+                continue
             
-            # Make sure we're not getting an empty or default name
-            if cleaned_filename in ["document.pdf", "", ".pdf"] or cleaned_filename.lower() == "document.pdf":
-                if original_filename and original_filename.lower() != "document.pdf":
-                    # Use the original name but without extension
-                    base_name = os.path.splitext(original_filename)[0]
-                    timestamp = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
-                    cleaned_filename = f"{base_name}_{timestamp}.pdf"
-                    app.logger.info(f"Using modified original filename: {cleaned_filename}")
-                else:
-                    # Generate a completely new name
-                    timestamp = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
-                    cleaned_filename = f"file_{timestamp}.pdf"
-                    app.logger.info(f"Generated unique filename: {cleaned_filename}")
+            input_path, output_path = _job_entry_paths(entry['file_id'])
+            if not os.path.exists(input_path):
+                entry.update({'status': 'error', 'message': 'File not found on server'})
+                _publish_job_entry(job_id, entry)
+                continue
             
-            # Create the display filename with the 'unlocked_' prefix
-            prefixed_filename = f"unlocked_{cleaned_filename}"
-            display_filename = secure_filename(prefixed_filename)
-            app.logger.info(f"Final display filename: {display_filename}")
+            password = passwords.get(entry['file_id'], '')
+            cache_key = result_cache_key(entry['file_id'], input_path, password)
+            if result_cache_checkout(cache_key, output_path):
+                entry.update(_job_entry_result(entry, {'status': 'success'}))
+                _publish_job_entry(job_id, entry)
+                continue
             
-            # Store in processed files for later download
-            output_filename = os.path.basename(output_path)
-            processed_files[output_filename] = display_filename
-            save_processed_files()
+            if entry.get('source') != 'upload':
+                # Only routed by size so far
+                entry['lane'] = upload_lane(entry['file_id'], input_path)
+            lane = entry['lane']
             
-            # Cleanup if file_id is provided
-            if file_id:
-                if file_id in protected_files:
-                    del protected_files[file_id]
-                    
-                # Remove the input file
-                if os.path.exists(input_path):
-                    os.remove(input_path)
+            reader, size, reservation_id = take_cached_reader(entry['file_id'])
+            if reader is not None:
+                # Parsed by /check-password in this process: unlocking it here
+                # is cheaper than parsing it again in a pool process, and the
+                # memory for it is still reserved; it still waits for a slot
+                # in its lane
+                cached_entries.append((entry, reader, size, password, cache_key, reservation_id, lane))
+                continue
             
-            app.logger.info(f"Successfully unlocked PDF: {original_filename}")
-            return {
-                'status': 'success',
-                'filename': display_filename,
-                'download_url': f'/download/{output_filename}'
-            }
-        except Exception as e:
-            app.logger.error(f"Error in standard PyPDF2 approach: {str(e)}")
-            # Fall through to next method for Render
+            cost = estimate_memory_cost(input_path, entry['file_id'])
+            pending.append((entry, input_path, output_path, password, cache_key, cost, lane))
         
-        # If we're on Render, try one more approach for compatibility
-        if IS_RENDER:
-            app.logger.info("Attempting Render fallback approach")
-            try:
-                # Try with alternative approach using file-based password
-                password_file = os.path.join(app.config['DATA_FOLDER'], f"pwd_{uuid.uuid4()}.txt")
-                with open(password_file, 'w') as f:
-                    f.write(password)
-                
-                # Read the password from file
-                with open(password_file, 'r') as f:
-                    file_pwd = f.read().strip()
-                
-                app.logger.info(f"Password read from file: {file_pwd}")
-                reader = PdfReader(input_path, password=file_pwd)
-                
-                if reader.is_encrypted:
-                    # Try to decrypt
-                    decrypt_result = reader.decrypt(file_pwd)
-                    app.logger.info(f"Decrypt result from file-read password: {decrypt_result}")
-                    
-                    if decrypt_result <= 0:
-                        app.logger.info("Failed to decrypt with file-read password")
-                        return {
-                            'status': 'error',
-                            'error': 'Incorrect password. Please try again.'
-                        }
-                
-                # Clean up password file
-                if os.path.exists(password_file):
-                    os.remove(password_file)
-                
-                # Write the unlocked PDF
-                writer = PdfWriter()
-                for page in reader.pages:
-                    writer.add_page(page)
-                    
-                with open(output_path, 'wb') as f:
-                    writer.write(f)
+        save_job(job)
+        
+        # Smallest first, so that the quickest results are reported first
+        cached_entries.sort(key=lambda item: item[2])
+        
+        while pending or futures or cached_entries:
+            # Hand the pools every file whose lane has a free slot and whose
+            # memory fits in the budget; the others stay queued until running
+            # ones finish, without holding up files of the other lane
+            for item in list(pending):
+                entry, input_path, output_path, password, cache_key, cost, lane = item
+                slot = acquire_lane_slot(lane)
+                if slot is None:
+                    continue
+                reservation_id = reserve_memory(cost)
+                if reservation_id is None:
+                    release_lane_slot(slot)
+                    continue
+                pending.remove(item)
+                entry['status'] = 'processing'
+                future = submit_pdf_work(*pdf_task(job, entry, _unlock_pdf_file, input_path, output_path, password),
+                                         lane=lane)
+                futures[future] = (entry, cache_key, reservation_id, slot, lane)
+            save_job(job)
+            
+            # Unlock a file with a cached reader in this thread while the
+            # pools work on the rest, then collect whatever they finished;
+            # files whose lane has no free slot stay queued like the others
+            cached_item = slot = None
+            for item in cached_entries:
+                slot = acquire_lane_slot(item[6])
+                if slot is not None:
+                    cached_item = item
+                    break
+            
+            if cached_item is not None:
+                cached_entries.remove(cached_item)
+                entry, reader, size, password, cache_key, reservation_id, _ = cached_item
+                entry['status'] = 'processing'
+                save_job(job)
+                input_path, output_path = _job_entry_paths(entry['file_id'])
+                try:
+                    unlock_result = run_cpu_bound(_unlock_pdf_file, input_path, output_path, password, reader=reader)
+                except Exception as e:
+                    unlock_result = {'status': 'error', 'error': f'An error occurred: {str(e)}'}
+                finally:
+                    release_lane_slot(slot)
+                if unlock_result.get('needs_password'):
+                    # Keep the reader, and its memory, for the next attempt
+                    # with another password
+                    cache_reader(entry['file_id'], reader, size, reservation_id)
+                else:
+                    release_memory(reservation_id)
+                entry.update(_job_entry_result(entry, unlock_result, cache_key))
+                save_job(job)
+                _publish_job_entry(job_id, entry)
+                timeout = 0
+            elif not futures:
+                # The slots or the budget are taken by other workers
+                time.sleep(ADMISSION_POLL_INTERVAL)
+                continue
+            else:
+                timeout = ADMISSION_POLL_INTERVAL if pending or cached_entries else None
+            
+            done, _ = wait(futures, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                entry, cache_key, reservation_id, slot, lane = futures.pop(future)
+                release_memory(reservation_id)
+                release_lane_slot(slot)
+                try:
+                    unlock_result = future.result()
+                except BrokenProcessPool as e:
+                    # A PDF worker died (e.g. killed for using too much memory)
+                    _reset_pdf_pool(lane)
+                    unlock_result = {'status': 'error', 'error': f'An error occurred: {str(e)}'}
+                except Exception as e:
+                    unlock_result = {'status': 'error', 'error': f'An error occurred: {str(e)}'}
                 
-                # Verify output
-                if os.path.exists(output_path) and os.path.getsize(output_path) > 0:
-                    verify_reader = PdfReader(output_path)
-                    if not verify_reader.is_encrypted:
-                        app.logger.info("Render fallback method succeeded")
-                        
-                        # Get original filename if file_id is provided
-                        original_filename = "document.pdf"
-                        if file_id and file_id in protected_files:
-                            original_filename = protected_files.get(file_id, "document.pdf")
-                            app.logger.info(f"Retrieved original filename for file_id {file_id}: {original_filename}")
-                        else:
-                            # If we don't have an original filename, try to create a unique one
-                            timestamp = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
-                            original_filename = f"file_{timestamp}.pdf"
-                            app.logger.info(f"No original filename found, generated: {original_filename}")
-                            
-                        # Process filenames
-                        cleaned_filename = clean_filename(original_filename, file_id)
-                        prefixed_filename = f"unlocked_{cleaned_filename}"
-                        display_filename = secure_filename(prefixed_filename)
-                        
-                        app.logger.info(f"Display filename after cleaning: {display_filename}")
-                        
-                        # Store in processed files
-                        output_filename = os.path.basename(output_path)
-                        processed_files[output_filename] = display_filename
-                        save_processed_files()
-                        
-                        # Cleanup if file_id is provided
-                        if file_id:
-                            if file_id in protected_files:
-                                del protected_files[file_id]
-                                
-                            # Remove the input file
-                            if os.path.exists(input_path):
-                                os.remove(input_path)
-                        
-                        return {
-                            'status': 'success',
-                            'filename': display_filename,
-                            'download_url': f'/download/{output_filename}'
-                        }
-            except Exception as render_error:
-                app.logger.error(f"Render fallback error: {str(render_error)}")
+                entry.update(_job_entry_result(entry, unlock_result, cache_key))
+                save_job(job)
+                _publish_job_entry(job_id, entry)
         
-        # If we get here, all approaches failed
-        return {
-            'status': 'error',
-            'error': 'Failed to unlock PDF. Please check your password and try again.'
-        }
+        job['status'] = 'completed'
+        app.logger.info("Unlock job %s completed: %s", job_id, _job_counts(job))
     except Exception as e:
-        app.logger.error(f"Error in unlock_pdf: {str(e)}")
+        app.logger.error("Unlock job %s failed: %s", job_id, e)
+        job['status'] = 'failed'
+        job['error'] = str(e)
+        for _, _, reservation_id, slot, _ in futures.values():
+            release_memory(reservation_id)
+            release_lane_slot(slot)
+        for item in cached_entries:
+            release_memory(item[5])
+        for entry in job['files']:
+            if entry['status'] in ('queued', 'processing'):
+                entry['status'] = 'error'
+                entry['message'] = f'Error: {str(e)}'
+    
+    save_job(job)
+    owned_jobs.discard(job_id)
+    _publish_job_entry(job_id, None)
+    for status, count in _job_counts(job).items():
+        count_file_result(status, count)
+
+def _upload_job_entry(upload):
+    """Return the job entry for a file saved by ingest_uploads()."""
+    if upload['error']:
         return {
+            'filename': upload['filename'],
+            'source': 'upload',
             'status': 'error',
-            'error': f'An error occurred: {str(e)}'
+            'message': upload['error']
         }
+    
+    # Generate a secure filename to prevent directory traversal attacks
+    file_id = upload['file_id']
+    original_filename = secure_filename(upload['filename'])
+    
+    # Store original filename for later processing
+    protected_files.put(file_id, original_filename, size=upload['size'], sha256=upload['sha256'])
+    app.logger.debug("Stored original filename for file_id %s: %s", file_id, original_filename, extra={'event': 'upload_name'})
+    
+    return {
+        'file_id': file_id,
+        'filename': upload['filename'],
+        'source': 'upload',
+        'status': 'queued',
+        'lane': upload['lane']
+    }
 
-# Helper function to clean up temporary files
-def _cleanup_temp_files(file_paths):
-    for file_path in file_paths:
-        try:
-            if os.path.exists(file_path):
-                os.remove(file_path)
-                app.logger.debug(f"Removed temporary file: {file_path}")
-        except Exception as e:
-            app.logger.error(f"Failed to remove temporary file {file_path}: {str(e)}")
+def _existing_job_entry(file_id):
+    """Return the job entry for a file uploaded by an earlier request."""
+    # Route by size and, if this process saved the upload, its page count;
+    # the job pre-scans the others before processing them
+    try:
+        input_path, _ = _job_entry_paths(file_id)
+        lane = choose_lane(os.path.getsize(input_path), upload_pages.get(file_id, 0))
+    except (OSError, ValueError):
+        lane = 'fast'
+    
+    return {
+        'file_id': file_id,
+        'filename': protected_files.get(file_id, "document.pdf"),
+        'source': 'existing',
+        'status': 'queued',
+        'lane': lane
+    }
 
-@app.route('/')
-def index():
-    return render_template('index.html')
+def start_unlock_job(job_files, passwords=None, job_id=None):
+    """
+    Save a new unlock job and queue it on this process's job threads.
+    
+    Args:
+        job_files (list): The job's file entries
+        passwords (dict, optional): Password to try per file ID
+        job_id (str, optional): ID to give the job, a new UUID by default
+        
+    Returns:
+        str: The job ID
+    """
+    job_id = job_id or str(uuid.uuid4())
+    job = {
+        'job_id': job_id,
+        'status': 'queued',
+        'created_at': time.time(),
+        'owner_pid': os.getpid(),
+        'files': job_files
+    }
+    # Numbered so that clients polling the job can tell which files are new
+    for index, entry in enumerate(job_files):
+        entry['index'] = index
+    if g.get('profile_id'):
+        # Profile the job's PDF work together with this request
+        job['profile_id'] = g.profile_id
+    _own_job(job_id)
+    save_job(job)
+    
+    lane = 'slow' if any(entry.get('lane') == 'slow' for entry in job_files) else 'fast'
+    job_executors[lane].submit(run_unlock_job, job_id, passwords)
+    app.logger.info("Queued unlock job %s with %s files in the %s lane", job_id, len(job_files), lane)
+    return job_id
 
 @app.route('/unlock', methods=['POST'])
 def unlock():
+    """
+    Accept a batch of files to unlock and process it in the background.
+    
+    The files are saved and queued right away; the response contains a job ID
+    whose per-file progress and download URLs are reported by /jobs/<job_id>.
+    """
     global protected_files
     
-    results = []
+    job_files = []
+    
+    # Stream the uploads to disk, dropping anything that is not a whole PDF
+    uploads, form = ingest_uploads('files[]')
+    if uploads is None:
+        uploads, form = [], request.form.to_dict(flat=False)
     
     # Trường hợp 1: Xử lý files[] - các file mới được tải lên
-    if 'files[]' in request.files:
-        files = request.files.getlist('files[]')
-        
-        for file in files:
-            if file and allowed_file(file.filename):
-                # Generate a secure filename to prevent directory traversal attacks
-                original_filename = secure_filename(file.filename)
-                
-                # Generate a unique ID for this file
-                file_id = str(uuid.uuid4())
-                
-                # Save the file with the unique ID as the filename
-                input_path = os.path.join(app.config['UPLOAD_FOLDER'], file_id)
-                file.save(input_path)
-                
-                # Store original filename for later processing
-                protected_files[file_id] = original_filename
-                app.logger.info(f"Stored original filename for file_id {file_id}: {original_filename}")
-                
-                # Create the output filename and path
-                output_filename = f"unlocked_{file_id}"
-                output_path = os.path.join(app.config['PROCESSED_FOLDER'], output_filename)
-                
-                # Try to unlock the PDF
-                try:
-                    # First check if the file is a valid PDF
-                    try:
-                        reader = PdfReader(input_path)
-                        
-                        # Check if the PDF is password-protected
-                        if reader.is_encrypted:
-                            # Try with empty password first
-                            decrypt_result = reader.decrypt('')
-                            
-                            # If decrypt_result > 0, file can be opened without password
-                            if decrypt_result <= 0:
-                                app.logger.info(f"PDF requires password: {original_filename}")
-                                # Return info that password is needed
-                                results.append({
-                                    'file_id': file_id,
-                                    'filename': file.filename,
-                                    'status': 'needs_password',
-                                    'message': 'This PDF is password protected'
-                                })
-                                continue
-                            
-                    except Exception as e:
-                        if "password" in str(e).lower():
-                            app.logger.info(f"PDF requires password: {original_filename}")
-                            # Return info that password is needed
-                            results.append({
-                                'file_id': file_id,
-                                'filename': file.filename,
-                                'status': 'needs_password',
-                                'message': 'This PDF is password protected'
-                            })
-                            continue
-                        else:
-                            # Not a password issue, might be a corrupt file
-                            app.logger.error(f"Error reading PDF: {str(e)}")
-                            results.append({
-                                'file_id': file_id,
-                                'filename': file.filename,
-                                'status': 'error',
-                                'message': f'Error: {str(e)}'
-                            })
-                            
-                            # Clean up the file
-                            if os.path.exists(input_path):
-                                os.remove(input_path)
-                            if file_id in protected_files:
-                                del protected_files[file_id]
-                                
-                            continue
-                    
-                    # If we get here, the PDF is not password-protected, try to unlock
-                    unlock_result = unlock_pdf(input_path, output_path, password='', file_id=file_id)
-                    
-                    if unlock_result['status'] == 'success':
-                        app.logger.info(f"Successfully unlocked PDF: {original_filename}")
-                        # Get the file info
-                        display_filename = unlock_result['filename']
-                        download_url = unlock_result['download_url']
-                        
-                        results.append({
-                            'filename': display_filename, 
-                            'status': 'success',
-                            'download_url': download_url
-                        })
-                    else:
-                        app.logger.warning(f"Failed to unlock PDF: {original_filename}")
-                        # Failed to unlock, add to results
-                        results.append({
-                            'file_id': file_id,
-                            'filename': file.filename,
-                            'status': 'error',
-                            'message': unlock_result['error']
-                        })
-                except Exception as e:
-                    app.logger.error(f"General error processing PDF: {str(e)}")
-                    results.append({
-                        'filename': file.filename,
-                        'status': 'error',
-                        'message': f'Error: {str(e)}'
-                    })
-                    
-                    # Clean up the file
-                    if os.path.exists(input_path):
-                        os.remove(input_path)
-                    if file_id in protected_files:
-                        del protected_files[file_id]
-            else:
-                # Invalid file type
-                results.append({
-                    'filename': file.filename if file else 'Unknown file',
-                    'status': 'error',
-                    'message': 'Invalid file type. Only PDF files are accepted.'
-                })
+    for upload in uploads:
+        job_files.append(_upload_job_entry(upload))
+    
+    if uploads:
+        enforce_storage_budget()
     
     # Trường hợp 2: Xử lý file_ids[] - các file đã được tải lên trước đó
-    if 'file_ids[]' in request.form:
-        file_ids = request.form.getlist('file_ids[]')
-        
-        for file_id in file_ids:
-            # Get the input path
-            input_path = os.path.join(app.config['UPLOAD_FOLDER'], file_id)
+    if 'file_ids[]' in form:
+        for file_id in form['file_ids[]']:
+            job_files.append(_existing_job_entry(file_id))
+    
+    if not job_files:
+        return jsonify({'status': 'error', 'message': 'No files were processed'}), 400
+    
+    job_id = start_unlock_job(job_files)
+    
+    return jsonify({
+        'status': 'queued',
+        'job_id': job_id,
+        'status_url': f'/jobs/{job_id}',
+        'files': job_files
+    }), 202
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    """Report the status, per-file results and download URLs of an unlock job."""
+    job = load_job(job_id)
+    
+    if job is None:
+        return jsonify({'status': 'error', 'error': 'Job not found'}), 404
+    
+    return jsonify({
+        'job_id': job['job_id'],
+        'status': job['status'],
+        'finished': job['status'] in JOB_FINISHED_STATUSES,
+        'created_at': job['created_at'],
+        'updated_at': job.get('updated_at'),
+        'counts': _job_counts(job),
+        'files': job['files'],
+        'error': job.get('error')
+    })
+
+# Seconds between two looks at the progress files by a /progress stream
+PROGRESS_POLL_INTERVAL = float(os.environ.get('PROGRESS_POLL_INTERVAL', 0.5))
+
+# A /progress stream ends after this many seconds without any news. It sends
+# a comment line after PROGRESS_KEEPALIVE quiet seconds, which keeps proxies
+# from closing it and lets it notice a client that has gone away
+PROGRESS_IDLE_TIMEOUT = int(os.environ.get('PROGRESS_IDLE_TIMEOUT', 120))
+PROGRESS_KEEPALIVE = 5
+
+def _sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+@app.route('/progress/<progress_id>', methods=['GET'])
+def progress_events(progress_id):
+    """
+    Stream the progress of a file, or of every file of a job, as Server-Sent Events.
+    
+    "progress" events carry a file's stage (parsing, decrypting, copying,
+    writing, verifying, finished), how many of its objects or pages are done
+    and the bytes written so far. A file's stream ends with its "finished"
+    stage; a job's stream also sends a "file" event with every result and
+    ends with a "done" event. Open the stream before starting the unlock so
+    that no stage is missed.
+    
+    The unlocks record their progress at most every PROGRESS_INTERVAL and the
+    stream reads it every PROGRESS_POLL_INTERVAL, so following a file costs
+    the same however large it is. On sync workers a stream holds a whole
+    worker, so it ends with a "timeout" event after JOB_STREAM_MAX_SECONDS;
+    there the page polls /progress/<progress_id>/state instead.
+    """
+    if not _is_valid_job_id(progress_id):
+        return jsonify({'status': 'error', 'error': 'Invalid ID'}), 404
+    is_job = load_job(progress_id) is not None
+    opened_at = time.time()
+    
+    def stream():
+        yield 'retry: 2000\n\n'
+        seen = {}
+        reported = set()
+        last_news = last_sent = time.monotonic()
+        deadline = None if ASYNC_MODE else last_news + JOB_STREAM_MAX_SECONDS
+        while True:
+            job = load_job(progress_id) if is_job else None
+            file_ids = [entry['file_id'] for entry in job['files'] if entry.get('file_id')] if job else [progress_id]
             
-            if not os.path.exists(input_path):
-                results.append({
-                    'file_id': file_id,
-                    'status': 'error',
-                    'message': 'File not found on server'
-                })
-                continue
-                
-            # Get original filename
-            original_filename = protected_files.get(file_id, "document.pdf")
-            app.logger.info(f"Processing existing file with ID {file_id}, original name: {original_filename}")
+            for file_id in file_ids:
+                state = read_progress(file_id)
+                if state is None or state['updated_at'] == seen.get(file_id):
+                    continue
+                seen[file_id] = state['updated_at']
+                if state['stage'] == 'finished' and state['updated_at'] < opened_at:
+                    # Left by an earlier attempt, e.g. with a wrong password
+                    continue
+                last_news = last_sent = time.monotonic()
+                yield _sse_event('progress', state)
+                if not is_job and state['stage'] == 'finished':
+                    return
             
-            # Create output path
-            output_filename = f"unlocked_{file_id}"
-            output_path = os.path.join(app.config['PROCESSED_FOLDER'], output_filename)
+            if job is not None:
+                for index, entry in enumerate(job['files']):
+                    if index not in reported and entry['status'] not in ('queued', 'processing'):
+                        reported.add(index)
+                        last_news = last_sent = time.monotonic()
+                        yield _sse_event('file', entry)
+                if job['status'] in JOB_FINISHED_STATUSES:
+                    yield _sse_event('done', {'job_id': progress_id, 'status': job['status'],
+                                              'counts': _job_counts(job)})
+                    return
             
-            # Try to unlock the file
-            try:
-                unlock_result = unlock_pdf(input_path, output_path, password='', file_id=file_id)
-                
-                if unlock_result['status'] == 'success':
-                    app.logger.info(f"Successfully unlocked PDF with ID: {file_id}")
-                    # Get the file info
-                    display_filename = unlock_result['filename']
-                    download_url = unlock_result['download_url']
-                    
-                    results.append({
-                        'file_id': file_id,
-                        'filename': display_filename, 
-                        'status': 'success',
-                        'download_url': download_url
-                    })
-                else:
-                    app.logger.warning(f"Failed to unlock PDF with ID: {file_id}")
-                    # Check if the error message indicates a password is needed
-                    if 'password' in unlock_result['error'].lower():
-                        results.append({
-                            'file_id': file_id,
-                            'filename': original_filename,
-                            'status': 'needs_password',
-                            'message': 'This PDF is password protected'
-                        })
-                    else:
-                        # Failed to unlock, add to results
-                        results.append({
-                            'file_id': file_id,
-                            'filename': original_filename,
-                            'status': 'error',
-                            'message': unlock_result['error']
-                        })
-            except Exception as e:
-                app.logger.error(f"General error processing PDF with ID {file_id}: {str(e)}")
-                results.append({
-                    'file_id': file_id,
-                    'status': 'error',
-                    'message': f'Error: {str(e)}'
-                })
+            now = time.monotonic()
+            if now - last_news >= PROGRESS_IDLE_TIMEOUT or (deadline is not None and now >= deadline):
+                yield _sse_event('timeout', {'idle_seconds': round(now - last_news)})
+                return
+            if now - last_sent >= PROGRESS_KEEPALIVE:
+                last_sent = now
+                yield ': keep-alive\n\n'
+            time.sleep(PROGRESS_POLL_INTERVAL)
+    
+    response = Response(stream(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+@app.route('/progress/<progress_id>/state', methods=['GET'])
+def progress_state(progress_id):
+    """
+    Report the last recorded progress of a file, or of every file of a job, as JSON.
+    
+    The polling counterpart of /progress/<progress_id> for sync workers,
+    where an open stream would hold a worker: each poll is one short request.
+    A file's "finished" stage may be left from an earlier attempt.
+    """
+    if not _is_valid_job_id(progress_id):
+        return jsonify({'status': 'error', 'error': 'Invalid ID'}), 404
+    
+    job = load_job(progress_id)
+    file_ids = [entry['file_id'] for entry in job['files'] if entry.get('file_id')] if job else [progress_id]
+    states = [state for state in map(read_progress, file_ids) if state is not None]
+    return jsonify({
+        'progress': states,
+        'finished': job is not None and job['status'] in JOB_FINISHED_STATUSES
+    })
+
+def _batch_manifest():
+    """
+    Read the files and passwords of an /unlock-batch request.
+    
+    Returns:
+        tuple: (list of upload dicts from ingest_uploads(), manifest list) or
+               (uploads, None) if the manifest is not a JSON list
+    """
+    uploads, form = ingest_uploads('files[]')
+    if uploads is None:
+        data = request.get_json(silent=True) or {}
+        return [], data.get('files') if isinstance(data, dict) else None
+    
+    try:
+        manifest = json.loads(form.get('manifest', ['[]'])[0])
+    except ValueError:
+        manifest = None
+    return uploads, manifest
+
+@app.route('/unlock-batch', methods=['POST'])
+def unlock_batch():
+    """
+    Unlock a batch of files, each with its own password, streaming the results.
+    
+    Takes JSON {"files": [{"file_id": ..., "password": ...}]} for files that
+    are already uploaded, or a multipart form with files[] uploads and a
+    "manifest" field holding that same list as JSON, where an item may name
+    the n-th upload with {"upload": n, "password": ...} instead of a file_id.
+    The files are unlocked in parallel like an /unlock job, and the response
+    is NDJSON: a "job" line, one "file" line per file as soon as it is done,
+    then a "done" line with the counts. The job also reports through
+    /jobs/<job_id>, so a client that loses the stream can poll it instead.
+    
+    On sync workers the stream holds a whole worker, so it is cut off after
+    JOB_STREAM_MAX_SECONDS with a "poll" line; the page then follows the job
+    through /jobs/<job_id>. With sync workers the page only sends batches
+    with passwords here, and batches without any to /unlock.
+    """
+    uploads, manifest = _batch_manifest()
+    if not isinstance(manifest, list):
+        for upload in uploads:
+            if upload['file_id']:
+                _remove_upload(upload['file_id'])
+        return jsonify({'status': 'error', 'message': 'The manifest must be a JSON list'}), 400
+    
+    job_files = [_upload_job_entry(upload) for upload in uploads]
+    if uploads:
+        enforce_storage_budget()
+    
+    # Passwords stay out of the job entries, so they are never written to disk
+    passwords = {}
+    seen = {entry['file_id'] for entry in job_files if 'file_id' in entry}
+    for item in manifest:
+        item = item if isinstance(item, dict) else {}
+        password = item.get('password') or ''
+        if not isinstance(password, str):
+            password = ''
+        
+        upload_index = item.get('upload')
+        if isinstance(upload_index, int) and 0 <= upload_index < len(uploads):
+            if uploads[upload_index]['file_id']:
+                passwords[uploads[upload_index]['file_id']] = password
+            continue
+        
+        file_id = item.get('file_id')
+        if not isinstance(file_id, str) or not _is_valid_job_id(file_id) or file_id in seen:
+            job_files.append({
+                'file_id': file_id if isinstance(file_id, str) else None,
+                'status': 'error',
+                'message': 'Invalid or duplicate file ID'
+            })
+            continue
+        seen.add(file_id)
+        passwords[file_id] = password
+        job_files.append(_existing_job_entry(file_id))
     
-    if not results:
+    if not job_files:
         return jsonify({'status': 'error', 'message': 'No files were processed'}), 400
     
-    return jsonify(results)
+    # Listen before the job starts so no result is missed
+    listener = queue.Queue()
+    job_id = str(uuid.uuid4())
+    job_listeners[job_id] = listener
+    start_unlock_job(job_files, passwords, job_id=job_id)
+    
+    def stream():
+        yield json.dumps({'type': 'job', 'job_id': job_id, 'status_url': f'/jobs/{job_id}',
+                          'files': len(job_files)}) + '\n'
+        deadline = None if ASYNC_MODE else time.monotonic() + JOB_STREAM_MAX_SECONDS
+        sent = set()
+        for entry in job_files:
+            if entry['status'] == 'error':
+                sent.add(entry['index'])
+                yield json.dumps(dict(entry, type='file')) + '\n'
+        
+        while True:
+            if deadline is not None and time.monotonic() >= deadline:
+                yield json.dumps({'type': 'poll', 'job_id': job_id, 'status_url': f'/jobs/{job_id}'}) + '\n'
+                return
+            timeout = JOB_STREAM_POLL_INTERVAL
+            if deadline is not None:
+                timeout = max(min(timeout, deadline - time.monotonic()), 0)
+            try:
+                entry = listener.get(timeout=timeout)
+            except queue.Empty:
+                # The job's thread publishes None when it is done; this only
+                # guards against a job that never ran
+                job = load_job(job_id)
+                if job is None or job['status'] in JOB_FINISHED_STATUSES:
+                    break
+                continue
+            if entry is None:
+                break
+            if entry['index'] not in sent:
+                sent.add(entry['index'])
+                yield json.dumps(dict(entry, type='file')) + '\n'
+        
+        job = load_job(job_id) or {'status': 'failed', 'files': []}
+        for entry in job['files']:
+            if entry['index'] not in sent:
+                yield json.dumps(dict(entry, type='file')) + '\n'
+        yield json.dumps({'type': 'done', 'job_id': job_id, 'status': job['status'],
+                          'counts': _job_counts(job), 'error': job.get('error')}) + '\n'
+    
+    response = Response(stream(), mimetype='application/x-ndjson')
+    # Runs whether or not the client read the stream to the end
+    response.call_on_close(lambda: job_listeners.pop(job_id, None))
+    # Ask proxies to pass every line on as it is written
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
 
 @app.route('/unlock-with-password', methods=['POST'])
 def unlock_with_password():
@@ -796,11 +3582,33 @@ def unlock_with_password():
     # Get the original filename
     original_filename = protected_files.get(file_id, f"document_{file_id[:8]}.pdf")
     
-    app.logger.info(f"Original filename from protected_files for file_id {file_id}: {original_filename}")
+    app.logger.debug("Original filename from protected_files for file_id %s: %s", file_id, original_filename, extra={'event': 'upload_name'})
+    
+    # Wait for a slot in the file's lane so that large files cannot tie up
+    # every worker
+    slot = acquire_lane_slot(upload_lane(file_id, input_path), timeout=ADMISSION_WAIT)
+    if slot is None:
+        return server_busy_response()
+    
+    # Reuse the reader parsed by /check-password if this process has it,
+    # together with the memory reserved for it
+    reader, size, reservation_id = take_cached_reader(file_id)
+    
+    # Parsing the file again needs room in the memory budget
+    if reader is None:
+        reservation_id = admit_memory(estimate_memory_cost(input_path, file_id))
+        if reservation_id is None:
+            release_lane_slot(slot)
+            return server_busy_response()
     
     # Try to unlock the PDF
     try:
-        result = unlock_pdf(input_path, output_path, password, file_id=file_id)
+        result = run_cpu_bound(unlock_pdf, input_path, output_path, password, file_id=file_id, reader=reader)
+        
+        # Wrong password: keep the reader and its memory for the next attempt
+        if reader is not None and result.get('needs_password'):
+            cache_reader(file_id, reader, size, reservation_id)
+            reservation_id = None
         
         if include_debug:
             debug_info['unlock_result'] = result
@@ -810,7 +3618,7 @@ def unlock_with_password():
             display_filename = result.get('filename')
             download_url = result.get('download_url')
             
-            app.logger.info(f"Successfully unlocked with password, display filename: {display_filename}")
+            app.logger.info("Successfully unlocked with password, display filename: %s", display_filename)
             
             return jsonify({
                 'status': 'success',
@@ -827,7 +3635,7 @@ def unlock_with_password():
                 'debug_info': debug_info if include_debug else None
             })
     except Exception as e:
-        app.logger.error(f"Exception in unlock_with_password: {str(e)}")
+        app.logger.error("Exception in unlock_with_password: %s", e)
         traceback_str = traceback.format_exc()
         
         if include_debug:
@@ -839,25 +3647,106 @@ def unlock_with_password():
             'error': f"An error occurred: {str(e)}",
             'debug_info': debug_info if include_debug else None
         })
+    finally:
+        release_memory(reservation_id)
+        release_lane_slot(slot)
+
+# Who sends the bytes of a download:
+# 'off' streams them from this worker with send_file;
+# 'x-accel' answers with an X-Accel-Redirect to DOWNLOAD_ACCEL_PREFIX for nginx
+# to serve (see nginx.conf); 'x-sendfile' answers with the file's path in an
+# X-Sendfile header, for Apache mod_xsendfile or lighttpd. The proxy then
+# answers Range and conditional requests itself, and the worker is free as
+# soon as it has sent the headers
+DOWNLOAD_OFFLOAD = os.environ.get('DOWNLOAD_OFFLOAD', 'off')
+# Internal nginx location mapped to the processed folder
+DOWNLOAD_ACCEL_PREFIX = os.environ.get('DOWNLOAD_ACCEL_PREFIX', '/protected-downloads/')
+# Seconds an offloaded file is kept from eviction: the worker's download lock
+# ends with its response, before the proxy has opened the file
+DOWNLOAD_OFFLOAD_GRACE = int(os.environ.get('DOWNLOAD_OFFLOAD_GRACE', 30))
+
+def _download_etag(stat_result):
+    """
+    Strong ETag of a processed file.
+    
+    Unlocked files and archives are written once and never changed in place,
+    so the inode, size and modification time identify their bytes.
+    """
+    return f"{stat_result.st_ino:x}-{stat_result.st_size:x}-{stat_result.st_mtime_ns:x}"
+
+def send_download(held_file, file_path, download_name):
+    """
+    Send a processed file as an attachment and release its download lock.
+    
+    With DOWNLOAD_OFFLOAD the response only tells the proxy which file to
+    send. Otherwise send_file streams it, answering Range requests with 206
+    and If-None-Match, If-Modified-Since and If-Range with the strong ETag
+    and modification time, so resumed and repeated downloads only get the
+    bytes they are missing.
+    
+    Args:
+        held_file: The file as returned by open_for_download()
+        file_path (str): Path of the file in the processed folder
+        download_name (str): File name the browser saves it under
+        
+    Returns:
+        Response: The download response
+    """
+    try:
+        stat_result = os.fstat(held_file.fileno())
+        
+        if DOWNLOAD_OFFLOAD != 'off':
+            response = werkzeug_send_file(file_path, request.environ, as_attachment=True,
+                                          download_name=download_name, use_x_sendfile=True,
+                                          conditional=False, etag=False, response_class=app.response_class)
+            # No body follows, whatever size the file has
+            del response.headers['Content-Length']
+            if DOWNLOAD_OFFLOAD == 'x-accel':
+                relative_path = os.path.relpath(file_path, app.config['PROCESSED_FOLDER'])
+                response.headers['X-Accel-Redirect'] = DOWNLOAD_ACCEL_PREFIX + quote(relative_path)
+                del response.headers['X-Sendfile']
+            # Start the grace period that stands in for the lock
+            os.utime(file_path, ns=(time.time_ns(), stat_result.st_mtime_ns))
+            release_download(held_file)
+            BYTES_OUT.inc(stat_result.st_size)
+            return response
+        
+        response = send_file(file_path, as_attachment=True, download_name=download_name,
+                             conditional=True, etag=_download_etag(stat_result),
+                             last_modified=stat_result.st_mtime)
+    except RequestedRangeNotSatisfiable as e:
+        release_download(held_file)
+        return e.get_response()
+    except Exception:
+        release_download(held_file)
+        raise
+    
+    response.call_on_close(lambda: release_download(held_file))
+    if response.status_code in (200, 206):
+        BYTES_OUT.inc(response.content_length or 0)
+    return response
 
 @app.route('/download/<filename>')
 def download(filename):
     try:
         file_path = os.path.join(app.config['PROCESSED_FOLDER'], filename)
         
-        if not os.path.exists(file_path):
+        # Keep the file from being evicted until it has been sent
+        held_file = open_for_download(file_path)
+        if held_file is None:
             return jsonify({'error': f'File not found: {file_path}'}), 404
+        record_download(filename, file_path)
         
         # Extract the file_id from the filename if possible
         file_id = None
         if filename.startswith("unlocked_"):
             file_id = filename[9:]  # Extract the UUID part
         
-        app.logger.info(f"Download requested for: {filename}, extracted file_id: {file_id}")
+        app.logger.debug("Download requested for: %s, extracted file_id: %s", filename, file_id, extra={'event': 'download_name'})
         
         # Get the display filename from our tracking dictionary
         display_filename = processed_files.get(filename, filename)
-        app.logger.info(f"Display filename from processed_files: {display_filename}")
+        app.logger.debug("Display filename from processed_files: %s", display_filename, extra={'event': 'download_name'})
         
         # Get just the base filename without the 'unlocked_' prefix if it exists
         if display_filename.startswith("unlocked_"):
@@ -870,12 +3759,12 @@ def download(filename):
             # Try to get the original filename from protected_files if file_id is available
             if file_id and file_id in protected_files:
                 original_name = protected_files.get(file_id)
-                app.logger.info(f"Found original filename in protected_files: {original_name}")
+                app.logger.debug("Found original filename in protected_files: %s", original_name, extra={'event': 'download_name'})
                 
                 # Clean up original name
                 if original_name:
                     base_filename = clean_filename(original_name, file_id)
-                    app.logger.info(f"Using original filename for download: {base_filename}")
+                    app.logger.debug("Using original filename for download: %s", base_filename, extra={'event': 'download_name'})
             
             # If we still don't have a good name, generate a unique one
             if base_filename in ["document.pdf", ".pdf", ""] or base_filename.startswith("document_"):
@@ -885,112 +3774,211 @@ def download(filename):
                     base_filename = f"file_{file_id[:8]}_{timestamp}.pdf"
                 else:
                     base_filename = f"file_{timestamp}.pdf"
-                app.logger.info(f"Generated new base filename: {base_filename}")
+                app.logger.debug("Generated new base filename: %s", base_filename, extra={'event': 'download_name'})
         
         # Create the final download filename with the 'unlocked_' prefix
         final_filename = f"unlocked_{base_filename}"
-        app.logger.info(f"Final download filename: {final_filename}")
+        app.logger.debug("Final download filename: %s", final_filename, extra={'event': 'download_name'})
         
         # Create the response with the properly named file
-        response = send_file(
-            file_path,
-            as_attachment=True,
-            download_name=final_filename
-        )
+        return send_download(held_file, file_path, final_filename)
+    except Exception as e:
+        app.logger.error("Download error: %s", e)
+        return jsonify({'error': str(e)}), 404
+
+# Compression for /download-all members: 'auto' deflates only members that
+# shrink when a sample is compressed, 'stored' and 'deflated' force one method
+ZIP_COMPRESSION = os.environ.get('ZIP_COMPRESSION', 'auto')
+
+# Bytes sampled from each member to decide whether deflating it pays off
+ZIP_SAMPLE_SIZE = 64 * 1024
+
+class _ZipStream:
+    """Write-only file object that hands what ZipFile writes to a generator."""
+    
+    def __init__(self):
+        self.chunks = []
+    
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+    
+    def flush(self):
+        pass
+    
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+def _zip_compress_type(file_path):
+    """Pick STORED or DEFLATED for a ZIP member based on ZIP_COMPRESSION."""
+    if ZIP_COMPRESSION == 'stored':
+        return zipfile.ZIP_STORED
+    if ZIP_COMPRESSION == 'deflated':
+        return zipfile.ZIP_DEFLATED
+    
+    # Most of an unlocked PDF is already Flate-compressed streams; only
+    # deflate members whose sample shrinks by at least 10% at level 1
+    with open(file_path, 'rb') as f:
+        sample = f.read(ZIP_SAMPLE_SIZE)
+    if sample and len(zlib.compress(sample, 1)) < len(sample) * 0.9:
+        return zipfile.ZIP_DEFLATED
+    return zipfile.ZIP_STORED
+
+def _zip_members(file_urls):
+    """
+    Resolve download URLs to the files and unique names of a ZIP archive.
+    
+    Args:
+        file_urls (list): Download URLs of processed files
+        
+    Returns:
+        list: (file_path, archive filename) tuples for the files that exist
+    """
+    members = []
+    
+    # Keep track of filenames used in the ZIP to prevent duplicates
+    used_filenames = set()
+    
+    for file_url in file_urls:
+        # Extract the filename from the URL
+        filename = file_url.split('/')[-1]
+        file_path = os.path.join(app.config['PROCESSED_FOLDER'], filename)
+        
+        if os.path.exists(file_path):
+            # Extract file_id if possible
+            file_id = None
+            if filename.startswith("unlocked_"):
+                file_id = filename[9:]
+            
+            # Get the display filename for the ZIP archive
+            display_filename = processed_files.get(filename, filename)
+            app.logger.debug("ZIP: Original display filename for %s: %s", filename, display_filename, extra={'event': 'zip_name'})
+            
+            # Get just the base filename without the 'unlocked_' prefix if it exists
+            if display_filename.startswith("unlocked_"):
+                base_filename = display_filename[9:]
+            else:
+                base_filename = display_filename
+            
+            # Try to get original filename from protected_files
+            if file_id and file_id in protected_files:
+                original_name = protected_files.get(file_id)
+                if original_name:
+                    base_filename = clean_filename(original_name, file_id)
+                    app.logger.debug("ZIP: Using original filename: %s", base_filename, extra={'event': 'zip_name'})
+            
+            # Make sure we're not using a generic "document.pdf" filename
+            if base_filename in ["document.pdf", ".pdf", ""] or base_filename.startswith("document_"):
+                # Generate a unique name based on file_id if available
+                timestamp = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
+                if file_id:
+                    base_filename = f"file_{file_id[:8]}_{timestamp}.pdf"
+                else:
+                    base_filename = f"file_{timestamp}_{len(used_filenames)}.pdf"
+                app.logger.debug("ZIP: Generated new base filename: %s", base_filename, extra={'event': 'zip_name'})
+            
+            # Create the final archive filename with the 'unlocked_' prefix
+            final_filename = f"unlocked_{base_filename}"
+            
+            # Check if this name is already used in the ZIP and make it unique if needed
+            if final_filename in used_filenames:
+                name_without_ext = os.path.splitext(final_filename)[0]
+                ext = os.path.splitext(final_filename)[1]
+                counter = 1
+                while final_filename in used_filenames:
+                    final_filename = f"{name_without_ext}_{counter}{ext}"
+                    counter += 1
+            
+            # Record this filename as used
+            used_filenames.add(final_filename)
+            
+            app.logger.debug("ZIP: Final archive filename: %s", final_filename, extra={'event': 'zip_name'})
+            members.append((file_path, final_filename))
+    
+    return members
+
+def stream_zip(members):
+    """
+    Generate a ZIP archive of the given files chunk by chunk.
+    
+    Members are copied in UPLOAD_CHUNK_SIZE pieces and sizes/CRCs go in data
+    descriptors, so memory use does not depend on the size of the archive.
+    
+    Args:
+        members (list): (file_path, archive filename) tuples
         
-        return response
-    except Exception as e:
-        app.logger.error(f"Download error: {str(e)}")
-        return jsonify({'error': str(e)}), 404
+    Yields:
+        bytes: The next piece of the archive
+    """
+    started = time.perf_counter()
+    sink = _ZipStream()
+    with zipfile.ZipFile(sink, 'w') as zf:
+        for file_path, arcname in members:
+            try:
+                zinfo = zipfile.ZipInfo.from_file(file_path, arcname)
+                zinfo.compress_type = _zip_compress_type(file_path)
+                with open(file_path, 'rb') as src, zf.open(zinfo, 'w') as dest:
+                    for chunk in iter(lambda: src.read(UPLOAD_CHUNK_SIZE), b''):
+                        dest.write(chunk)
+                        data = sink.drain()
+                        if data:
+                            BYTES_OUT.inc(len(data))
+                            yield data
+            except FileNotFoundError:
+                # Removed by a cleanup after the archive was started
+                app.logger.warning("ZIP: %s disappeared, skipping it", file_path)
+    
+    # Closing the archive wrote the last data descriptor and the central directory
+    data = sink.drain()
+    BYTES_OUT.inc(len(data))
+    ZIP_BUILD_SECONDS.observe(time.perf_counter() - started)
+    yield data
 
 @app.route('/download-all', methods=['POST'])
 def download_all():
+    """
+    Stream a ZIP archive of processed files as the response.
+    
+    The file URLs come from a form submission (files fields) or a JSON body
+    ({"files": [...]}); the archive is built while it is being sent.
+    """
     try:
         # Get the list of file URLs from the request
-        data = request.json
-        if not data or 'files' not in data or not data['files']:
-            return jsonify({'error': 'No files specified'}), 400
-        
-        file_urls = data['files']
-        memory_file = io.BytesIO()
+        if request.is_json:
+            data = request.get_json(silent=True) or {}
+            file_urls = data.get('files') or []
+        else:
+            file_urls = request.form.getlist('files')
         
-        # Keep track of filenames used in the ZIP to prevent duplicates
-        used_filenames = set()
+        if not file_urls:
+            return jsonify({'error': 'No files specified'}), 400
         
-        # Create a ZIP file in memory
-        with zipfile.ZipFile(memory_file, 'w', zipfile.ZIP_DEFLATED) as zf:
-            for file_url in file_urls:
-                # Extract the filename from the URL
-                filename = file_url.split('/')[-1]
-                file_path = os.path.join(app.config['PROCESSED_FOLDER'], filename)
-                
-                if os.path.exists(file_path):
-                    # Extract file_id if possible
-                    file_id = None
-                    if filename.startswith("unlocked_"):
-                        file_id = filename[9:]
-                    
-                    # Get the display filename for the ZIP archive
-                    display_filename = processed_files.get(filename, filename)
-                    app.logger.info(f"ZIP: Original display filename for {filename}: {display_filename}")
-                    
-                    # Get just the base filename without the 'unlocked_' prefix if it exists
-                    if display_filename.startswith("unlocked_"):
-                        base_filename = display_filename[9:]
-                    else:
-                        base_filename = display_filename
-                    
-                    # Try to get original filename from protected_files
-                    if file_id and file_id in protected_files:
-                        original_name = protected_files.get(file_id)
-                        if original_name:
-                            base_filename = clean_filename(original_name, file_id)
-                            app.logger.info(f"ZIP: Using original filename: {base_filename}")
-                    
-                    # Make sure we're not using a generic "document.pdf" filename
-                    if base_filename in ["document.pdf", ".pdf", ""] or base_filename.startswith("document_"):
-                        # Generate a unique name based on file_id if available
-                        timestamp = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
-                        if file_id:
-                            base_filename = f"file_{file_id[:8]}_{timestamp}.pdf"
-                        else:
-                            base_filename = f"file_{timestamp}_{len(used_filenames)}.pdf"
-                        app.logger.info(f"ZIP: Generated new base filename: {base_filename}")
-                    
-                    # Create the final archive filename with the 'unlocked_' prefix
-                    final_filename = f"unlocked_{base_filename}"
-                    
-                    # Check if this name is already used in the ZIP and make it unique if needed
-                    if final_filename in used_filenames:
-                        name_without_ext = os.path.splitext(final_filename)[0]
-                        ext = os.path.splitext(final_filename)[1]
-                        counter = 1
-                        while final_filename in used_filenames:
-                            final_filename = f"{name_without_ext}_{counter}{ext}"
-                            counter += 1
-                    
-                    # Record this filename as used
-                    used_filenames.add(final_filename)
-                    
-                    app.logger.info(f"ZIP: Final archive filename: {final_filename}")
-                    
-                    # Add the file to the ZIP archive with the proper name
-                    zf.write(file_path, arcname=final_filename)
+        members = _zip_members(file_urls)
         
-        # Create a unique ID for the ZIP file
-        zip_id = str(uuid.uuid4())
-        zip_filename = f"unlocked_pdfs_{zip_id}.zip"
-        zip_path = os.path.join(app.config['PROCESSED_FOLDER'], zip_filename)
+        # Keep every member from being evicted until the archive has been sent
+        held_files = []
+        available = []
+        for file_path, arcname in members:
+            held_file = open_for_download(file_path)
+            if held_file is not None:
+                held_files.append(held_file)
+                available.append((file_path, arcname))
+                record_download(os.path.basename(file_path), file_path)
         
-        # Save the ZIP file
-        memory_file.seek(0)
-        with open(zip_path, 'wb') as f:
-            f.write(memory_file.getvalue())
+        if not available:
+            return jsonify({'error': 'None of the requested files are available'}), 404
         
-        return jsonify({'status': 'success', 'download_url': f'/download-zip/{zip_filename}'})
+        response = Response(stream_zip(available), mimetype='application/zip')
+        response.headers['Content-Disposition'] = 'attachment; filename=unlocked_pdfs.zip'
+        response.headers['Cache-Control'] = 'no-store'
+        for held_file in held_files:
+            response.call_on_close(lambda held_file=held_file: release_download(held_file))
+        return response
     
     except Exception as e:
-        app.logger.error(f"Create ZIP error: {str(e)}")
+        app.logger.error("Create ZIP error: %s", e)
         return jsonify({'error': str(e)}), 500
 
 @app.route('/download-zip/<filename>')
@@ -998,19 +3986,15 @@ def download_zip(filename):
     try:
         zip_path = os.path.join(app.config['PROCESSED_FOLDER'], filename)
         
-        if not os.path.exists(zip_path):
+        # Keep the archive from being evicted until it has been sent
+        held_file = open_for_download(zip_path)
+        if held_file is None:
             return jsonify({'error': f'ZIP file not found: {zip_path}'}), 404
         
         # Return the ZIP file
-        response = send_file(
-            zip_path,
-            as_attachment=True,
-            download_name="unlocked_pdfs.zip"
-        )
-        
-        return response
+        return send_download(held_file, zip_path, "unlocked_pdfs.zip")
     except Exception as e:
-        app.logger.error(f"Download ZIP error: {str(e)}")
+        app.logger.error("Download ZIP error: %s", e)
         return jsonify({'error': str(e)}), 404
 
 @app.route('/clear-processed', methods=['POST'])
@@ -1075,7 +4059,7 @@ def clear_processed():
             errors.append(f"Error saving processed files data: {str(save_error)}")
         
         if errors:
-            app.logger.error(f"Clear processed errors: {', '.join(errors)}")
+            app.logger.error("Clear processed errors: %s", ', '.join(errors))
             return jsonify({
                 'status': 'partial_success',
                 'message': f'Removed {len(removed_files)} files with {len(errors)} errors',
@@ -1087,50 +4071,163 @@ def clear_processed():
             'message': f'Successfully removed {len(removed_files)} files'
         })
     except Exception as e:
-        app.logger.error(f"Clear processed error: {str(e)}")
+        app.logger.error("Clear processed error: %s", e)
         return jsonify({'error': str(e)}), 500
 
 # Cleanup function to periodically remove old files
-@app.route('/cleanup', methods=['GET'])
-def cleanup():
+# Seconds between scans of the upload, processed and jobs folders for files
+# the expiry index does not know about (the only cleanup with METADATA_BACKEND=json)
+CLEANUP_RECONCILE_INTERVAL = int(os.environ.get('CLEANUP_RECONCILE_INTERVAL', 15 * 60))
+
+# Longest the cleanup scheduler sleeps between looking at the expiry index
+CLEANUP_MAX_SLEEP = 60
+
+# Expired entries deleted per query, so a backlog is worked off in batches
+CLEANUP_BATCH_SIZE = 500
+
+# Held with flock by the one process that runs the cleanup scheduler
+CLEANUP_LOCK_FILE = os.path.join(DATA_FOLDER, 'cleanup.lock')
+
+def _remove_upload(filename):
+    """Delete an upload along with everything tracked about it."""
     try:
-        # Remove files older than 1 hour (optional)
-        current_time = time.time()
-        count = 0
-        total_processed = 0
-        total_uploads = 0
-        
-        # Cleanup upload folder
-        for filename in os.listdir(app.config['UPLOAD_FOLDER']):
-            file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-            if os.path.isfile(file_path) and (current_time - os.path.getmtime(file_path)) > 3600:
-                try:
-                    os.remove(file_path)
-                    count += 1
-                    total_uploads += 1
-                    app.logger.info(f"Removed old upload file: {file_path}")
-                    
-                    # Remove from protected_files if it's there
-                    if filename in protected_files:
-                        del protected_files[filename]
-                except Exception as e:
-                    app.logger.error(f"Error removing file {file_path}: {str(e)}")
-                
-        # Cleanup processed folder
-        for filename in os.listdir(app.config['PROCESSED_FOLDER']):
-            file_path = os.path.join(app.config['PROCESSED_FOLDER'], filename)
-            if os.path.isfile(file_path) and (current_time - os.path.getmtime(file_path)) > 3600:
+        os.remove(os.path.join(app.config['UPLOAD_FOLDER'], filename))
+        app.logger.info("Removed old upload file: %s", filename, extra={'event': 'file_removed'})
+    except FileNotFoundError:
+        pass
+    protected_files.pop(filename, None)
+    upload_hashes.pop(filename, None)
+    upload_trailers.pop(filename, None)
+    upload_pages.pop(filename, None)
+    evict_cached_reader(filename)
+    try:
+        os.remove(os.path.join(PROGRESS_FOLDER, f"{filename}.json"))
+    except FileNotFoundError:
+        pass
+
+def _remove_processed(filename):
+    """Delete an unlocked file and its processed_files entry."""
+    try:
+        os.remove(os.path.join(app.config['PROCESSED_FOLDER'], filename))
+        app.logger.info("Removed old processed file: %s", filename, extra={'event': 'file_removed'})
+    except FileNotFoundError:
+        pass
+    processed_files.pop(filename, None)
+
+def expire_due_files(now=None):
+    """
+    Delete the uploads and unlocked files whose expiry time has passed.
+    
+    Only looks at the rows the expires_at index says are due, so the cost
+    does not depend on how many files are kept.
+    
+    Returns:
+        tuple: (uploads removed, processed files removed)
+    """
+    if METADATA_BACKEND != 'sqlite':
+        return 0, 0
+    
+    now = now or time.time()
+    rows = get_metadata_db().execute(
+        'SELECT kind, key FROM files WHERE expires_at <= ? ORDER BY expires_at LIMIT ?',
+        (now, CLEANUP_BATCH_SIZE)).fetchall()
+    
+    uploads = processed = 0
+    for kind, key in rows:
+        try:
+            if kind == 'protected':
+                _remove_upload(key)
+                uploads += 1
+            else:
+                _remove_processed(key)
+                processed += 1
+        except Exception as e:
+            app.logger.error("Error removing expired file %s: %s", key, e)
+    return uploads, processed
+
+def next_expiry():
+    """Return when the next tracked file expires, or None if none are tracked."""
+    if METADATA_BACKEND != 'sqlite':
+        return None
+    return get_metadata_db().execute('SELECT MIN(expires_at) FROM files').fetchone()[0]
+
+def reconcile_folders(max_age=None):
+    """
+    Remove old files that the expiry index does not cover.
+    
+    Catches uploads that never got a metadata row, files left behind by a
+    crash, job records and cached results, and does all the work with the
+    json backend. Uses os.scandir so each file costs one directory entry.
+    
+    Args:
+        max_age (int, optional): Age in seconds after which files are removed,
+                                 FILE_TTL by default
+        
+    Returns:
+        tuple: (uploads removed, processed files removed, other files removed)
+    """
+    max_age = max_age or FILE_TTL
+    cutoff = time.time() - max_age
+    counts = {'protected': 0, 'processed': 0}
+    
+    for kind, folder, tracked, remove in [
+            ('protected', app.config['UPLOAD_FOLDER'], protected_files, _remove_upload),
+            ('processed', app.config['PROCESSED_FOLDER'], processed_files, _remove_processed)]:
+        with os.scandir(folder) as entries:
+            old = [entry.name for entry in entries
+                   if entry.is_file() and entry.stat().st_mtime < cutoff]
+        for filename in old:
+            # Files in the expiry index are removed when their row expires
+            if METADATA_BACKEND == 'sqlite' and filename in tracked:
+                continue
+            try:
+                remove(filename)
+                counts[kind] += 1
+            except Exception as e:
+                app.logger.error("Error removing file %s: %s", filename, e)
+    
+    # Drop cached results nobody has used for max_age
+    other = evict_result_cache(max_age=max_age)
+    
+    # On-demand profiles are kept for PROFILE_MAX_AGE; sampled ones are
+    # limited by number instead
+    profile_cutoff = time.time() - PROFILE_MAX_AGE
+    with os.scandir(PROFILES_FOLDER) as entries:
+        for entry in entries:
+            if entry.name.startswith('cprofile-') and entry.stat().st_mtime < profile_cutoff:
                 try:
-                    os.remove(file_path)
-                    count += 1
-                    total_processed += 1
-                    app.logger.info(f"Removed old processed file: {file_path}")
-                    
-                    # Remove from tracking dictionary
-                    if filename in processed_files:
-                        del processed_files[filename]
+                    os.remove(entry.path)
+                    other += 1
                 except Exception as e:
-                    app.logger.error(f"Error removing file {file_path}: {str(e)}")
+                    app.logger.error("Error removing file %s: %s", entry.path, e)
+    
+    # Fail the jobs whose worker died, so that their clients stop waiting
+    unfinished_jobs()
+    
+    # Cleanup old job records and progress left by unlocks that never finished
+    for folder in (JOBS_FOLDER, PROGRESS_FOLDER):
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                if entry.is_file() and entry.stat().st_mtime < cutoff:
+                    try:
+                        os.remove(entry.path)
+                        other += 1
+                        app.logger.info("Removed old record: %s", entry.path, extra={'event': 'file_removed'})
+                    except Exception as e:
+                        app.logger.error("Error removing file %s: %s", entry.path, e)
+    
+    return counts['protected'], counts['processed'], other
+
+@app.route('/cleanup', methods=['GET'])
+def cleanup():
+    try:
+        # Remove files that have expired, then anything else older than FILE_TTL
+        uploads, processed = expire_due_files()
+        old_uploads, old_processed, other = reconcile_folders()
+        
+        total_uploads = uploads + old_uploads
+        total_processed = processed + old_processed
+        count = total_uploads + total_processed + other
                 
         # Save the updated processed files dictionary
         save_processed_files()
@@ -1140,70 +4237,372 @@ def cleanup():
             'message': f'Removed {count} old files ({total_uploads} uploads, {total_processed} processed)'
         }), 200
     except Exception as e:
-        app.logger.error(f"Cleanup error: {str(e)}")
+        app.logger.error("Cleanup error: %s", e)
         return jsonify({'error': str(e)}), 500
 
+_cleanup_lock_fd = None
+_cleanup_thread_pid = None
+
+def _acquire_cleanup_leadership():
+    """Try to become the one process that runs cleanup; keep it until exit."""
+    global _cleanup_lock_fd
+    if fcntl is None:
+        return True
+    if _cleanup_lock_fd is None:
+        _cleanup_lock_fd = os.open(CLEANUP_LOCK_FILE, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(_cleanup_lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return True
+    except OSError:
+        return False
+
+def cleanup_scheduler():
+    """
+    Delete files as they expire, in the cleanup leader only.
+    
+    Every worker runs this thread, but only the one holding CLEANUP_LOCK_FILE
+    gets past the election; the others keep retrying so one of them takes
+    over if the leader exits. The leader sleeps until the next expiry in the
+    index (at most CLEANUP_MAX_SLEEP) and reconciles the folders every
+    CLEANUP_RECONCILE_INTERVAL.
+    """
+    while not _acquire_cleanup_leadership():
+        time.sleep(CLEANUP_MAX_SLEEP)
+    app.logger.info("Process %s is running the cleanup scheduler", os.getpid())
+    
+    next_reconcile = 0
+    while True:
+        delay = CLEANUP_MAX_SLEEP
+        try:
+            now = time.time()
+            uploads, processed = expire_due_files(now)
+            other = enforce_storage_budget()
+            
+            if now >= next_reconcile:
+                old_uploads, old_processed, old_other = reconcile_folders()
+                uploads += old_uploads
+                processed += old_processed
+                other += old_other
+                next_reconcile = now + CLEANUP_RECONCILE_INTERVAL
+            
+            if uploads or processed or other:
+                save_processed_files()
+                app.logger.info("Scheduled cleanup removed %s uploads, %s processed and %s other files", uploads, processed, other)
+            
+            if uploads + processed >= CLEANUP_BATCH_SIZE:
+                # More expired rows are waiting
+                delay = 0
+            else:
+                due = next_expiry()
+                if due is not None:
+                    delay = min(delay, max(due - time.time(), 0.05))
+                delay = min(delay, max(next_reconcile - time.time(), 0))
+        except Exception as e:
+            app.logger.error("Error in cleanup thread: %s", e)
+        
+        time.sleep(delay)
+
 # Add a background thread for automatic cleanup
 def setup_periodic_cleanup():
-    """Set up a background thread to run cleanup periodically"""
-    import threading
+    """
+    Start the cleanup scheduler thread in this process.
     
-    def cleanup_thread():
-        while True:
-            try:
-                app.logger.info("Running scheduled cleanup")
-                # Remove files older than 1 hour
-                current_time = time.time()
-                cleaned_count = 0
-                
-                # Clean up upload folder
-                for filename in os.listdir(app.config['UPLOAD_FOLDER']):
-                    file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-                    if os.path.isfile(file_path) and (current_time - os.path.getmtime(file_path)) > 3600:
-                        try:
-                            os.remove(file_path)
-                            cleaned_count += 1
-                            
-                            # Remove from protected_files if it's there
-                            if filename in protected_files:
-                                del protected_files[filename]
-                        except:
-                            pass
-                
-                # Clean up processed folder
-                for filename in os.listdir(app.config['PROCESSED_FOLDER']):
-                    file_path = os.path.join(app.config['PROCESSED_FOLDER'], filename)
-                    if os.path.isfile(file_path) and (current_time - os.path.getmtime(file_path)) > 3600:
-                        try:
-                            os.remove(file_path)
-                            cleaned_count += 1
-                            
-                            # Remove from tracking dictionary
-                            if filename in processed_files:
-                                del processed_files[filename]
-                        except:
-                            pass
-                
-                # Save the updated processed files dictionary
-                if cleaned_count > 0:
-                    try:
-                        save_processed_files()
-                        app.logger.info(f"Scheduled cleanup removed {cleaned_count} files")
-                    except:
-                        pass
-                        
-            except Exception as e:
-                app.logger.error(f"Error in cleanup thread: {str(e)}")
-                
-            # Sleep for 15 minutes
-            time.sleep(15 * 60)
+    Called from the gunicorn worker hook, wsgi.py and the development server;
+    safe to call more than once.
+    """
+    global _cleanup_thread_pid
+    if _cleanup_thread_pid == os.getpid():
+        return
+    _cleanup_thread_pid = os.getpid()
     
     # Start the cleanup thread
-    thread = threading.Thread(target=cleanup_thread)
+    thread = threading.Thread(target=cleanup_scheduler)
     thread.daemon = True  # Thread will exit when main thread exits
     thread.start()
     app.logger.info("Started background cleanup thread")
 
+# Bytes that uploads/ and processed/ may hold before the least recently
+# downloaded files are evicted, ahead of their expiry. The result cache is not
+# counted: it has its own bound, RESULT_CACHE_MAX_BYTES, on top of this one
+# (entries hard-linked to a processed file take no extra space)
+STORAGE_BUDGET_BYTES = int(os.environ.get('STORAGE_BUDGET_BYTES', 512 * 1024 * 1024))
+
+def open_for_download(file_path):
+    """
+    Open a file and hold a shared lock on it while it is being sent.
+    
+    The storage budget never evicts a file someone holds this lock on.
+    
+    Returns:
+        file: The open file to pass to release_download(), or None if missing
+    """
+    try:
+        f = open(file_path, 'rb')
+    except FileNotFoundError:
+        return None
+    if fcntl is not None:
+        run_cpu_bound(fcntl.flock, f.fileno(), fcntl.LOCK_SH)
+    return f
+
+def release_download(held_file):
+    """Release and close a file opened by open_for_download()."""
+    if fcntl is not None:
+        # Unlock before closing: a pool process forked during the download
+        # shares the lock and would otherwise keep it forever
+        fcntl.flock(held_file.fileno(), fcntl.LOCK_UN)
+    held_file.close()
+
+def record_download(filename, file_path):
+    """Mark an unlocked file as just downloaded, for least-recently-used eviction."""
+    if METADATA_BACKEND == 'sqlite':
+        processed_files.touch(filename)
+    else:
+        # The json backend orders eviction by access time, which is set
+        # explicitly because relatime mounts rarely update it
+        try:
+            os.utime(file_path, ns=(time.time_ns(), os.stat(file_path).st_mtime_ns))
+        except OSError:
+            pass
+
+def _remove_if_idle(file_path, remove):
+    """
+    Run remove() unless a download holds a lock on file_path.
+    
+    Returns:
+        bool: False if the file is being downloaded
+    """
+    if DOWNLOAD_OFFLOAD != 'off':
+        # Handed to the proxy within the grace period: it may not have
+        # opened the file yet
+        try:
+            if os.stat(file_path).st_atime > time.time() - DOWNLOAD_OFFLOAD_GRACE:
+                return False
+        except FileNotFoundError:
+            pass
+    
+    if fcntl is None:
+        remove()
+        return True
+    
+    try:
+        fd = os.open(file_path, os.O_RDONLY)
+    except FileNotFoundError:
+        remove()
+        return True
+    try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            return False
+        remove()
+        return True
+    finally:
+        os.close(fd)
+
+def storage_usage():
+    """
+    Return the bytes and number of files kept in uploads/ and processed/.
+    
+    Read from the metadata index with the sqlite backend, so it does not
+    list any folder.
+    """
+    if METADATA_BACKEND == 'sqlite':
+        used, files = get_metadata_db().execute(
+            'SELECT COALESCE(SUM(size), 0), COUNT(*) FROM files').fetchone()
+        return used, files
+    
+    used = files = 0
+    for folder in [app.config['UPLOAD_FOLDER'], app.config['PROCESSED_FOLDER']]:
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                if entry.is_file():
+                    used += entry.stat().st_size
+                    files += 1
+    return used, files
+
+def _eviction_candidates():
+    """Yield (remove function, path, size) from least to most recently used."""
+    if METADATA_BACKEND == 'sqlite':
+        rows = get_metadata_db().execute(
+            'SELECT kind, key, size FROM files ORDER BY accessed_at').fetchall()
+        for kind, key, size in rows:
+            if kind == 'protected':
+                yield (lambda key=key: _remove_upload(key),
+                       os.path.join(app.config['UPLOAD_FOLDER'], key), size or 0)
+            else:
+                yield (lambda key=key: _remove_processed(key),
+                       os.path.join(app.config['PROCESSED_FOLDER'], key), size or 0)
+        return
+    
+    candidates = []
+    for folder, remove in [(app.config['UPLOAD_FOLDER'], _remove_upload),
+                           (app.config['PROCESSED_FOLDER'], _remove_processed)]:
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                if entry.is_file():
+                    stat_result = entry.stat()
+                    candidates.append((stat_result.st_atime, entry.name, entry.path,
+                                       stat_result.st_size, remove))
+    for _, name, path, size, remove in sorted(candidates):
+        yield (lambda name=name, remove=remove: remove(name), path, size)
+
+def pending_job_uploads():
+    """Return the file IDs of the uploads that unfinished jobs have yet to unlock."""
+    file_ids = set()
+    for job in unfinished_jobs():
+        for entry in job['files']:
+            if entry.get('file_id') and entry['status'] in ('queued', 'processing'):
+                file_ids.add(entry['file_id'])
+    return file_ids
+
+def enforce_storage_budget():
+    """
+    Evict the least recently downloaded files while over STORAGE_BUDGET_BYTES.
+    
+    Files that are being downloaded and uploads that a queued or running job
+    still has to unlock are skipped. Evictions are counted in the
+    storage_evictions, storage_evicted_bytes and storage_busy_skips counters.
+    
+    Returns:
+        int: Number of files evicted
+    """
+    used, _ = storage_usage()
+    if used <= STORAGE_BUDGET_BYTES:
+        return 0
+    
+    pending = pending_job_uploads()
+    evicted = evicted_bytes = busy = 0
+    for remove, file_path, size in _eviction_candidates():
+        if used <= STORAGE_BUDGET_BYTES:
+            break
+        if (os.path.dirname(file_path) == app.config['UPLOAD_FOLDER']
+                and os.path.basename(file_path) in pending):
+            busy += 1
+            continue
+        try:
+            if _remove_if_idle(file_path, remove):
+                used -= size
+                evicted += 1
+                evicted_bytes += size
+            else:
+                busy += 1
+        except Exception as e:
+            app.logger.error("Error evicting %s: %s", file_path, e)
+    
+    if evicted:
+        save_processed_files()
+        bump_counter('storage_evictions', evicted)
+        bump_counter('storage_evicted_bytes', evicted_bytes)
+        app.logger.warning("Storage over budget: evicted %s files (%s bytes)", evicted, evicted_bytes)
+    if busy:
+        bump_counter('storage_busy_skips', busy)
+    return evicted
+
+@app.route('/healthz', methods=['GET'])
+def healthz():
+    """
+    Health check and warm-up for the keep-alive pings and the platform.
+    
+    Primes the PDF and crypto code in this worker if that hasn't happened yet,
+    without rendering any template.
+    """
+    return jsonify({
+        'status': 'ok',
+        'pid': os.getpid(),
+        'warm_up_seconds': round(warm_up(), 4)
+    })
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Metrics of all worker processes in the Prometheus text format."""
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return Response(generate_latest(registry), mimetype=CONTENT_TYPE_LATEST)
+
+@app.route('/admin/profiles', methods=['GET'])
+def list_profiles():
+    """List the stored profiles, newest first (admin token required)."""
+    if not _is_admin():
+        return jsonify({'error': 'Forbidden'}), 403
+    
+    profiles = []
+    for name in os.listdir(PROFILES_FOLDER):
+        if not name.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(PROFILES_FOLDER, name)) as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            continue
+        meta.pop('stacks', None)
+        profiles.append(meta)
+    
+    profiles.sort(key=lambda meta: meta['created_at'], reverse=True)
+    return jsonify({'profiles': profiles})
+
+@app.route('/admin/profiles/<profile_id>', methods=['GET'])
+def get_profile(profile_id):
+    """
+    Return one profile (admin token required).
+    
+    cProfile profiles, merged with the profiles of the job's PDF tasks, are
+    returned as a text report sorted by cumulative time, or with ?format=prof
+    as a pstats file for snakeviz or pstats. Sampled profiles are returned as
+    collapsed stacks ('frame;frame;... samples' per line) for flame graphs,
+    or with ?format=json with their metadata.
+    """
+    if not _is_admin():
+        return jsonify({'error': 'Forbidden'}), 403
+    if not _is_valid_profile_id(profile_id):
+        return jsonify({'error': 'Invalid profile ID'}), 400
+    
+    try:
+        with open(os.path.join(PROFILES_FOLDER, f"{profile_id}.json")) as f:
+            meta = json.load(f)
+    except FileNotFoundError:
+        return jsonify({'error': 'Profile not found'}), 404
+    
+    output_format = request.args.get('format', 'text')
+    if meta['kind'] == 'sampled':
+        if output_format == 'json':
+            return jsonify(meta)
+        lines = [f"{stack} {count}" for stack, count in
+                 sorted(meta['stacks'].items(), key=lambda item: item[1], reverse=True)]
+        return Response("\n".join(lines) + "\n", mimetype='text/plain')
+    
+    # The request's own profile, then the job's PDF tasks as they finished
+    paths = [os.path.join(PROFILES_FOLDER, name) for name in sorted(os.listdir(PROFILES_FOLDER))
+             if name.startswith(f"{profile_id}.") and name.endswith('.prof')]
+    stats = pstats.Stats(*paths, stream=io.StringIO())
+    
+    if output_format == 'prof':
+        # The format pstats.Stats.dump_stats writes
+        buffer = io.BytesIO(marshal.dumps(stats.stats))
+        return send_file(buffer, mimetype='application/octet-stream', as_attachment=True,
+                         download_name=f"{profile_id}.prof")
+    
+    stats.stream.write(f"{meta['label']}: {meta['duration']:.3f}s, {len(paths)} profile(s)\n")
+    stats.sort_stats('cumulative').print_stats(PROFILE_REPORT_LINES)
+    return Response(stats.stream.getvalue(), mimetype='text/plain')
+
+@app.route('/storage-status', methods=['GET'])
+def storage_status():
+    try:
+        used, files = storage_usage()
+        counters = read_counters()
+        return jsonify({
+            'status': 'success',
+            'budget_bytes': STORAGE_BUDGET_BYTES,
+            'used_bytes': used,
+            'files': files,
+            'evictions': counters.get('storage_evictions', 0),
+            'evicted_bytes': counters.get('storage_evicted_bytes', 0),
+            'busy_skips': counters.get('storage_busy_skips', 0)
+        })
+    except Exception as e:
+        app.logger.error("Storage status error: %s", e)
+        return jsonify({'status': 'error', 'error': str(e)}), 500
+
 @app.route('/get-processed-files', methods=['GET'])
 def get_processed_files():
     try:
@@ -1225,7 +4624,7 @@ def get_processed_files():
         
         return jsonify({'files': files_list})
     except Exception as e:
-        app.logger.error(f"Get processed files error: {str(e)}")
+        app.logger.error("Get processed files error: %s", e)
         return jsonify({'error': str(e)}), 500
 
 # Add emergency reset endpoint
@@ -1234,20 +4633,30 @@ def emergency_reset():
     try:
         # Clear the processed files dictionary
         processed_files.clear()
+        upload_hashes.clear()
+        upload_trailers.clear()
+        upload_pages.clear()
+        clear_reader_cache()
         
         # Try to delete the JSON file
-        if os.path.exists(PROCESSED_FILES_DB):
+        if METADATA_BACKEND == 'sqlite':
+            protected_files.clear()
+        elif os.path.exists(PROCESSED_FILES_DB):
             try:
                 os.remove(PROCESSED_FILES_DB)
             except:
                 pass
                 
         # Re-create folders with proper permissions
-        for folder in [UPLOAD_FOLDER, PROCESSED_FOLDER, DATA_FOLDER]:
+        for folder in [UPLOAD_FOLDER, PROCESSED_FOLDER, DATA_FOLDER, JOBS_FOLDER, RESULT_CACHE_FOLDER, PROGRESS_FOLDER]:
             # Try to delete all files in the folder
             try:
                 for filename in os.listdir(folder):
                     file_path = os.path.join(folder, filename)
+                    # The metadata database and journal were emptied above;
+                    # deleting them under the other workers' open handles would lose writes
+                    if file_path.startswith(METADATA_DB) or file_path == PROCESSED_FILES_JOURNAL:
+                        continue
                     if os.path.isfile(file_path):
                         try:
                             os.remove(file_path)
@@ -1260,105 +4669,138 @@ def emergency_reset():
         ensure_folder_permissions()
         
         # Create empty processed files file
-        try:
-            with open(PROCESSED_FILES_DB, 'w') as f:
-                json.dump({}, f)
-        except:
-            pass
+        if METADATA_BACKEND != 'sqlite':
+            try:
+                with open(PROCESSED_FILES_DB, 'w') as f:
+                    json.dump({}, f)
+            except:
+                pass
             
         return jsonify({
             'status': 'success',
             'message': 'Emergency reset completed. Please refresh the page.'
         })
     except Exception as e:
-        app.logger.error(f"Emergency reset error: {str(e)}")
+        app.logger.error("Emergency reset error: %s", e)
         return jsonify({'error': str(e)}), 500
 
+def probe_encryption(input_path):
+    """
+    Parse a PDF and try to open it with an empty password.
+    
+    Returns:
+        tuple: (reader, encrypted, decrypt_result), decrypt_result being 0 if
+        the file is not encrypted or needs a user password
+    """
+    from PyPDF2 import PdfReader
+    reader = PdfReader(input_path)
+    encrypted = reader.is_encrypted
+    decrypt_result = reader.decrypt('') if encrypted else 0
+    return reader, encrypted, decrypt_result
+
 @app.route('/check-password', methods=['POST'])
 def check_password():
+    # Stream only the first file to disk; the rest of the body is never read
+    uploads, _ = ingest_uploads('files[]', max_files=1)
+    
     # Check if any files were uploaded
-    if 'files[]' not in request.files:
+    if not uploads:
         return jsonify({'status': 'error', 'message': 'No files were uploaded'}), 400
     
-    file = request.files.getlist('files[]')[0]  # Lấy file đầu tiên
+    upload = uploads[0]  # Lấy file đầu tiên
     
-    if file and allowed_file(file.filename):
-        # Generate a unique ID for this file
-        file_id = str(uuid.uuid4())
-        
-        # Save the file temporarily
-        input_path = os.path.join(app.config['UPLOAD_FOLDER'], file_id)
-        file.save(input_path)
+    if not upload['error']:
+        file_id = upload['file_id']
+        input_path = upload['path']
         
         # Store original filename for later use
-        original_filename = secure_filename(file.filename)
-        app.logger.info(f"Original filename for file_id {file_id}: {original_filename}")
+        original_filename = secure_filename(upload['filename'])
+        app.logger.debug("Original filename for file_id %s: %s", file_id, original_filename, extra={'event': 'upload_name'})
+        enforce_storage_budget()
+        
+        # Parsing needs a slot in the file's lane and room in the memory
+        # budget; without them the client uploads again after Retry-After
+        slot = acquire_lane_slot(upload['lane'], timeout=ADMISSION_WAIT)
+        reservation_id = None
+        if slot is not None:
+            reservation_id = admit_memory(estimate_memory_cost(input_path, file_id))
+        if reservation_id is None:
+            release_lane_slot(slot)
+            _remove_upload(file_id)
+            return server_busy_response()
         
         # Check if the file is password-protected
         try:
-            reader = PdfReader(input_path)
+            with STAGE_SECONDS.labels('encryption_probe').time():
+                reader, encrypted, decrypt_result = run_cpu_bound(probe_encryption, input_path)
+            
+            # Keep the parsed reader, and the memory reserved for it, for the
+            # unlock request that follows
+            cache_reader(file_id, reader, upload['size'], reservation_id)
+            reservation_id = None
             
             # Check if the PDF is encrypted
-            if reader.is_encrypted:
-                # Try to open with an empty password
-                decrypt_result = reader.decrypt('')
-                
+            if encrypted:
                 # If decrypt_result > 0, it means the file is only owner-password protected
                 # and can be accessed without a user password (decrypt_result = 1 or 2)
                 if decrypt_result > 0:
-                    app.logger.info(f"File is encrypted but can be opened without password: {file.filename}")
+                    app.logger.info("File is encrypted but can be opened without password: %s", upload['filename'])
                     
                     # We can process this file without password
-                    protected_files[file_id] = original_filename
+                    protected_files.put(file_id, original_filename, size=upload['size'], sha256=upload['sha256'])
                     return jsonify({
                         'needs_password': False,
                         'file_id': file_id,
-                        'filename': file.filename,
+                        'filename': upload['filename'],
                         'status': 'success'
                     })
                 else:
                     # Store original filename for later use - this file needs a password
-                    protected_files[file_id] = original_filename
+                    protected_files.put(file_id, original_filename, size=upload['size'], sha256=upload['sha256'])
                     
                     return jsonify({
                         'needs_password': True,
                         'file_id': file_id,
-                        'filename': file.filename
+                        'filename': upload['filename']
                     })
             else:
                 # Not encrypted at all
-                protected_files[file_id] = original_filename
+                protected_files.put(file_id, original_filename, size=upload['size'], sha256=upload['sha256'])
                 return jsonify({
                     'needs_password': False,
                     'file_id': file_id,
-                    'filename': file.filename,
+                    'filename': upload['filename'],
                     'status': 'success'
                 })
         except Exception as e:
             # Check if the error is related to password protection
             if "password" in str(e).lower():
                 # Store original filename for later use
-                protected_files[file_id] = original_filename
+                protected_files.put(file_id, original_filename, size=upload['size'], sha256=upload['sha256'])
                 
                 # If it specifically mentions incorrect password, it definitely needs one
                 return jsonify({
                     'needs_password': True,
                     'file_id': file_id,
-                    'filename': file.filename
+                    'filename': upload['filename']
                 })
             else:
                 # Some other error occurred
                 if os.path.exists(input_path):
                     os.remove(input_path)
+                evict_cached_reader(file_id)
                 
                 return jsonify({
                     'status': 'error',
                     'message': str(e)
                 })
+        finally:
+            release_memory(reservation_id)
+            release_lane_slot(slot)
     else:
         return jsonify({
             'status': 'error', 
-            'message': 'Invalid file type'
+            'message': upload['error']
         })
 
 @app.route('/session-status', methods=['GET'])
@@ -1390,10 +4832,271 @@ def session_status():
             }
         }), 200
     except Exception as e:
-        app.logger.error(f"Session status error: {str(e)}")
+        app.logger.error("Session status error: %s", e)
         return jsonify({'status': 'error', 'error': str(e)}), 500
 
+# Bulk unlocking from the command line:
+#
+#     python -m app unlock ARCHIVE [MORE ...] --workers 4 --passwords passwords.csv
+#
+# Walks the folders recursively and unlocks every PDF on a process pool with
+# the same code as the web app, writing "unlocked_<clean name>" next to each
+# input or, with --output-dir, into a mirror of the input tree. Every
+# finished file is appended to the checkpoint, so after an interruption the
+# same command carries on where it stopped.
+CLI_CHECKPOINT = 'unlock-checkpoint.jsonl'
+
+# Seconds between two progress lines on stderr
+CLI_REPORT_INTERVAL = 5
+
+def load_password_map(path):
+    """
+    Read the passwords to use per file from a CSV or JSON file.
+    
+    CSV files have a path and a password column (a header row is optional);
+    JSON files hold an object mapping paths to passwords. Paths are matched
+    against the input path relative to its folder argument, then against the
+    file name.
+    
+    Returns:
+        dict: Path or file name -> password
+    """
+    with open(path, newline='', encoding='utf-8') as f:
+        if path.lower().endswith('.json'):
+            data = json.load(f)
+            if not isinstance(data, dict):
+                raise ValueError(f"{path} must hold a JSON object of path: password pairs")
+            return {os.path.normpath(key): str(value) for key, value in data.items()}
+        
+        import csv
+        passwords = {}
+        for row in csv.reader(f):
+            if len(row) < 2 or row[:2] == ['path', 'password']:
+                continue
+            passwords[os.path.normpath(row[0].strip())] = row[1]
+        return passwords
+
+def find_pdfs(roots, output_dir=None):
+    """
+    Yield (input path, path relative to its root, root, earlier output) for every PDF under roots.
+    
+    The output folder is skipped, and files named "unlocked_..." found in the
+    folders are flagged as earlier outputs, so that running the command again
+    never unlocks its own results.
+    """
+    output_dir = os.path.abspath(output_dir) if output_dir else None
+    for root in roots:
+        root = os.path.abspath(root)
+        if os.path.isfile(root):
+            yield root, os.path.basename(root), os.path.dirname(root), False
+            continue
+        for folder, subfolders, filenames in os.walk(root):
+            subfolders[:] = sorted(name for name in subfolders
+                                   if os.path.join(folder, name) != output_dir)
+            for filename in sorted(filenames):
+                if not filename.lower().endswith('.pdf'):
+                    continue
+                path = os.path.join(folder, filename)
+                yield path, os.path.relpath(path, root), root, filename.lower().startswith('unlocked_')
+
+def cli_output_path(input_path, relative_path, output_dir=None):
+    """Where the unlocked copy of input_path goes, named with clean_filename."""
+    filename = f"unlocked_{clean_filename(os.path.basename(input_path))}"
+    if output_dir:
+        return os.path.join(os.path.abspath(output_dir), os.path.dirname(relative_path), filename)
+    return os.path.join(os.path.dirname(input_path), filename)
+
+def _init_cli_worker():
+    """Leave Ctrl-C to the CLI process, which stops the pool and reports."""
+    import signal
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    _init_pdf_worker()
+
+def _cli_unlock_file(input_path, output_path, password):
+    """
+    Unlock one file for the CLI in a pool process.
+    
+    The PDF is written to a temporary name and renamed when it is complete,
+    so an interrupted run never leaves a partial output behind.
+    """
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    temp_path = f"{output_path}.{os.getpid()}.part"
+    try:
+        result = _unlock_pdf_file(input_path, temp_path, password)
+        if result.get('needs_password') and password:
+            # Files with only an owner password open with an empty one, also
+            # when --password is meant for the other files
+            result = _unlock_pdf_file(input_path, temp_path, '')
+        if result['status'] == 'success':
+            os.replace(temp_path, output_path)
+            result['bytes_written'] = os.path.getsize(output_path)
+        return result
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+def _load_checkpoint(path):
+    """Return the last recorded result per input path of a checkpoint file."""
+    done = {}
+    try:
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                    done[record['path']] = record
+                except (ValueError, KeyError):
+                    # The line being written when the run was interrupted
+                    continue
+    except FileNotFoundError:
+        pass
+    return done
+
+def cli_unlock(args):
+    """
+    Run the "unlock" command: unlock every PDF under args.paths on a process pool.
+    
+    Returns:
+        int: Exit status, 1 if any file could not be unlocked
+    """
+    passwords = load_password_map(args.passwords) if args.passwords else {}
+    checkpoint = _load_checkpoint(args.checkpoint)
+    
+    # Work out every file's output first, so that two inputs whose names
+    # clean to the same one get different outputs
+    tasks = []
+    outputs = set()
+    skipped = earlier_outputs = 0
+    for input_path, relative_path, root, earlier_output in find_pdfs(args.paths, args.output_dir):
+        if earlier_output:
+            earlier_outputs += 1
+            continue
+        try:
+            stat_result = os.stat(input_path)
+        except OSError:
+            continue
+        
+        record = checkpoint.get(input_path)
+        if (record and record.get('size') == stat_result.st_size and record.get('mtime_ns') == stat_result.st_mtime_ns
+                and (record['status'] == 'success' or (record['status'] == 'error' and not args.retry_failed))):
+            skipped += 1
+            outputs.add(record.get('output'))
+            continue
+        
+        output_path = cli_output_path(input_path, relative_path, args.output_dir)
+        stem, extension = os.path.splitext(output_path)
+        number = 1
+        while output_path in outputs or output_path == input_path:
+            number += 1
+            output_path = f"{stem}_{number}{extension}"
+        outputs.add(output_path)
+        
+        password = passwords.get(os.path.normpath(relative_path),
+                                 passwords.get(os.path.basename(input_path), args.password))
+        tasks.append((input_path, output_path, password, stat_result))
+    
+    total_bytes = sum(stat_result.st_size for _, _, _, stat_result in tasks)
+    print(f"{len(tasks)} files to unlock ({total_bytes / 1024 / 1024:.1f} MB), "
+          f"{skipped} already done according to {args.checkpoint}, "
+          f"{earlier_outputs} earlier outputs (unlocked_*) left alone", file=sys.stderr)
+    
+    counts = {'success': 0, 'needs_password': 0, 'error': 0}
+    bytes_done = 0
+    started = last_report = time.perf_counter()
+    pool = ProcessPoolExecutor(max_workers=args.workers, initializer=_init_cli_worker)
+    pending = iter(tasks)
+    futures = {}
+    interrupted = False
+    
+    with open(args.checkpoint, 'a', encoding='utf-8') as checkpoint_file:
+        try:
+            while True:
+                # Keep a couple of files per process queued, not the whole archive
+                while len(futures) < args.workers * 2:
+                    task = next(pending, None)
+                    if task is None:
+                        break
+                    futures[pool.submit(_cli_unlock_file, *task[:3])] = task
+                if not futures:
+                    break
+                
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    input_path, output_path, _, stat_result = futures.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        result = {'status': 'error', 'error': f'An error occurred: {str(e)}'}
+                    status = unlock_result_status(result)
+                    counts[status] += 1
+                    bytes_done += stat_result.st_size
+                    
+                    checkpoint_file.write(json.dumps({
+                        'path': input_path,
+                        'size': stat_result.st_size,
+                        'mtime_ns': stat_result.st_mtime_ns,
+                        'status': status,
+                        'output': output_path if status == 'success' else None,
+                        'error': result.get('error')
+                    }) + '\n')
+                    checkpoint_file.flush()
+                    if status != 'success':
+                        print(f"{status}: {input_path}: {result.get('error')}", file=sys.stderr)
+                
+                now = time.perf_counter()
+                if now - last_report >= CLI_REPORT_INTERVAL:
+                    last_report = now
+                    finished = sum(counts.values())
+                    print(f"{finished}/{len(tasks)} files, {finished / (now - started):.1f} files/s",
+                          file=sys.stderr)
+        except KeyboardInterrupt:
+            interrupted = True
+            pool.shutdown(wait=False, cancel_futures=True)
+        else:
+            pool.shutdown()
+    
+    elapsed = max(time.perf_counter() - started, 1e-9)
+    finished = sum(counts.values())
+    print(f"{'Interrupted' if interrupted else 'Done'}: {finished} files in {elapsed:.1f}s, "
+          f"{finished / elapsed:.2f} files/s, {bytes_done / 1024 / 1024 / elapsed:.2f} MB/s; "
+          f"{counts['success']} unlocked, {counts['needs_password']} need a password, "
+          f"{counts['error']} failed, {skipped + earlier_outputs} skipped")
+    if interrupted:
+        print(f"Run the same command again to continue from {args.checkpoint}", file=sys.stderr)
+        return 130
+    return 1 if counts['needs_password'] or counts['error'] else 0
+
+def cli_main(argv):
+    """Parse the command line of "python -m app" and run the command."""
+    import argparse
+    parser = argparse.ArgumentParser(prog='python -m app', description='PDF Unlocker Pro command line')
+    commands = parser.add_subparsers(dest='command', required=True)
+    
+    unlock_parser = commands.add_parser('unlock', help='Unlock every PDF in folders, recursively')
+    unlock_parser.add_argument('paths', nargs='+', help='Folders (or single PDF files) to unlock')
+    unlock_parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                               help='Processes unlocking files at once (default: one per CPU)')
+    unlock_parser.add_argument('--passwords', help='CSV (path,password) or JSON ({"path": "password"}) '
+                                                   'file with the passwords of protected files')
+    unlock_parser.add_argument('--password', default='', help='Password for files not in --passwords')
+    unlock_parser.add_argument('--output-dir', help='Write the outputs into a mirror of the input tree '
+                                                    'here instead of next to the inputs')
+    unlock_parser.add_argument('--checkpoint', default=CLI_CHECKPOINT,
+                               help=f'Results of finished files, used to resume (default: {CLI_CHECKPOINT})')
+    unlock_parser.add_argument('--retry-failed', action='store_true',
+                               help='Also retry the files the checkpoint records as failed')
+    unlock_parser.add_argument('--verbose', action='store_true', help='Log at INFO instead of WARNING')
+    
+    args = parser.parse_args(argv)
+    if args.workers < 1:
+        parser.error('--workers must be at least 1')
+    if args.verbose:
+        app.logger.setLevel(logging.INFO)
+    return cli_unlock(args)
+
 if __name__ == "__main__":
+    if CLI_MODE:
+        sys.exit(cli_main(sys.argv[1:]))
+    
     # Start the periodic cleanup thread
     setup_periodic_cleanup()
     
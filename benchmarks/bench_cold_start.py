@@ -0,0 +1,106 @@
+"""
+Cold start: time from starting gunicorn to the first successful unlock.
+
+Copies the app of --app-dir (this checkout by default) to an empty folder,
+byte-compiles it the way the render.yaml build does and starts gunicorn with
+its gunicorn_config.py on a free port. A PDF with a user password from
+corpus.py is then posted to /check-password until the server answers, and
+unlocked through /unlock-with-password. Every run starts a fresh server in a
+fresh copy; the median of --runs runs is reported for:
+
+    first response   /check-password answered, counted from the start
+    first unlock     /unlock-with-password answered with success
+
+To compare with an earlier version, point --app-dir at a checkout of it:
+
+    git worktree add /tmp/before HEAD~1
+    python benchmarks/bench_cold_start.py --app-dir /tmp/before --json before.json
+    python benchmarks/bench_cold_start.py --json after.json
+"""
+import argparse
+import json
+import os
+import shutil
+import signal
+import statistics
+import tempfile
+import time
+import urllib.error
+
+from common import copy_app, free_port, post, post_pdf, start_server
+from corpus import USER_PASSWORD, make_case_pdf
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def run(app_dir, data, workers, log):
+    run_dir = tempfile.mkdtemp(prefix='bench_cold_start_')
+    try:
+        copy_app(app_dir, run_dir)
+        port = free_port()
+        url = f'http://127.0.0.1:{port}'
+
+        start = time.perf_counter()
+        server = start_server(run_dir, port, workers, log)
+        try:
+            while True:
+                try:
+                    result = post_pdf(f'{url}/check-password', data, 'cold-start.pdf')
+                    break
+                except (ConnectionError, urllib.error.URLError):
+                    if server.poll() is not None:
+                        raise RuntimeError('gunicorn exited, see the log')
+                    time.sleep(0.01)
+            first_response = time.perf_counter() - start
+            assert result['needs_password'], result
+
+            body = json.dumps({'file_id': result['file_id'], 'password': USER_PASSWORD}).encode()
+            result = post(f'{url}/unlock-with-password', body, 'application/json')
+            first_unlock = time.perf_counter() - start
+            assert result['status'] == 'success', result
+        finally:
+            server.send_signal(signal.SIGTERM)
+            server.wait(timeout=60)
+
+        return {'first_response_s': first_response, 'first_unlock_s': first_unlock}
+    finally:
+        shutil.rmtree(run_dir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--app-dir', default=APP_DIR, help='Folder with the app.py to start')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--log', help='Append the gunicorn output to this file instead of discarding it')
+    parser.add_argument('--json', help='Also write the results to this JSON file')
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='bench_cold_start_')
+    log = open(args.log or os.devnull, 'a')
+    try:
+        path = make_case_pdf(os.path.join(work_dir, 'cold-start.pdf'), 1, 'rc4-128', 'user', 'text', 1)
+        with open(path, 'rb') as f:
+            data = f.read()
+
+        runs = []
+        print(f"{'run':>4} {'first response s':>17} {'first unlock s':>15}")
+        for number in range(1, args.runs + 1):
+            row = run(args.app_dir, data, args.workers, log)
+            runs.append(row)
+            print(f"{number:>4} {row['first_response_s']:>17.3f} {row['first_unlock_s']:>15.3f}")
+
+        medians = {key: statistics.median(row[key] for row in runs) for key in runs[0]}
+        print(f"{'med':>4} {medians['first_response_s']:>17.3f} {medians['first_unlock_s']:>15.3f}")
+
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump({'benchmark': 'cold_start', 'app_dir': args.app_dir, 'workers': args.workers,
+                           'median': medians, 'runs': runs}, f, indent=2)
+    finally:
+        log.close()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
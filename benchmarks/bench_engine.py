@@ -0,0 +1,83 @@
+"""
+CPU time and memory of the unlock engines on large documents.
+
+Compares the page-by-page rebuild ('pages') with the whole-document clone
+('clone') on owner-password PDFs, timing parse + decrypt + write and
+measuring the peak of traced allocations per page.
+
+    python benchmarks/bench_engine.py --pages 500 1000 2000
+"""
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import time
+import tracemalloc
+
+from common import make_pdf
+
+from PyPDF2 import PdfReader
+
+import app
+
+ENGINES = {
+    'pages': app._write_page_copy,
+    'clone': app._write_decrypted_clone,
+}
+
+
+def unlock_with(engine, input_path, output_path):
+    reader = PdfReader(input_path)
+    if reader.is_encrypted:
+        reader.decrypt('')
+    with open(output_path, 'wb') as f:
+        ENGINES[engine](reader, f)
+
+
+def measure(engine, input_path, output_path, repeat):
+    cpu_times = []
+    for _ in range(repeat):
+        start = time.process_time()
+        unlock_with(engine, input_path, output_path)
+        cpu_times.append(time.process_time() - start)
+    
+    # Separate run for memory, tracing slows the code down
+    tracemalloc.start()
+    unlock_with(engine, input_path, output_path)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    
+    return min(cpu_times), peak, os.path.getsize(output_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--pages', type=int, nargs='+', default=[500, 1000])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--json', help='Also write the results to this JSON file')
+    args = parser.parse_args()
+    
+    work_dir = tempfile.mkdtemp(prefix='bench_engine_')
+    results = []
+    try:
+        print(f"{'pages':>6} {'engine':>6} {'cpu s':>8} {'ms/page':>8} {'peak MB':>8} {'KB/page':>8} {'out KB':>8}")
+        for pages in args.pages:
+            input_path = make_pdf(os.path.join(work_dir, f"in_{pages}.pdf"), pages=pages)
+            for engine in ENGINES:
+                output_path = os.path.join(work_dir, f"out_{pages}_{engine}.pdf")
+                cpu, peak, size = measure(engine, input_path, output_path, args.repeat)
+                results.append({'pages': pages, 'engine': engine, 'cpu_seconds': cpu,
+                                'peak_bytes': peak, 'output_bytes': size})
+                print(f"{pages:>6} {engine:>6} {cpu:>8.3f} {1000 * cpu / pages:>8.3f} "
+                      f"{peak / 2 ** 20:>8.1f} {peak / 1024 / pages:>8.1f} {size / 1024:>8.0f}")
+        
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump({'benchmark': 'engine', 'results': results}, f, indent=2)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+"""
+Latency of small unlocks while large ones are running, with and without lanes.
+
+Starts a few unlock jobs for large PDFs through /unlock, then submits small
+single-page jobs one after another and times each until /jobs reports it
+finished. Runs once with every file in one lane and once with the fast/slow
+lanes, and prints p50/p99/max of the small jobs.
+
+    python benchmarks/bench_lanes.py --big-jobs 2 --big-pages 1500 --small-jobs 30
+"""
+import argparse
+import io
+import json
+import os
+import shutil
+import tempfile
+import time
+
+from common import make_pdf
+
+import app
+
+
+def unique(data, n):
+    # Different bytes per upload so the result cache does not answer them
+    return data + f"\n%{n}\n".encode()
+
+
+def submit(client, data, name):
+    response = client.post('/unlock', data={'files[]': (io.BytesIO(data), name)},
+                           content_type='multipart/form-data')
+    assert response.status_code == 202, response.get_json()
+    return response.get_json()['job_id']
+
+
+def wait_for(client, job_id, poll=0.01):
+    while True:
+        job = client.get(f'/jobs/{job_id}').get_json()
+        if job['finished']:
+            assert job['counts'].get('success') == len(job['files']), job
+            return
+        time.sleep(poll)
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+def run(client, big, small, args, counter):
+    big_jobs = []
+    for _ in range(args.big_jobs):
+        counter[0] += 1
+        big_jobs.append(submit(client, unique(big, counter[0]), 'big.pdf'))
+
+    latencies = []
+    for _ in range(args.small_jobs):
+        counter[0] += 1
+        start = time.perf_counter()
+        wait_for(client, submit(client, unique(small, counter[0]), 'small.pdf'))
+        latencies.append(time.perf_counter() - start)
+
+    for job_id in big_jobs:
+        wait_for(client, job_id)
+
+    return {
+        'p50_ms': percentile(latencies, 0.5) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'max_ms': max(latencies) * 1000
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--big-jobs', type=int, default=2)
+    parser.add_argument('--big-pages', type=int, default=1500)
+    parser.add_argument('--small-jobs', type=int, default=30)
+    parser.add_argument('--json', help='Also write the results to this JSON file')
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='bench_lanes_')
+    try:
+        with open(make_pdf(os.path.join(work_dir, 'big.pdf'), pages=args.big_pages), 'rb') as f:
+            big = f.read()
+        with open(make_pdf(os.path.join(work_dir, 'small.pdf'), pages=1), 'rb') as f:
+            small = f.read()
+
+        client = app.app.test_client()
+        slow_bytes, slow_pages = app.LANE_SLOW_BYTES, app.LANE_SLOW_PAGES
+        counter = [0]
+        results = []
+
+        for mode in ['single lane', 'fast/slow lanes']:
+            if mode == 'single lane':
+                app.LANE_SLOW_BYTES = app.LANE_SLOW_PAGES = float('inf')
+            else:
+                app.LANE_SLOW_BYTES, app.LANE_SLOW_PAGES = slow_bytes, slow_pages
+            row = run(client, big, small, args, counter)
+            row['mode'] = mode
+            results.append(row)
+
+        print(f"{args.small_jobs} single-page jobs behind {args.big_jobs} x {args.big_pages}-page jobs")
+        print(f"{'mode':>16} {'p50 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+        for row in results:
+            print(f"{row['mode']:>16} {row['p50_ms']:>9.1f} {row['p99_ms']:>9.1f} {row['max_ms']:>9.1f}")
+
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump({'benchmark': 'lanes', 'big_jobs': args.big_jobs, 'big_pages': args.big_pages,
+                           'small_jobs': args.small_jobs, 'results': results}, f, indent=2)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
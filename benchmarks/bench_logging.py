@@ -0,0 +1,137 @@
+"""
+Request latency with logging off, queued to the writer thread, and written in the request.
+
+Uploads an RC4-128 PDF with a user password from corpus.py to /check-password
+and unlocks it through /unlock-with-password, the way the frontend does, using
+the Flask test client. The two requests log a dozen records at INFO and about
+twice as many at --level DEBUG. The log goes to os.devnull, so the numbers
+show the cost of producing the records rather than of the terminal:
+
+    off     app.logger disabled
+    queue   the app's setup: records are formatted by the background writer
+    sync    the same formatter and filters on a handler writing in the request
+
+    python benchmarks/bench_logging.py --requests 300 --level DEBUG
+"""
+import argparse
+import io
+import json
+import logging
+import os
+import shutil
+import statistics
+import tempfile
+import time
+
+from corpus import USER_PASSWORD, make_case_pdf
+
+import app
+
+MODES = ['off', 'queue', 'sync']
+
+
+def unique(data, n):
+    # Different bytes per upload so the result cache does not answer them
+    return data + f"\n%{os.getpid()}-{n}\n".encode()
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+def use_mode(mode, devnull):
+    logger = app.app.logger
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    logger.disabled = mode == 'off'
+    if mode == 'sync':
+        handler = logging.StreamHandler(devnull)
+        handler.setFormatter(app._log_formatter())
+        for log_filter in app.log_handler.filters:
+            handler.addFilter(log_filter)
+        logger.addHandler(handler)
+    else:
+        logger.addHandler(app.log_handler)
+
+
+def run(client, data, requests, counter):
+    latencies = {'/check-password': [], '/unlock-with-password': []}
+    for _ in range(requests):
+        counter[0] += 1
+        start = time.perf_counter()
+        result = client.post('/check-password', data={'files[]': (io.BytesIO(unique(data, counter[0])), 'bench.pdf')},
+                             content_type='multipart/form-data').get_json()
+        latencies['/check-password'].append(time.perf_counter() - start)
+        assert result['needs_password'], result
+
+        start = time.perf_counter()
+        result = client.post('/unlock-with-password', json={'file_id': result['file_id'], 'password': USER_PASSWORD}).get_json()
+        latencies['/unlock-with-password'].append(time.perf_counter() - start)
+        assert result['status'] == 'success', result
+        app._remove_processed(result['download_url'].rsplit('/', 1)[-1])
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--pages', type=int, default=1)
+    parser.add_argument('--level', choices=['DEBUG', 'INFO', 'WARNING'], default='INFO')
+    parser.add_argument('--format', choices=['json', 'text'], default='json')
+    parser.add_argument('--rounds', type=int, default=3, help='Times every mode is run, interleaved')
+    parser.add_argument('--json', help='Also write the results to this JSON file')
+    args = parser.parse_args()
+
+    app.LOG_FORMAT = args.format
+    app.app.logger.setLevel(args.level)
+    devnull = open(os.devnull, 'w')
+    # Restart the writer so it uses --format and writes to os.devnull
+    app.log_listener.stop()
+    app._start_log_listener()
+    app.log_listener.handler.setStream(devnull)
+
+    work_dir = tempfile.mkdtemp(prefix='bench_logging_')
+    try:
+        path = make_case_pdf(os.path.join(work_dir, 'bench.pdf'), 1, 'rc4-128', 'user', 'text', args.pages)
+        with open(path, 'rb') as f:
+            data = f.read()
+
+        client = app.app.test_client()
+        counter = [0]
+        run(client, data, 10, counter)  # warm up
+
+        latencies = {(mode, endpoint): [] for mode in MODES for endpoint in ['/check-password', '/unlock-with-password']}
+        for _ in range(args.rounds):
+            for mode in MODES:
+                use_mode(mode, devnull)
+                for endpoint, values in run(client, data, args.requests, counter).items():
+                    latencies[mode, endpoint].extend(values)
+        use_mode('queue', devnull)
+
+        results = [{
+            'mode': mode,
+            'endpoint': endpoint,
+            'requests': len(values),
+            'median_ms': statistics.median(values) * 1000,
+            'p99_ms': percentile(values, 0.99) * 1000,
+            'mean_ms': statistics.mean(values) * 1000
+        } for (mode, endpoint), values in latencies.items()]
+
+        print(f"{args.pages}-page PDF, level {args.level}, {args.format} format")
+        print(f"{'endpoint':>22} {'mode':>6} {'median ms':>10} {'p99 ms':>9} {'mean ms':>9} {'vs off':>8}")
+        off = {row['endpoint']: row['median_ms'] for row in results if row['mode'] == 'off'}
+        for row in sorted(results, key=lambda row: row['endpoint']):
+            print(f"{row['endpoint']:>22} {row['mode']:>6} {row['median_ms']:>10.3f} {row['p99_ms']:>9.3f} "
+                  f"{row['mean_ms']:>9.3f} {(row['median_ms'] / off[row['endpoint']] - 1) * 100:>+7.1f}%")
+
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump({'benchmark': 'logging', 'level': args.level, 'format': args.format,
+                           'pages': args.pages, 'results': results}, f, indent=2)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
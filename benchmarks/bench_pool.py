@@ -0,0 +1,66 @@
+"""
+Throughput of a multi-file unlock batch on the PDF process pool.
+
+Unlocks the same batch of owner-password PDFs with 1..N pool processes and
+prints files/s and the speedup over a single process.
+
+    python benchmarks/bench_pool.py --files 16 --pages 200 --max-workers 4
+"""
+import argparse
+import json
+import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+from common import make_pdf, timed
+
+import app
+
+
+def run_batch(pool, inputs, out_dir):
+    futures = [pool.submit(app._unlock_pdf_file, path, os.path.join(out_dir, f"out_{i}.pdf"), '')
+               for i, path in enumerate(inputs)]
+    results = [future.result() for future in futures]
+    assert all(result['status'] == 'success' for result in results), results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--files', type=int, default=16)
+    parser.add_argument('--pages', type=int, default=200)
+    parser.add_argument('--max-workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--json', help='Also write the results to this JSON file')
+    args = parser.parse_args()
+    
+    work_dir = tempfile.mkdtemp(prefix='bench_pool_')
+    try:
+        inputs = [make_pdf(os.path.join(work_dir, f"in_{i}.pdf"), pages=args.pages) for i in range(args.files)]
+        results = []
+        
+        for workers in range(1, args.max_workers + 1):
+            with ProcessPoolExecutor(max_workers=workers, initializer=app._init_pdf_worker) as pool:
+                # Start the processes before timing, as get_pdf_pool() does
+                for future in [pool.submit(app._pdf_worker_ping) for _ in range(workers)]:
+                    future.result()
+                
+                seconds, _ = timed(run_batch, pool, inputs, work_dir)
+            
+            results.append({'workers': workers, 'seconds': seconds, 'files_per_second': args.files / seconds})
+        
+        baseline = results[0]['seconds']
+        print(f"{args.files} files x {args.pages} pages")
+        print(f"{'workers':>8} {'seconds':>10} {'files/s':>10} {'speedup':>8}")
+        for row in results:
+            row['speedup'] = baseline / row['seconds']
+            print(f"{row['workers']:>8} {row['seconds']:>10.3f} {row['files_per_second']:>10.2f} {row['speedup']:>7.2f}x")
+        
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump({'benchmark': 'pool', 'files': args.files, 'pages': args.pages, 'results': results}, f, indent=2)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
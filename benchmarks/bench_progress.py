@@ -0,0 +1,92 @@
+"""
+Cost of the progress reporting in the unlock engines.
+
+Writes owner-password PDFs of --pages pages with both engines, once without
+a ProgressReporter and once with one, the way _unlock_pdf_file reports the
+progress of an upload. The reader is parsed and decrypted outside the timed
+part, so the numbers compare the copy and write loops the hooks are in.
+Both variants run interleaved --repeat times; the medians are reported.
+
+    python benchmarks/bench_progress.py --pages 200 1000 --repeat 7
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import tempfile
+import time
+
+from common import make_pdf
+
+from PyPDF2 import PdfReader
+
+import app
+
+ENGINES = {
+    'pages': app._write_page_copy,
+    'clone': app._write_decrypted_clone,
+}
+
+
+def write_once(engine, input_path, output_path, progress):
+    reader = PdfReader(input_path)
+    reader.decrypt('')
+    with open(output_path, 'wb') as f:
+        start = time.perf_counter()
+        ENGINES[engine](reader, f, progress)
+        return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--pages', type=int, nargs='+', default=[200, 1000])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--json', help='Also write the results to this JSON file')
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='bench_progress_')
+    results = []
+    try:
+        output_path = os.path.join(work_dir, 'out.pdf')
+        print(f"{'pages':>6} {'engine':>6} {'off ms':>9} {'on ms':>9} {'change':>8} {'writes':>7}")
+        for pages in args.pages:
+            input_path = make_pdf(os.path.join(work_dir, f'{pages}.pdf'), pages)
+            for engine in ENGINES:
+                seconds = {'off': [], 'on': []}
+                writes = 0
+                for _ in range(args.repeat):
+                    seconds['off'].append(write_once(engine, input_path, output_path, None))
+                    progress = app.ProgressReporter(f'bench-{os.getpid()}')
+                    progress.path = os.path.join(work_dir, 'progress.json')
+                    original_write = progress._write
+
+                    def counted_write(now, original_write=original_write):
+                        nonlocal writes
+                        writes += 1
+                        original_write(now)
+                    progress._write = counted_write
+                    seconds['on'].append(write_once(engine, input_path, output_path, progress))
+
+                row = {
+                    'pages': pages,
+                    'engine': engine,
+                    'off_median_s': statistics.median(seconds['off']),
+                    'on_median_s': statistics.median(seconds['on']),
+                    'progress_writes_per_run': writes / args.repeat
+                }
+                results.append(row)
+                print(f"{pages:>6} {engine:>6} {row['off_median_s'] * 1000:>9.1f} {row['on_median_s'] * 1000:>9.1f} "
+                      f"{(row['on_median_s'] / row['off_median_s'] - 1) * 100:>+7.1f}% "
+                      f"{row['progress_writes_per_run']:>7.1f}")
+
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump({'benchmark': 'progress', 'interval_s': app.PROGRESS_INTERVAL,
+                           'repeat': args.repeat, 'results': results}, f, indent=2)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,171 @@
+"""
+How many slow clients the sync and the async server mode can hold.
+
+Starts gunicorn in a fresh copy of the app, once with SERVER_MODE=sync and
+once with SERVER_MODE=async, and for every count in --clients opens that
+many connections that trickle a PDF upload into /check-password over --hold
+seconds, like phones on a bad network. Meanwhile a probe requests /healthz
+every 100 ms. A count is held when every probe is answered within
+--probe-timeout and every slow upload is answered, either unlocked or with
+the 503 the admission control sends when too many files arrive at once.
+
+    python benchmarks/bench_slow_clients.py --workers 2 --clients 1 2 8 32 128
+"""
+import argparse
+import http.client
+import json
+import os
+import shutil
+import signal
+import socket
+import statistics
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+
+from common import copy_app, free_port, multipart_body, start_server
+from corpus import make_case_pdf
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STEP = 0.05
+
+
+def wait_until_up(url, server):
+    while True:
+        try:
+            with urllib.request.urlopen(f'{url}/healthz', timeout=5):
+                return
+        except (ConnectionError, urllib.error.URLError):
+            if server.poll() is not None:
+                raise RuntimeError('gunicorn exited, see the log')
+            time.sleep(0.05)
+
+
+def upload_request(port, data, n):
+    # Different bytes per upload so the result cache does not answer them
+    body, content_type = multipart_body(data + f"\n%slow-{os.getpid()}-{time.time()}-{n}\n".encode(), 'slow.pdf')
+    head = (f'POST /check-password HTTP/1.1\r\nHost: 127.0.0.1:{port}\r\nContent-Type: {content_type}\r\n'
+            f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n').encode()
+    return head + body
+
+
+def probe(url, stop, timeout, latencies, failures):
+    while not stop.is_set():
+        start = time.perf_counter()
+        try:
+            with urllib.request.urlopen(f'{url}/healthz', timeout=timeout) as response:
+                response.read()
+            latencies.append(time.perf_counter() - start)
+        except (OSError, urllib.error.URLError):
+            failures.append(time.perf_counter() - start)
+        stop.wait(0.1)
+
+
+def run(port, data, clients, args):
+    url = f'http://127.0.0.1:{port}'
+    requests = [upload_request(port, data, n) for n in range(clients)]
+    sockets = [socket.create_connection(('127.0.0.1', port)) for _ in range(clients)]
+
+    latencies, failures = [], []
+    stop = threading.Event()
+    prober = threading.Thread(target=probe, args=(url, stop, args.probe_timeout, latencies, failures))
+    prober.start()
+    try:
+        # Send every request in equal pieces spread over --hold seconds
+        steps = max(1, int(args.hold / STEP))
+        for step in range(steps):
+            for sock, request in zip(sockets, requests):
+                size = -(-len(request) // steps)
+                sock.sendall(request[step * size:(step + 1) * size])
+            time.sleep(STEP)
+
+        succeeded = busy = 0
+        for sock in sockets:
+            sock.settimeout(args.hold + 120)
+            response = http.client.HTTPResponse(sock)
+            try:
+                response.begin()
+                result = json.loads(response.read())
+                succeeded += response.status == 200 and result.get('needs_password') is True
+                busy += response.status == 503 and result.get('busy') is True
+            except (OSError, http.client.HTTPException, ValueError):
+                pass
+    finally:
+        stop.set()
+        prober.join()
+        for sock in sockets:
+            sock.close()
+
+    probes = latencies + failures
+    return {
+        'clients': clients,
+        'uploads_ok': succeeded,
+        'uploads_busy': busy,
+        'probes': len(probes),
+        'probe_failures': len(failures),
+        'probe_median_ms': statistics.median(probes) * 1000 if probes else None,
+        'probe_max_ms': max(probes) * 1000 if probes else None,
+        'held': succeeded + busy == clients and not failures
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--app-dir', default=APP_DIR, help='Folder with the app.py to start')
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--clients', type=int, nargs='+', default=[1, 2, 8, 32, 128])
+    parser.add_argument('--hold', type=float, default=5, help='Seconds every slow client takes for its upload')
+    parser.add_argument('--probe-timeout', type=float, default=2)
+    parser.add_argument('--modes', nargs='+', choices=['sync', 'async'], default=['sync', 'async'])
+    parser.add_argument('--log', help='Append the gunicorn output to this file instead of discarding it')
+    parser.add_argument('--json', help='Also write the results to this JSON file')
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='bench_slow_clients_')
+    log = open(args.log or os.devnull, 'a')
+    results = []
+    try:
+        path = make_case_pdf(os.path.join(work_dir, 'slow.pdf'), 1, 'rc4-128', 'user', 'text', 10)
+        with open(path, 'rb') as f:
+            data = f.read()
+
+        print(f"{args.workers} workers, uploads of {len(data) // 1024} KB taking {args.hold:.0f}s each")
+        print(f"{'mode':>6} {'clients':>8} {'uploads ok':>11} {'busy':>5} {'probes failed':>14} {'probe median ms':>16} "
+              f"{'probe max ms':>13} {'held':>5}")
+        for mode in args.modes:
+            run_dir = os.path.join(work_dir, mode)
+            os.makedirs(run_dir)
+            copy_app(args.app_dir, run_dir)
+            port = free_port()
+            server = start_server(run_dir, port, args.workers, log, SERVER_MODE=mode)
+            try:
+                wait_until_up(f'http://127.0.0.1:{port}', server)
+                for clients in args.clients:
+                    row = run(port, data, clients, args)
+                    row['mode'] = mode
+                    results.append(row)
+                    print(f"{mode:>6} {clients:>8} {row['uploads_ok']:>11} {row['uploads_busy']:>5} "
+                          f"{row['probe_failures']:>6} of {row['probes']:<5} {row['probe_median_ms']:>16.1f} "
+                          f"{row['probe_max_ms']:>13.1f} {'yes' if row['held'] else 'no':>5}")
+            finally:
+                server.send_signal(signal.SIGTERM)
+                server.wait(timeout=60)
+
+        print()
+        for mode in args.modes:
+            held = [row['clients'] for row in results if row['mode'] == mode and row['held']]
+            print(f"{mode}: held up to {max(held) if held else 0} slow clients")
+
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump({'benchmark': 'slow_clients', 'workers': args.workers, 'hold_s': args.hold,
+                           'probe_timeout_s': args.probe_timeout, 'results': results}, f, indent=2)
+    finally:
+        log.close()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
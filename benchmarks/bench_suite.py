@@ -0,0 +1,236 @@
+"""
+Benchmark suite over a reproducible corpus of encrypted PDFs.
+
+Builds the corpus of corpus.py (RC4-40/128, AES-128/256, owner-only and user
+passwords, text and image pages) and for every file times unlock_pdf and
+try_password_variations directly and /check-password, /unlock and
+/download-all through the Flask test client; clean_filename is timed on a
+set of typical upload names. Files with a user password go through
+/unlock-with-password, the way the frontend unlocks them.
+
+Every result keeps the minimum, median and maximum of --repeat runs. --json
+writes them together with the corpus hashes and library versions, and
+--compare prints the change against such a file from an earlier run, e.g.
+before and after a PyPDF2 upgrade:
+
+    python benchmarks/bench_suite.py --profile full --json before.json
+    python benchmarks/bench_suite.py --profile full --json after.json --compare before.json
+"""
+import argparse
+import importlib.metadata
+import io
+import json
+import os
+import platform
+import shutil
+import statistics
+import tempfile
+import time
+
+from common import timed
+from corpus import PROFILES, build_corpus
+
+import app
+
+# Upload names as they come from the frontend, with the security markers
+# and Vietnamese names clean_filename is written for
+FILENAMES = [
+    'report.pdf',
+    'Annual Report 2023 (SECURED).pdf',
+    'contract_protected_final-unlocked.pdf',
+    'Báo cáo tài chính quý 3 (bảo mật).pdf',
+    'scan 2024-01-05 12.30.15 [password protected].PDF',
+    '',
+]
+FILENAME_ROUNDS = 200
+
+
+# Differs between runs, so that a run never finds the uploads of the previous
+# one in the result cache
+RUN_ID = os.urandom(8).hex()
+
+
+def unique(data, n):
+    # Different bytes per upload so the result cache does not answer them
+    return data + f"\n%{RUN_ID}-{n}\n".encode()
+
+
+def stats(seconds):
+    return {
+        'runs': len(seconds),
+        'min_s': min(seconds),
+        'median_s': statistics.median(seconds),
+        'max_s': max(seconds)
+    }
+
+
+def bench_clean_filename(repeat):
+    seconds = []
+    for _ in range(repeat):
+        elapsed, _ = timed(lambda: [app.clean_filename(name) for _ in range(FILENAME_ROUNDS) for name in FILENAMES])
+        seconds.append(elapsed / (FILENAME_ROUNDS * len(FILENAMES)))
+    return [dict(case='filenames', target='clean_filename', **stats(seconds))]
+
+
+def bench_functions(case, work_dir, repeat):
+    rows = []
+    output_path = os.path.join(work_dir, 'out.pdf')
+
+    seconds = []
+    for _ in range(repeat):
+        elapsed, reader = timed(app.try_password_variations, case['path'], case['password'])
+        assert reader is not None, case['name']
+        seconds.append(elapsed)
+    rows.append(dict(target='try_password_variations', **stats(seconds)))
+
+    if case['protection'] == 'user':
+        seconds = []
+        for _ in range(repeat):
+            elapsed, reader = timed(app.try_password_variations, case['path'], 'wrong-password')
+            assert reader is None, case['name']
+            seconds.append(elapsed)
+        rows.append(dict(target='try_password_variations (wrong password)', **stats(seconds)))
+
+    seconds = []
+    for _ in range(repeat):
+        elapsed, result = timed(app.unlock_pdf, case['path'], output_path, case['password'])
+        assert result['status'] == 'success', (case['name'], result)
+        seconds.append(elapsed)
+        app.processed_files.pop(os.path.basename(output_path), None)
+    rows.append(dict(target='unlock_pdf', **stats(seconds)))
+
+    return rows
+
+
+def post_file(client, url, data, name):
+    return client.post(url, data={'files[]': (io.BytesIO(data), name)}, content_type='multipart/form-data')
+
+
+def wait_for(client, job_id, poll=0.01):
+    while True:
+        job = client.get(f'/jobs/{job_id}').get_json()
+        if job['finished']:
+            return job
+        time.sleep(poll)
+
+
+def unlock_through_api(client, case, data, file_id):
+    """Unlock an uploaded file the way the frontend does, return the download URL."""
+    if case['protection'] == 'user':
+        result = client.post('/unlock-with-password', json={'file_id': file_id, 'password': case['password']}).get_json()
+        assert result['status'] == 'success', (case['name'], result)
+        return result['download_url']
+
+    response = post_file(client, '/unlock', data, case['name'])
+    assert response.status_code == 202, (case['name'], response.get_json())
+    job = wait_for(client, response.get_json()['job_id'])
+    assert job['counts'].get('success') == 1, (case['name'], job)
+    return job['files'][0]['download_url']
+
+
+def bench_endpoints(client, case, repeat, counter):
+    with open(case['path'], 'rb') as f:
+        original = f.read()
+
+    seconds = {'/check-password': [], '/unlock': [], '/download-all': []}
+    for _ in range(repeat):
+        counter[0] += 1
+        data = unique(original, counter[0])
+
+        start = time.perf_counter()
+        result = post_file(client, '/check-password', data, case['name']).get_json()
+        seconds['/check-password'].append(time.perf_counter() - start)
+        assert result['needs_password'] == (case['protection'] == 'user'), (case['name'], result)
+
+        start = time.perf_counter()
+        download_url = unlock_through_api(client, case, data, result['file_id'])
+        seconds['/unlock'].append(time.perf_counter() - start)
+        if case['protection'] != 'user':
+            # Only the user-password path consumed the checked upload
+            app._remove_upload(result['file_id'])
+
+        start = time.perf_counter()
+        response = client.post('/download-all', json={'files': [download_url]})
+        archive = response.get_data()
+        response.close()
+        seconds['/download-all'].append(time.perf_counter() - start)
+        assert response.status_code == 200 and archive[:2] == b'PK', case['name']
+
+        app._remove_processed(download_url.rsplit('/', 1)[-1])
+
+    target_names = {'/unlock': '/unlock-with-password' if case['protection'] == 'user' else '/unlock'}
+    return [dict(target=target_names.get(target, target), **stats(values)) for target, values in seconds.items()]
+
+
+def compare(results, path):
+    with open(path) as f:
+        previous = {(row['case'], row['target']): row['median_s'] for row in json.load(f)['results']}
+
+    print(f"\nChange of the median against {path}")
+    print(f"{'case':>36} {'target':>42} {'before ms':>10} {'after ms':>10} {'change':>8}")
+    for row in results:
+        before = previous.get((row['case'], row['target']))
+        if before:
+            print(f"{row['case']:>36} {row['target']:>42} {before * 1000:>10.2f} {row['median_s'] * 1000:>10.2f} "
+                  f"{(row['median_s'] / before - 1) * 100:>+7.1f}%")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--profile', choices=sorted(PROFILES), default='quick')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--corpus', help='Keep the corpus in this directory and reuse it on the next run')
+    parser.add_argument('--only', help='Only run the corpus files whose name contains this text')
+    parser.add_argument('--json', help='Also write the results to this JSON file')
+    parser.add_argument('--compare', help='Results JSON of an earlier run to compare against')
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='bench_suite_')
+    try:
+        cases = build_corpus(args.corpus or os.path.join(work_dir, 'corpus'), args.profile, args.seed)
+        if args.only:
+            cases = [case for case in cases if args.only in case['name']]
+
+        client = app.app.test_client()
+        counter = [0]
+        results = bench_clean_filename(args.repeat)
+
+        print(f"{'case':>36} {'target':>42} {'median ms':>10} {'min ms':>10}")
+        for case in cases:
+            rows = bench_functions(case, work_dir, args.repeat) + bench_endpoints(client, case, args.repeat, counter)
+            for row in rows:
+                row['case'] = case['name']
+            results.extend(rows)
+        for row in results:
+            print(f"{row['case']:>36} {row['target']:>42} {row['median_s'] * 1000:>10.2f} {row['min_s'] * 1000:>10.2f}")
+
+        if args.compare:
+            compare(results, args.compare)
+
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump({
+                    'benchmark': 'suite',
+                    'profile': args.profile,
+                    'seed': args.seed,
+                    'repeat': args.repeat,
+                    'created_at': time.time(),
+                    'environment': {
+                        'python': platform.python_version(),
+                        'platform': platform.platform(),
+                        'cpus': os.cpu_count(),
+                        'pypdf2': importlib.metadata.version('PyPDF2'),
+                        'pycryptodome': importlib.metadata.version('pycryptodome'),
+                        'flask': importlib.metadata.version('flask'),
+                        'pdf_pool_workers': app.PDF_POOL_WORKERS
+                    },
+                    'corpus': [{key: value for key, value in case.items() if key != 'path'} for case in cases],
+                    'results': results
+                }, f, indent=2)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
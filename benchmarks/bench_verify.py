@@ -0,0 +1,91 @@
+"""
+Latency of verifying unlocked output.
+
+Compares the summary-based 'fast' verification with re-parsing the written
+file, as unlock_pdf used to do after every write ('reparse'), and with the
+'deep' debugging mode.
+
+    python benchmarks/bench_verify.py --pages 10 500 2000
+"""
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import time
+
+from common import make_pdf
+
+from PyPDF2 import PdfReader
+
+import app
+
+
+def legacy_verify(summary, output_path):
+    # What the success paths of unlock_pdf did before the summary check
+    if not os.path.exists(output_path) or os.path.getsize(output_path) == 0:
+        return 'empty'
+    return 'encrypted' if PdfReader(output_path).is_encrypted else None
+
+
+def fast_verify(summary, output_path):
+    app.PDF_VERIFY_MODE = 'fast'
+    return app.verify_unlocked_output(summary, output_path)
+
+
+def deep_verify(summary, output_path):
+    app.PDF_VERIFY_MODE = 'deep'
+    return app.verify_unlocked_output(summary, output_path)
+
+
+VERIFIERS = {'reparse': legacy_verify, 'fast': fast_verify, 'deep': deep_verify}
+
+
+def best_of(fn, repeat, *args):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        assert fn(*args) is None
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--pages', type=int, nargs='+', default=[10, 500, 2000])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--json', help='Also write the results to this JSON file')
+    args = parser.parse_args()
+    
+    work_dir = tempfile.mkdtemp(prefix='bench_verify_')
+    results = []
+    try:
+        print(f"{'pages':>6} {'size KB':>8} {'reparse ms':>11} {'fast ms':>8} {'deep ms':>8} {'saved ms':>9}")
+        for pages in args.pages:
+            input_path = make_pdf(os.path.join(work_dir, f"in_{pages}.pdf"), pages=pages)
+            output_path = os.path.join(work_dir, f"out_{pages}.pdf")
+            
+            reader = PdfReader(input_path)
+            reader.decrypt('')
+            summary = app.write_unlocked_pdf(reader, output_path)
+            
+            row = {'pages': pages, 'output_bytes': summary['bytes']}
+            for name, verifier in VERIFIERS.items():
+                row[f'{name}_seconds'] = best_of(verifier, args.repeat, summary, output_path)
+            row['saved_seconds'] = row['reparse_seconds'] - row['fast_seconds']
+            results.append(row)
+            
+            print(f"{pages:>6} {summary['bytes'] / 1024:>8.0f} {1000 * row['reparse_seconds']:>11.3f} "
+                  f"{1000 * row['fast_seconds']:>8.3f} {1000 * row['deep_seconds']:>8.3f} "
+                  f"{1000 * row['saved_seconds']:>9.3f}")
+        
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump({'benchmark': 'verify', 'results': results}, f, indent=2)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
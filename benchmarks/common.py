@@ -0,0 +1,127 @@
+"""
+Shared helpers for the benchmark scripts.
+
+The scripts import the application module directly, so they are run from the
+repository root, e.g. `python benchmarks/bench_pool.py`.
+"""
+import compileall
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import time
+import urllib.request
+import uuid
+
+# Make `import app` work when a script is run as benchmarks/<script>.py
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_ROOT not in sys.path:
+    sys.path.insert(0, REPO_ROOT)
+
+from PyPDF2 import PageObject, PdfWriter
+from PyPDF2.generic import DecodedStreamObject, DictionaryObject, NameObject
+
+
+def add_font(writer):
+    """Add a Helvetica font object to writer and return its reference."""
+    return writer._add_object(DictionaryObject({
+        NameObject('/Type'): NameObject('/Font'),
+        NameObject('/Subtype'): NameObject('/Type1'),
+        NameObject('/BaseFont'): NameObject('/Helvetica'),
+    }))
+
+
+def add_text_page(writer, font, number, lines=50):
+    """Add a page with lines of text in font to writer."""
+    page = PageObject.create_blank_page(writer, 612, 792)
+    text = [f"BT /F1 10 Tf 40 {760 - 14 * i} Td (Page {number + 1} line {i}: lorem ipsum dolor sit amet) Tj ET"
+            for i in range(lines)]
+    content = DecodedStreamObject()
+    content.set_data("\n".join(text).encode('latin-1'))
+    page[NameObject('/Contents')] = writer._add_object(content)
+    page[NameObject('/Resources')] = DictionaryObject({
+        NameObject('/Font'): DictionaryObject({NameObject('/F1'): font})
+    })
+    writer.add_page(page)
+
+
+def make_pdf(path, pages=10, user_password=None, owner_password='owner', use_128bit=True):
+    """
+    Write a text PDF with the given number of pages.
+    
+    Args:
+        path (str): Where to write the PDF
+        pages (int): Number of pages
+        user_password (str, optional): Password needed to open the file. With
+            only an owner password the file opens with an empty password.
+        owner_password (str, optional): Owner password, None for no encryption
+        use_128bit (bool): RC4-128 when True, RC4-40 otherwise
+    """
+    writer = PdfWriter()
+    font = add_font(writer)
+    for number in range(pages):
+        add_text_page(writer, font, number)
+    
+    if owner_password is not None or user_password is not None:
+        writer.encrypt(user_password or '', owner_password, use_128bit=use_128bit)
+    
+    with open(path, 'wb') as f:
+        writer.write(f)
+    return path
+
+
+def timed(fn, *args, **kwargs):
+    """Call fn and return (seconds, result)."""
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+
+# What a deployment consists of, for the scripts that start gunicorn
+APP_FILES = ['app.py', 'wsgi.py', 'gunicorn_config.py', 'templates', 'static']
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def copy_app(app_dir, run_dir):
+    """Copy the app of app_dir to run_dir and byte-compile it like the render.yaml build."""
+    for name in APP_FILES:
+        source = os.path.join(app_dir, name)
+        if os.path.isdir(source):
+            shutil.copytree(source, os.path.join(run_dir, name))
+        elif os.path.exists(source):
+            shutil.copy(source, run_dir)
+    compileall.compile_dir(run_dir, quiet=1)
+
+
+def start_server(run_dir, port, workers, log, **env):
+    """Start gunicorn with the gunicorn_config.py of run_dir, with env added to the environment."""
+    env = dict(os.environ, PORT=str(port), WEB_CONCURRENCY=str(workers), **env)
+    env.pop('PROMETHEUS_MULTIPROC_DIR', None)
+    return subprocess.Popen([sys.executable, '-m', 'gunicorn', '-c', 'gunicorn_config.py',
+                             '--workers', str(workers), 'wsgi:app'],
+                            cwd=run_dir, env=env, stdout=log, stderr=log)
+
+
+def post(url, body, content_type, timeout=120):
+    request = urllib.request.Request(url, data=body, headers={'Content-Type': content_type})
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        return json.load(response)
+
+
+def multipart_body(data, name, field='files[]'):
+    """Return (body, content type) of a form upload of one file."""
+    boundary = uuid.uuid4().hex
+    body = (f'--{boundary}\r\nContent-Disposition: form-data; name="{field}"; filename="{name}"\r\n'
+            f'Content-Type: application/pdf\r\n\r\n').encode() + data + f'\r\n--{boundary}--\r\n'.encode()
+    return body, f'multipart/form-data; boundary={boundary}'
+
+
+def post_pdf(url, data, name):
+    return post(url, *multipart_body(data, name))
@@ -0,0 +1,301 @@
+"""
+Reproducible corpus of encrypted PDFs for the benchmark suite.
+
+Covers the four standard security handler variants (RC4-40, RC4-128,
+AES-128, AES-256), owner-only and user-password protection, text-heavy and
+image-heavy content, and page counts from 1 to 2,000 with files up to the
+16 MB upload limit. Every byte comes from a random generator seeded with the
+corpus seed and the file name, including document IDs, salts and AES IVs, so
+the same seed gives identical files on every machine and PyPDF2 version.
+
+PyPDF2 can only write RC4, so objects are encrypted here and the writer only
+serializes them; the key derivation comes from PyPDF2's own algorithms.
+
+    python benchmarks/corpus.py --profile full --out /tmp/corpus
+"""
+import argparse
+import hashlib
+import io
+import json
+import os
+import random
+import struct
+
+from common import add_font, add_text_page
+
+from Crypto.Cipher import AES, ARC4
+from Crypto.Util.Padding import pad
+from PyPDF2 import PageObject, PdfReader, PdfWriter
+from PyPDF2._encryption import AlgV4, AlgV5
+from PyPDF2.generic import (ArrayObject, ByteStringObject, DecodedStreamObject, DictionaryObject,
+                            NameObject, NumberObject, StreamObject, TextStringObject)
+
+# Standard security handler settings: /V, /R, key length in bits and the
+# crypt filter method for the AES variants
+ENCRYPTIONS = {
+    'rc4-40': {'V': 1, 'R': 2, 'bits': 40, 'method': None},
+    'rc4-128': {'V': 2, 'R': 3, 'bits': 128, 'method': None},
+    'aes-128': {'V': 4, 'R': 4, 'bits': 128, 'method': '/AESV2'},
+    'aes-256': {'V': 5, 'R': 6, 'bits': 256, 'method': '/AESV3'},
+}
+
+# Owner-only files open with an empty password, user files need USER_PASSWORD
+PROTECTIONS = ('owner', 'user')
+USER_PASSWORD = 'bench-user'
+OWNER_PASSWORD = 'bench-owner'
+
+# Permissions without printing, copying or editing, the usual reason for
+# someone to unlock a file
+PERMISSIONS = -3904
+
+# Each image-heavy page holds one uncompressed RGB image of this many pixels
+# per side (768 KB), like a scanned page
+IMAGE_SIDE = 512
+
+# Content and page counts per profile; every one is built for each
+# encryption and protection. 19 image pages come to just under 15 MB, the
+# largest file that still fits in a 16 MB upload.
+PROFILES = {
+    'quick': [('text', 1), ('text', 100), ('image', 2)],
+    'full': [('text', 1), ('text', 100), ('text', 2000), ('image', 2), ('image', 19)],
+}
+
+
+def add_image_page(writer, font, rng, number):
+    """Add a page filled with an image of random pixels to writer."""
+    image = DecodedStreamObject()
+    image.set_data(rng.randbytes(IMAGE_SIDE * IMAGE_SIDE * 3))
+    image.update({
+        NameObject('/Type'): NameObject('/XObject'),
+        NameObject('/Subtype'): NameObject('/Image'),
+        NameObject('/Width'): NumberObject(IMAGE_SIDE),
+        NameObject('/Height'): NumberObject(IMAGE_SIDE),
+        NameObject('/ColorSpace'): NameObject('/DeviceRGB'),
+        NameObject('/BitsPerComponent'): NumberObject(8),
+    })
+
+    page = PageObject.create_blank_page(writer, 612, 792)
+    content = DecodedStreamObject()
+    content.set_data(f"q 532 0 0 712 40 40 cm /Im0 Do Q\nBT /F1 10 Tf 40 20 Td (Scan {number + 1}) Tj ET".encode())
+    page[NameObject('/Contents')] = writer._add_object(content)
+    page[NameObject('/Resources')] = DictionaryObject({
+        NameObject('/Font'): DictionaryObject({NameObject('/F1'): font}),
+        NameObject('/XObject'): DictionaryObject({NameObject('/Im0'): writer._add_object(image)})
+    })
+    writer.add_page(page)
+
+
+def _aes256_values(user_password, owner_password, key, rng):
+    """Return the /U, /UE, /O, /OE and /Perms entries for revision 6."""
+    u_salts, o_salts = rng.randbytes(16), rng.randbytes(16)
+    zero_iv = bytes(16)
+
+    u_value = AlgV5.calculate_hash(6, user_password, u_salts[:8], b'') + u_salts
+    ue_value = AES.new(AlgV5.calculate_hash(6, user_password, u_salts[8:], b''),
+                       AES.MODE_CBC, zero_iv).encrypt(key)
+    o_value = AlgV5.calculate_hash(6, owner_password, o_salts[:8], u_value) + o_salts
+    oe_value = AES.new(AlgV5.calculate_hash(6, owner_password, o_salts[8:], u_value),
+                       AES.MODE_CBC, zero_iv).encrypt(key)
+    perms = AES.new(key, AES.MODE_ECB).encrypt(
+        struct.pack('<i', PERMISSIONS) + b'\xff\xff\xff\xffTadb' + rng.randbytes(4))
+
+    return {'/U': u_value, '/UE': ue_value, '/O': o_value, '/OE': oe_value, '/Perms': perms}
+
+
+def _encryption_dict(encryption, user_password, owner_password, id1, rng):
+    """
+    Build the /Encrypt dictionary for a document.
+
+    Returns:
+        tuple: (DictionaryObject, file encryption key)
+    """
+    settings = ENCRYPTIONS[encryption]
+    revision, key_size = settings['R'], settings['bits'] // 8
+    user, owner = user_password.encode(), owner_password.encode()
+
+    if revision == 6:
+        key = rng.randbytes(key_size)
+        values = _aes256_values(user, owner, key, rng)
+    else:
+        # These take the key length in bits and /P as an unsigned value
+        o_key = AlgV4.compute_O_value_key(owner, revision, settings['bits'])
+        o_value = AlgV4.compute_O_value(o_key, user, revision)
+        key = AlgV4.compute_key(user, revision, settings['bits'], o_value, PERMISSIONS & 0xFFFFFFFF, id1, True)
+        values = {'/O': o_value, '/U': AlgV4.compute_U_value(key, revision, id1)}
+
+    encrypt = DictionaryObject({
+        NameObject('/Filter'): NameObject('/Standard'),
+        NameObject('/V'): NumberObject(settings['V']),
+        NameObject('/R'): NumberObject(revision),
+        NameObject('/Length'): NumberObject(settings['bits']),
+        NameObject('/P'): NumberObject(PERMISSIONS),
+    })
+    for name, value in values.items():
+        encrypt[NameObject(name)] = ByteStringObject(value)
+
+    if settings['method']:
+        encrypt[NameObject('/CF')] = DictionaryObject({
+            NameObject('/StdCF'): DictionaryObject({
+                NameObject('/Type'): NameObject('/CryptFilter'),
+                NameObject('/CFM'): NameObject(settings['method']),
+                NameObject('/AuthEvent'): NameObject('/DocOpen'),
+                NameObject('/Length'): NumberObject(key_size),
+            })
+        })
+        encrypt[NameObject('/StmF')] = NameObject('/StdCF')
+        encrypt[NameObject('/StrF')] = NameObject('/StdCF')
+
+    return encrypt, key
+
+
+def _object_key(encryption, key, idnum):
+    """Per-object key of algorithm 1; AES-256 uses the file key itself."""
+    if encryption == 'aes-256':
+        return key
+    salt = b'sAlT' if encryption == 'aes-128' else b''
+    digest = hashlib.md5(key + struct.pack('<i', idnum)[:3] + b'\x00\x00' + salt).digest()
+    return digest[:min(16, len(key) + 5)]
+
+
+def _encrypt_value(value, cipher):
+    """Encrypt the strings and stream data in value, in place where possible."""
+    if isinstance(value, (ByteStringObject, TextStringObject)):
+        return ByteStringObject(cipher(value.original_bytes))
+    if isinstance(value, StreamObject):
+        value._data = cipher(value._data)
+    if isinstance(value, DictionaryObject):
+        for name, item in list(value.items()):
+            value[name] = _encrypt_value(item, cipher)
+    elif isinstance(value, ArrayObject):
+        for index, item in enumerate(value):
+            value[index] = _encrypt_value(item, cipher)
+    return value
+
+
+def encrypt_writer(writer, encryption, user_password, owner_password, rng):
+    """
+    Encrypt every object of writer and return the /Encrypt reference.
+
+    The caller has to add the reference to the trailer, see write_encrypted.
+    """
+    id1 = rng.randbytes(16)
+    writer._ID = ArrayObject([ByteStringObject(id1), ByteStringObject(id1)])
+    encrypt, key = _encryption_dict(encryption, user_password, owner_password, id1, rng)
+
+    for index, obj in enumerate(list(writer._objects)):
+        object_key = _object_key(encryption, key, index + 1)
+        if encryption.startswith('aes'):
+            def cipher(data, object_key=object_key):
+                iv = rng.randbytes(16)
+                return iv + AES.new(object_key, AES.MODE_CBC, iv).encrypt(pad(data, 16))
+        else:
+            def cipher(data, object_key=object_key):
+                return ARC4.new(object_key).encrypt(data)
+        _encrypt_value(obj, cipher)
+
+    # Added last so that it is the one object left in clear text
+    return writer._add_object(encrypt)
+
+
+def write_encrypted(writer, encrypt_ref, path):
+    """Write writer to path with encrypt_ref as the trailer's /Encrypt."""
+    buffer = io.BytesIO()
+    writer.write(buffer)
+    head, trailer, tail = buffer.getvalue().rpartition(b'trailer\n<<\n')
+    assert trailer, "trailer not found"
+    with open(path, 'wb') as f:
+        f.write(head + trailer + f"/Encrypt {encrypt_ref.idnum} 0 R\n".encode() + tail)
+
+
+def make_case_pdf(path, seed, encryption, protection, content, pages):
+    """Write one corpus file, the same bytes for the same arguments."""
+    rng = random.Random(f"{seed}:{os.path.basename(path)}")
+    writer = PdfWriter()
+    font = add_font(writer)
+    for number in range(pages):
+        if content == 'image':
+            add_image_page(writer, font, rng, number)
+        else:
+            add_text_page(writer, font, number)
+
+    user_password = USER_PASSWORD if protection == 'user' else ''
+    encrypt_ref = encrypt_writer(writer, encryption, user_password, OWNER_PASSWORD, rng)
+    write_encrypted(writer, encrypt_ref, path)
+    return path
+
+
+def _sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def build_corpus(directory, profile='quick', seed=1):
+    """
+    Generate the corpus for profile into directory.
+
+    Files already there are kept, so a corpus directory can be reused between
+    runs; their hashes in the manifest show if they came from the same seed.
+
+    Returns:
+        list: One dict per file with name, path, encryption, protection,
+            content, pages, password, bytes and sha256
+    """
+    os.makedirs(directory, exist_ok=True)
+    cases = []
+    for content, pages in PROFILES[profile]:
+        for encryption in ENCRYPTIONS:
+            for protection in PROTECTIONS:
+                name = f"{encryption}_{protection}_{content}_{pages}p.pdf"
+                path = os.path.join(directory, name)
+                if not os.path.exists(path):
+                    make_case_pdf(path, seed, encryption, protection, content, pages)
+                cases.append({
+                    'name': name,
+                    'path': path,
+                    'encryption': encryption,
+                    'protection': protection,
+                    'content': content,
+                    'pages': pages,
+                    'password': USER_PASSWORD if protection == 'user' else '',
+                    'bytes': os.path.getsize(path),
+                    'sha256': _sha256(path)
+                })
+
+    with open(os.path.join(directory, 'manifest.json'), 'w') as f:
+        json.dump({'profile': profile, 'seed': seed, 'files': cases}, f, indent=2)
+    return cases
+
+
+def check_case(case):
+    """Raise if a corpus file does not decrypt with its passwords."""
+    for password in (case['password'], OWNER_PASSWORD):
+        reader = PdfReader(case['path'])
+        assert reader.is_encrypted and reader.decrypt(password), f"{case['name']}: {password!r} rejected"
+        assert len(reader.pages) == case['pages'], case['name']
+        text = reader.pages[-1].extract_text()
+        assert ('Scan' if case['content'] == 'image' else 'lorem ipsum') in text, f"{case['name']}: bad content"
+    if case['protection'] == 'user':
+        assert not PdfReader(case['path']).decrypt('wrong'), f"{case['name']}: opens with a wrong password"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--profile', choices=sorted(PROFILES), default='quick')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--out', required=True, help='Directory to write the corpus to')
+    parser.add_argument('--check', action='store_true', help='Decrypt every file with PyPDF2 afterwards')
+    args = parser.parse_args()
+
+    cases = build_corpus(args.out, args.profile, args.seed)
+    print(f"{'file':>36} {'KB':>8} sha256")
+    for case in cases:
+        if args.check:
+            check_case(case)
+        print(f"{case['name']:>36} {case['bytes'] / 1024:>8.0f} {case['sha256'][:16]}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,61 @@
-workers = 4
+import os
+import shutil
+
+# 'sync' gives every connection a worker for its whole duration; 'async' runs
+# each worker's connections as gevent greenlets, so slow clients uploading or
+# downloading don't tie up a worker while the PDF work runs on threads
+SERVER_MODE = os.environ.get('SERVER_MODE', 'sync')
+if SERVER_MODE == 'async':
+    # Patch before the app is preloaded, so that its locks, queues and
+    # threads are gevent ones in every worker
+    from gevent import monkey
+    monkey.patch_all()
+
+# Exported so that every worker sizes its PDF process pool to its share of
+# the CPUs, see PDF_POOL_WORKERS in app.py. Set WEB_CONCURRENCY rather than
+# --workers to change the count
+workers = int(os.environ.setdefault('WEB_CONCURRENCY', '4'))
 bind = '0.0.0.0:' + str(os.environ.get('PORT', 8000))
 timeout = 120
+worker_class = 'gevent' if SERVER_MODE == 'async' else 'sync'
+# Connections each async worker serves at once
+worker_connections = int(os.environ.get('WORKER_CONNECTIONS', 1000))
+
+# Import the app once in the master: the folder checks run once and the
+# workers are forked with everything already imported
+preload_app = True
+
+# Folder where the workers keep their metrics, see METRICS_FOLDER in app.py.
+# Set here so that every worker inherits it.
+METRICS_FOLDER = os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR',
+                                       os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'metrics'))
+
+
+def on_starting(server):
+    # Values left by the workers of a previous run would be added to this one's
+    shutil.rmtree(METRICS_FOLDER, ignore_errors=True)
+    os.makedirs(METRICS_FOLDER, exist_ok=True)
+
+
+def when_ready(server):
+    # Import PyPDF2 and pycryptodome and prime them before the workers are
+    # forked, so no worker pays for it on its first upload
+    from app import warm_up
+    server.log.info("Warmed up the PDF code in %.3fs", warm_up())
+
+
+def post_worker_init(worker):
+    # Start the fast-lane PDF process pool before the worker takes its first
+    # request; the slow-lane pool starts with the first large file
+    from app import get_pdf_pool, setup_periodic_cleanup
+    get_pdf_pool()
+    
+    # Start the cleanup scheduler; the workers elect one of them to run it
+    setup_periodic_cleanup()
+
+
+def child_exit(server, worker):
+    # The in-flight gauges of a dead worker no longer count; its counters and
+    # histograms stay part of the totals
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
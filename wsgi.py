@@ -1,4 +1,8 @@
-from app import app
+from app import app, setup_periodic_cleanup
+
+# Under gunicorn every worker starts the cleanup scheduler in post_worker_init;
+# starting it here would start it in the master, which preloads this module
 
 if __name__ == "__main__":
-    app.run() 
\ No newline at end of file
+    setup_periodic_cleanup()
+    app.run() 